@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import date, timedelta
+from typing import Dict, Any, Optional, List, Tuple, Callable
+
+# ================== СЧЁТЧИКИ ОТЧЁТА ==================
+# Вектор счётчиков за день (и сумма за окно — тот же формат):
+#   [0..2]   дни с утренним / дневным / вечерним чек-ином
+#   [3..5]   сон (утро):         Хорошо / Нормально / Плохо
+#   [6..8]   энергия (утро):     Хорошо / Нормально / Плохо
+#   [9..11]  самочувствие (день): Хорошо / Нормально / Плохо
+#   [12..14] энергия (день):     Хорошо / Нормально / Плохо
+STATUSES = ("Хорошо", "Нормально", "Плохо")
+STATUS_INDEX = {s: i for i, s in enumerate(STATUSES)}
+PRESENCE_INDEX = {"morning": 0, "day": 1, "evening": 2}
+FIELD_OFFSET = {
+    ("morning", "sleep_quality"): 3,
+    ("morning", "energy_level"): 6,
+    ("day", "wellbeing"): 9,
+    ("day", "energy_level"): 12,
+}
+VECTOR_SIZE = 15
+WINDOW_DAYS = 7
+
+def count_day(payload: Dict[str, Dict[str, str]]) -> List[int]:
+    vec = [0] * VECTOR_SIZE
+    for checkin_type, fields in payload.items():
+        if not fields:
+            continue
+        if checkin_type in PRESENCE_INDEX:
+            vec[PRESENCE_INDEX[checkin_type]] = 1
+        for field, value in fields.items():
+            offset = FIELD_OFFSET.get((checkin_type, field))
+            if offset is not None and value in STATUS_INDEX:
+                vec[offset + STATUS_INDEX[value]] += 1
+    return vec
+
+def count_days(data_by_date: Dict[str, Dict[str, Dict[str, str]]]) -> List[int]:
+    # полный пересчёт — эталон для проверки инкрементальных счётчиков
+    total = [0] * VECTOR_SIZE
+    for payload in data_by_date.values():
+        for i, v in enumerate(count_day(payload)):
+            total[i] += v
+    return total
+
+class _ChatWindow:
+    __slots__ = ("end", "days", "totals")
+
+    def __init__(self, end: date):
+        self.end = end
+        self.days: Dict[date, List[int]] = {}
+        self.totals = [0] * VECTOR_SIZE
+
+    @property
+    def start(self) -> date:
+        return self.end - timedelta(days=WINDOW_DAYS - 1)
+
+    def advance(self, new_end: date):
+        # сдвигаем окно вперёд: вычитаем выпавшие дни (не больше WINDOW_DAYS штук)
+        if new_end <= self.end:
+            return
+        new_start = new_end - timedelta(days=WINDOW_DAYS - 1)
+        for d in [d for d in self.days if d < new_start]:
+            vec = self.days.pop(d)
+            for i, v in enumerate(vec):
+                self.totals[i] -= v
+        self.end = new_end
+
+# ================== ИНКРЕМЕНТАЛЬНЫЕ АГРЕГАТЫ ==================
+class WeeklyAggregates:
+    """
+    Скользящие счётчики недельного отчёта по каждому чату.
+    Обновляются на каждом ответе чек-ина, отчёт строится за O(1).
+    Чат поднимается из хранилища одним запросом по диапазону при первом обращении.
+    """
+
+    def __init__(self, loader: Callable[[int, date, date], Dict[str, Any]], verify: bool = False):
+        self._loader = loader
+        self.verify_enabled = verify
+        self._chats: Dict[int, _ChatWindow] = {}
+        self.stats = {"loads": 0, "verified": 0, "mismatches": 0}
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def _load(self, chat_id: int, today: date) -> _ChatWindow:
+        w = _ChatWindow(today)
+        for d, payload in self._loader(chat_id, w.start, today).items():
+            vec = count_day(payload)
+            w.days[date.fromisoformat(d)] = vec
+            for i, v in enumerate(vec):
+                w.totals[i] += v
+        self._chats[chat_id] = w
+        self.stats["loads"] += 1
+        return w
+
+    def forget(self, chat_id: int):
+        self._chats.pop(chat_id, None)
+
+    def sweep(self, today: date) -> int:
+        # окна без дней в последней неделе пусты (с запасом в день на часовые пояса) —
+        # без ответов чат потом просто поднимется из хранилища заново
+        cutoff = today - timedelta(days=WINDOW_DAYS)
+        stale = [c for c, w in self._chats.items() if not any(d >= cutoff for d in w.days)]
+        for chat_id in stale:
+            del self._chats[chat_id]
+        return len(stale)
+
+    def on_answer(self, chat_id: int, date_key: str, checkin_type: str, field: str,
+                  previous: Optional[str], value: str):
+        # вызывать ПОСЛЕ записи ответа в хранилище
+        d = date.fromisoformat(date_key)
+        w = self._chats.get(chat_id)
+        if w is None:
+            # загрузка из хранилища уже увидит новый ответ
+            self._load(chat_id, d)
+            return
+        w.advance(d)
+        if d < w.start:
+            return
+
+        vec = w.days.get(d)
+        if vec is None:
+            vec = w.days[d] = [0] * VECTOR_SIZE
+
+        delta: List[Tuple[int, int]] = []
+        presence = PRESENCE_INDEX.get(checkin_type)
+        if presence is not None and not vec[presence]:
+            delta.append((presence, 1))
+        offset = FIELD_OFFSET.get((checkin_type, field))
+        if offset is not None:
+            # ответ за тот же день перезаписан — снимаем старое значение
+            if previous in STATUS_INDEX:
+                delta.append((offset + STATUS_INDEX[previous], -1))
+            if value in STATUS_INDEX:
+                delta.append((offset + STATUS_INDEX[value], 1))
+
+        for i, v in delta:
+            vec[i] += v
+            w.totals[i] += v
+
+    def _window(self, chat_id: int, today: date) -> _ChatWindow:
+        w = self._chats.get(chat_id)
+        if w is None or w.end > today:
+            return self._load(chat_id, today)
+        w.advance(today)
+        return w
+
+    def counts(self, chat_id: int, today: date) -> List[int]:
+        totals = list(self._window(chat_id, today).totals)
+        if self.verify_enabled and not self.verify(chat_id, today, totals):
+            totals = list(self._chats[chat_id].totals)
+        return totals
+
+    def verify(self, chat_id: int, today: date, totals: Optional[List[int]] = None) -> bool:
+        # сверка с полным пересчётом; при расхождении чат перечитывается из хранилища
+        if totals is None:
+            totals = list(self._window(chat_id, today).totals)
+        expected = count_days(self._loader(chat_id, today - timedelta(days=WINDOW_DAYS - 1), today))
+        self.stats["verified"] += 1
+        if totals == expected:
+            return True
+        self.stats["mismatches"] += 1
+        logging.error("WeeklyAggregates mismatch chat_id=%s incremental=%s recount=%s", chat_id, totals, expected)
+        self._load(chat_id, today)
+        return False
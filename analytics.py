@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from array import array
+from datetime import date, timedelta
+from typing import Dict, Any, Optional, List
+
+from compact import SLOTS, SLOT_BITS, SLOT_MASK
+
+CHECKIN_TYPES = ("morning", "day", "evening")
+TYPE_SLOTS = {t: [i for i, (slot_type, _, _) in enumerate(SLOTS) if slot_type == t] for t in CHECKIN_TYPES}
+WEEK = 7
+
+TYPE_TITLES = {"morning": "утро", "day": "день", "evening": "вечер"}
+SLOT_TITLES = {
+    "morning.sleep_quality": "Сон",
+    "morning.energy_level": "Энергия утром",
+    "day.wellbeing": "Самочувствие",
+    "day.energy_level": "Энергия днём",
+    "evening.day_result": "Итог дня",
+}
+REPORT_WEEKS = 12  # в текст — последние недели, в результате — все
+
+_numpy_module = None
+
+def _numpy():
+    # NumPy нужен только аналитике: импорт при первом запуске, None — не установлен
+    global _numpy_module
+    if _numpy_module is None:
+        try:
+            import numpy
+            _numpy_module = numpy
+        except ImportError:
+            _numpy_module = False
+    return _numpy_module or None
+
+# ================== ВЫБОРКА СТОЛБЦОВ ==================
+async def collect_codes(storage, start: date, end: date, chunk: int = 500):
+    """
+    Коды ответов всех подписчиков за [start, end] одной матрицей (строка — чат, столбец — день).
+    Горячие данные меняет event loop, поэтому они копируются здесь же, порциями по chunk чатов
+    с уступкой циклу между порциями; холодный архив (неизменяемые файлы) читается в потоке.
+    """
+    chat_ids = storage.list_subscribers()
+    hot = array("H")
+    for i in range(0, len(chat_ids), chunk):
+        hot.extend(storage.checkin_codes(chat_ids[i:i + chunk], start, end))
+        await asyncio.sleep(0)
+    cold = await asyncio.to_thread(storage.archived_checkin_codes, chat_ids, start, end)
+    return len(chat_ids), hot, cold
+
+# ================== АГРЕГАЦИЯ ==================
+def summarize(chats: int, start: date, days: int, hot: array, cold: List[array]) -> Dict[str, Any]:
+    # выполняется в потоке: все операции — над массивами NumPy целиком
+    np = _numpy()
+    if np is None:
+        raise RuntimeError("numpy is required for analytics")
+    result: Dict[str, Any] = {
+        "start": start.isoformat(),
+        "end": (start + timedelta(days=days - 1)).isoformat(),
+        "days": days,
+        "chats": chats,
+        "active": 0,
+        "completion": {t: {"all": 0.0, "active": 0.0} for t in CHECKIN_TYPES},
+        "distributions": {},
+        "weeks": [],
+    }
+    if not chats:
+        return result
+    m = np.frombuffer(hot, dtype=np.uint16).reshape(chats, days)
+    for part in cold:
+        # день, который есть и в горячих данных, и в архиве (ротация в процессе), берём из горячих
+        m = np.where(m != 0, m, np.frombuffer(part, dtype=np.uint16).reshape(chats, days))
+
+    values = [(m >> (i * SLOT_BITS)) & SLOT_MASK for i in range(len(SLOTS))]
+    answered = [v != 0 for v in values]
+    active = int((m != 0).any(axis=1).sum())
+
+    week_starts = np.arange(0, days, WEEK)
+    week_cells = chats * (np.minimum(week_starts + WEEK, days) - week_starts)
+
+    def by_week(per_day):
+        return np.add.reduceat(per_day, week_starts)
+
+    completion: Dict[str, Dict[str, float]] = {}
+    week_completion: Dict[str, List[float]] = {}
+    for t in CHECKIN_TYPES:
+        # чек-ин заполнен, если есть ответы на все его вопросы-кнопки
+        done_per_day = np.logical_and.reduce([answered[i] for i in TYPE_SLOTS[t]]).sum(axis=0)
+        total = int(done_per_day.sum())
+        completion[t] = {"all": total / (chats * days), "active": total / (active * days) if active else 0.0}
+        week_completion[t] = (by_week(done_per_day) / week_cells).tolist()
+
+    distributions: Dict[str, Dict[str, Any]] = {}
+    week_scores: Dict[str, List[Optional[float]]] = {}
+    for i, (t, f, labels) in enumerate(SLOTS):
+        key = f"{t}.{f}"
+        v = values[i]
+        counts = np.bincount(v.ravel(), minlength=len(labels) + 1)[1:len(labels) + 1]
+        distributions[key] = {"counts": dict(zip(labels, counts.tolist())), "answers": int(counts.sum())}
+        # балл ответа: 1 — лучший вариант, 0 — худший
+        score = np.where(v != 0, (len(labels) - v.astype(np.float32)) / (len(labels) - 1), 0.0)
+        sums = by_week(score.sum(axis=0)).tolist()
+        counts_by_week = by_week(answered[i].sum(axis=0)).tolist()
+        week_scores[key] = [round(s / n, 3) if n else None for s, n in zip(sums, counts_by_week)]
+
+    weeks = []
+    for w, offset in enumerate(week_starts.tolist()):
+        weeks.append({
+            "start": (start + timedelta(days=offset)).isoformat(),
+            "completion": {t: round(week_completion[t][w], 4) for t in CHECKIN_TYPES},
+            "scores": {key: week_scores[key][w] for key in week_scores},
+        })
+    result.update(
+        active=active,
+        completion={t: {k: round(v, 4) for k, v in c.items()} for t, c in completion.items()},
+        distributions=distributions,
+        weeks=weeks,
+    )
+    return result
+
+async def cohort_report(storage, start: date, end: date, chunk: int = 500) -> Dict[str, Any]:
+    started = time.perf_counter()
+    chats, hot, cold = await collect_codes(storage, start, end, chunk)
+    extracted = time.perf_counter()
+    result = await asyncio.to_thread(summarize, chats, start, (end - start).days + 1, hot, cold)
+    result["timing"] = {
+        "extract_s": round(extracted - started, 3),
+        "aggregate_s": round(time.perf_counter() - extracted, 3),
+    }
+    return result
+
+# ================== ТЕКСТ ОТЧЁТА ==================
+def _pct(x: float) -> str:
+    return f"{x * 100:.0f}%"
+
+def format_report(r: Dict[str, Any]) -> str:
+    lines = [
+        f"📊 Аналитика {r['start']} — {r['end']} ({r['days']} дн.)",
+        f"Подписчиков: {r['chats']}, отвечали: {r['active']}"
+        + (f" ({_pct(r['active'] / r['chats'])})" if r["chats"] else ""),
+        "",
+        "Заполнение чек-инов (от всех / от отвечавших):",
+    ]
+    for t in CHECKIN_TYPES:
+        c = r["completion"][t]
+        lines.append(f"• {TYPE_TITLES[t]}: {_pct(c['all'])} / {_pct(c['active'])}")
+
+    lines += ["", "Ответы:"]
+    for key, d in r["distributions"].items():
+        n = d["answers"]
+        shares = " · ".join(f"{label} {_pct(count / n) if n else '—'}" for label, count in d["counts"].items())
+        lines.append(f"• {SLOT_TITLES.get(key, key)}: {shares} (n={n})")
+
+    weeks = r["weeks"][-REPORT_WEEKS:]
+    if weeks:
+        lines += ["", "По неделям — заполнение утро/день/вечер, балл сна и самочувствия (0…1):"]
+        previous = None
+        for w in weeks:
+            comp = "/".join(f"{w['completion'][t] * 100:.0f}" for t in CHECKIN_TYPES)
+            if previous is not None:
+                delta = "/".join(
+                    f"{round((w['completion'][t] - previous['completion'][t]) * 100):+d}" for t in CHECKIN_TYPES
+                )
+                comp += f"% ({delta})"
+            else:
+                comp += "%"
+            scores = []
+            for key in ("morning.sleep_quality", "day.wellbeing"):
+                score = w["scores"][key]
+                scores.append(f"{SLOT_TITLES[key].lower()} " + ("—" if score is None else f"{score:.2f}"))
+            lines.append(f"{w['start'][5:]}: {comp}; {', '.join(scores)}")
+            previous = w
+
+    t = r.get("timing")
+    if t:
+        lines += ["", f"Выборка {t['extract_s']} с, расчёт {t['aggregate_s']} с"]
+    return "\n".join(lines)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Память и размер на диске истории чек-инов: прежний weekly_data
+{chat: {date: {type: {field: value}}}} против CheckinHistory (коды по 3 бита
+в uint16 на день + боковая таблица для свободного текста).
+
+    python benchmarks/bench_compact.py [--chats 2000] [--days 180]
+
+Заодно проверяет, что преобразование туда и обратно без потерь.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tracemalloc
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from compact import CheckinHistory, DAY_RESULTS, dump_history  # noqa: E402
+from aggregates import STATUSES  # noqa: E402
+
+def generate(chats: int, days: int, seed: int = 1) -> dict:
+    # как в жизни: не каждый день и не все три чек-ина; sleep_plan — свободный текст
+    rnd = random.Random(seed)
+    start = date.today() - timedelta(days=days)
+    data = {}
+    for c in range(chats):
+        by_date = {}
+        for d in range(days):
+            day = {}
+            if rnd.random() < 0.8:
+                day["morning"] = {"sleep_quality": rnd.choice(STATUSES), "energy_level": rnd.choice(STATUSES)}
+            if rnd.random() < 0.6:
+                day["day"] = {"wellbeing": rnd.choice(STATUSES), "energy_level": rnd.choice(STATUSES)}
+            if rnd.random() < 0.5:
+                day["evening"] = {"day_result": rnd.choice(DAY_RESULTS), "sleep_plan": f"{rnd.randint(21, 23)}:{rnd.choice(['00', '30'])}"}
+            if day:
+                by_date[(start + timedelta(days=d)).isoformat()] = day
+        data[str(100000000 + c)] = by_date
+    return data
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    obj = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, "filename"))
+    return obj, size
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=180)
+    args = parser.parse_args()
+
+    source = json.dumps(generate(args.chats, args.days), ensure_ascii=False)
+    legacy, legacy_mem = measure(lambda: json.loads(source))
+    history, compact_mem = measure(lambda: CheckinHistory.from_json(json.loads(source)))
+    assert history.to_json() == legacy, "round trip is lossy"
+
+    legacy_disk = len(json.dumps(legacy, ensure_ascii=False, separators=(",", ":")).encode())
+    compact_disk = len(dump_history(history).encode())
+    answers = sum(len(f) for by_date in legacy.values() for day in by_date.values() for f in day.values())
+
+    print(f"{args.chats} chats x {args.days} days, {answers} answers")
+    print(f"memory  legacy: {legacy_mem / 1e6:8.1f} MB   compact: {compact_mem / 1e6:8.1f} MB   ({legacy_mem / compact_mem:.1f}x)")
+    print(f"disk    legacy: {legacy_disk / 1e6:8.1f} MB   compact: {compact_disk / 1e6:8.1f} MB   ({legacy_disk / compact_disk:.1f}x)")
+    print("round trip: lossless")
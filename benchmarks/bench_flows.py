@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Стоимость одного шага анкеты: прежний путь (поиск вопроса + get_keyboard, который
+каждый раз собирает словарь клавиатур, + to_dict/json.dumps разметки при отправке)
+против собранного потока (шаг по номеру, проверка ответа, готовый объект клавиатуры —
+при отправке остаётся только его to_dict/json.dumps).
+
+    python benchmarks/bench_flows.py [--steps 200000]
+
+Нужен python-telegram-bot (flows собирает настоящие ReplyKeyboardMarkup).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove  # noqa: E402
+
+from questionnaire import QUESTIONS, SURVEY  # noqa: E402
+
+def to_payload(markup):
+    # то, что PTB делает с reply_markup при отправке
+    return json.dumps(markup.to_dict())
+
+def legacy_setup():
+    # прежние структуры: кортежи (поле, текст, тип) и клавиатуры по типу
+    rows_by_answer = {}
+    legacy_questions = []
+    for i, q in enumerate(QUESTIONS):
+        rows = q["answer"].rows
+        q_type = None
+        if rows is not None:
+            q_type = rows_by_answer.setdefault(rows, f"kb{len(rows_by_answer)}")
+        legacy_questions.append((q["field"], q["text"], q_type))
+    keyboards = {
+        t: ReplyKeyboardMarkup([list(r) for r in rows], resize_keyboard=True, one_time_keyboard=True)
+        for rows, t in rows_by_answer.items()
+    }
+
+    def get_keyboard(q_type):
+        return dict(keyboards).get(q_type, ReplyKeyboardRemove())
+
+    return legacy_questions, get_keyboard
+
+def bench_legacy(n, answers):
+    questions, get_keyboard = legacy_setup()
+    count = len(questions)
+    t0 = time.perf_counter()
+    for i in range(n):
+        q_index = i % count
+        key, _, _ = questions[q_index]
+        value = answers[q_index].strip()
+        q_index += 1
+        if value and q_index < count:
+            _, text, q_type = questions[q_index]
+            to_payload(get_keyboard(q_type))
+    return (time.perf_counter() - t0) / n
+
+def bench_compiled(n, answers):
+    count = len(SURVEY)
+    t0 = time.perf_counter()
+    for i in range(n):
+        step = SURVEY.steps[i % count]
+        value = step.parse(answers[step.index].strip())
+        if value is not None and step.next is not None:
+            next_step = SURVEY.steps[step.next]
+            if next_step.reply_markup is not None:
+                to_payload(next_step.reply_markup)
+    return (time.perf_counter() - t0) / n
+
+def sample_answers():
+    answers = []
+    for q in QUESTIONS:
+        rows = q["answer"].rows
+        answers.append(rows[0][-1] if rows else "170")
+    return answers
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=200000)
+    args = parser.parse_args()
+    answers = sample_answers()
+    legacy = bench_legacy(args.steps, answers)
+    compiled = bench_compiled(args.steps, answers)
+    print(f"legacy:   {legacy * 1e6:8.2f} µs/step")
+    print(f"compiled: {compiled * 1e6:8.2f} µs/step (incl. answer validation)")
+    print(f"speedup:  {legacy / compiled:8.1f}x")
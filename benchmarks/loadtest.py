@@ -0,0 +1,672 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный прогон бота без сети: локальные заглушки Bot API (getUpdates/sendMessage/
+editMessageText/getFile/скачивание файла) и OpenAI Responses (обычный и потоковый ответ),
+bot.py запускается отдельным процессом с BOT_API_BASE_URL/OPENAI_BASE_URL на заглушки.
+
+    python benchmarks/loadtest.py [--users 50] [--subscribers 1000] [--photos 2]
+        [--telegram-latency 30] [--openai-latency 1500] [--openai-error-rate 0.02]
+        [--telegram-error-rate 0.01] [--broadcast-in 90] [--checkins morning,day,evening]
+        [--json report.json]
+
+Сценарий:
+  1. users синтетических пользователей параллельно: /start, вся анкета (QUESTIONS),
+     подписка, photos фото еды каждый;
+  2. «утренняя рассылка»: subscribers подписчиков (плюс users) заранее записаны в хранилище
+     с одинаковым временем чек-ина — слот срабатывает на всех сразу; каждый чат проходит
+     чек-ин до конца; затем так же дневной и вечерний (через --slot-gap минут).
+
+Отчёт: p50/p95/p99 задержки от апдейта до первого ответа бота по видам шагов,
+задержка доставки рассылки, пропускная способность, пиковая память процесса бота (VmHWM).
+Лог бота остаётся во временном каталоге (путь печатается в конце).
+"""
+import argparse
+import asyncio
+import email.parser
+import email.policy
+import io
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Optional, List, Tuple, Callable, Awaitable, AsyncIterator
+from urllib.parse import parse_qs, urlsplit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from questionnaire import (  # noqa: E402
+    QUESTIONS, CHECKIN_FLOWS,
+    MORNING_CHECKIN_QUESTIONS, DAY_CHECKIN_QUESTIONS, EVENING_CHECKIN_QUESTIONS,
+)
+from flows import Number  # noqa: E402
+
+try:
+    from PIL import Image
+except ImportError:  # без Pillow все фото — копии одного JPEG из репозитория
+    Image = None
+
+TOKEN = "123456:loadtest"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+SAMPLE_PHOTO = os.path.join(ROOT, "photo_2026-01-05_03-09-46.jpg")
+CHECKIN_QUESTIONS = {
+    "morning": MORNING_CHECKIN_QUESTIONS,
+    "day": DAY_CHECKIN_QUESTIONS,
+    "evening": EVENING_CHECKIN_QUESTIONS,
+}
+ACTIVE_BASE = 10_000_000
+PASSIVE_BASE = 20_000_000
+
+# ================== МИНИМАЛЬНЫЙ HTTP-СЕРВЕР ==================
+class Response:
+    def __init__(self, status: int = 200, body: Any = None, content_type: str = "application/json",
+                 chunks: Optional[AsyncIterator[bytes]] = None):
+        self.status = status
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.body = body or b""
+        self.content_type = content_type
+        self.chunks = chunks  # потоковый ответ (chunked)
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+class MiniServer:
+    # keep-alive, тело по Content-Length, ответ целиком или chunked — этого хватает httpx
+    def __init__(self, handler: Callable[[str, str, Dict[str, str], bytes], Awaitable[Response]]):
+        self.handler = handler
+        self.port = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                try:
+                    resp = await self.handler(method, target, headers, body)
+                except Exception as e:  # ошибка заглушки — видна в отчёте как 500
+                    resp = Response(500, {"error": repr(e)})
+                head = f"HTTP/1.1 {resp.status} {REASONS.get(resp.status, 'OK')}\r\nContent-Type: {resp.content_type}\r\n"
+                if resp.chunks is None:
+                    writer.write(f"{head}Content-Length: {len(resp.body)}\r\n\r\n".encode() + resp.body)
+                else:
+                    writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode())
+                    async for chunk in resp.chunks:
+                        writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                        await writer.drain()
+                    writer.write(b"0\r\n\r\n")
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+def parse_params(headers: Dict[str, str], body: bytes) -> Dict[str, Any]:
+    # PTB шлёт параметры формой (urlencoded или multipart с файлами), вложенные — строками JSON
+    ctype = headers.get("content-type", "")
+    if not body:
+        return {}
+    if ctype.startswith("application/json"):
+        return json.loads(body)
+    if ctype.startswith("multipart/form-data"):
+        msg = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {ctype}\r\n\r\n".encode() + body
+        )
+        params: Dict[str, Any] = {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+            params[name] = payload if part.get_filename() else payload.decode("utf-8")
+        return params
+    return {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
+
+# ================== СТАТИСТИКА ==================
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def add(self, kind: str, seconds: float):
+        self.samples.setdefault(kind, []).append(seconds)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {
+            kind: {
+                "count": len(v),
+                "p50_ms": round(percentile(v, 50) * 1000, 1),
+                "p95_ms": round(percentile(v, 95) * 1000, 1),
+                "p99_ms": round(percentile(v, 99) * 1000, 1),
+                "max_ms": round(max(v) * 1000, 1),
+            }
+            for kind, v in sorted(self.samples.items())
+        }
+
+# ================== ЗАГЛУШКА BOT API ==================
+class FakeTelegram:
+    """
+    Апдейты пользователей кладутся в очередь getUpdates; всё, что бот отправляет в чат,
+    попадает в его входящие (inbox) с временем получения.
+    """
+
+    def __init__(self, latency: float, error_rate: float, rng: random.Random):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng
+        self._updates: List[Dict[str, Any]] = []
+        self._new_updates = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        self.inboxes: Dict[int, asyncio.Queue] = {}
+        self.files: Dict[str, bytes] = {}
+        self.polling = asyncio.Event()
+        self.calls: Dict[str, int] = {}
+        self.injected_errors = 0
+
+    def inbox(self, chat_id: int) -> asyncio.Queue:
+        q = self.inboxes.get(chat_id)
+        if q is None:
+            q = self.inboxes[chat_id] = asyncio.Queue()
+        return q
+
+    # ---------- апдейты от «пользователей» ----------
+    def _push(self, chat_id: int, message: Dict[str, Any]) -> int:
+        self._update_id += 1
+        self._message_id += 1
+        user = {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+        message.update(
+            message_id=self._message_id,
+            date=int(time.time()),
+            chat={"id": chat_id, "type": "private", "first_name": user["first_name"]},
+            **{"from": user},
+        )
+        self._updates.append({"update_id": self._update_id, "message": message})
+        self._new_updates.set()
+        return self._update_id
+
+    def send_text(self, chat_id: int, text: str) -> int:
+        message: Dict[str, Any] = {"text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._push(chat_id, message)
+
+    def send_photo(self, chat_id: int, image: bytes) -> int:
+        # как у Telegram: несколько размеров по возрастанию
+        sizes = []
+        base = f"{chat_id}-{self._update_id + 1}"
+        for side in (90, 320, 800):
+            file_id = f"photo-{base}-{side}"
+            self.files[file_id] = image
+            sizes.append({"file_id": file_id, "file_unique_id": f"u{file_id}", "width": side,
+                          "height": side * 3 // 4, "file_size": len(image)})
+        return self._push(chat_id, {"photo": sizes})
+
+    # ---------- HTTP ----------
+    async def handle(self, method: str, target: str, headers: Dict[str, str], body: bytes) -> Response:
+        path = urlsplit(target).path
+        if path.startswith(f"/file/bot{TOKEN}/"):
+            file_id = path.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+            data = self.files.get(file_id)
+            return Response(200, data, "image/jpeg") if data is not None else Response(404, b"")
+        prefix = f"/bot{TOKEN}/"
+        if not path.startswith(prefix):
+            return Response(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+        api_method = path[len(prefix):]
+        params = parse_params(headers, body)
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if api_method == "getUpdates":
+            return await self._get_updates(params)
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        if api_method in ("sendMessage", "sendPhoto", "editMessageText") and self.rng.random() < self.error_rate:
+            self.injected_errors += 1
+            return Response(429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                  "parameters": {"retry_after": 1}})
+        handler = getattr(self, f"_api_{api_method}", None)
+        if handler is None:
+            return Response(200, {"ok": True, "result": True})
+        return Response(200, {"ok": True, "result": handler(params)})
+
+    async def _get_updates(self, params: Dict[str, Any]) -> Response:
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        timeout = min(float(params.get("timeout") or 0), 10.0)
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return Response(200, {"ok": True, "result": self._updates[:limit]})
+
+    def _api_getMe(self, params):
+        return BOT_USER
+
+    def _message(self, chat_id: int, **fields) -> Dict[str, Any]:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    def _deliver(self, chat_id: int, method: str, text: str, markup: Optional[str]):
+        self.inbox(chat_id).put_nowait((time.perf_counter(), method, text, markup))
+
+    def _api_sendMessage(self, params):
+        chat_id = int(params["chat_id"])
+        self._deliver(chat_id, "sendMessage", params.get("text", ""), params.get("reply_markup"))
+        return self._message(chat_id, text=params.get("text", ""))
+
+    def _api_sendPhoto(self, params):
+        chat_id = int(params["chat_id"])
+        self._deliver(chat_id, "sendPhoto", params.get("caption", ""), params.get("reply_markup"))
+        return self._message(chat_id, caption=params.get("caption", ""),
+                             photo=[{"file_id": "bot-photo", "file_unique_id": "bot-photo", "width": 1, "height": 1}])
+
+    def _api_editMessageText(self, params):
+        chat_id = int(params["chat_id"])
+        self._deliver(chat_id, "editMessageText", params.get("text", ""), params.get("reply_markup"))
+        return self._message(chat_id, text=params.get("text", ""))
+
+    def _api_getFile(self, params):
+        file_id = params["file_id"]
+        return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": len(self.files.get(file_id, b"")),
+                "file_path": f"photos/{file_id}.jpg"}
+
+# ================== ЗАГЛУШКА OPENAI ==================
+class FakeOpenAI:
+    # POST /v1/responses: JSON с оценкой блюда; при stream=true — SSE с дельтами текста
+    def __init__(self, latency: float, error_rate: float, rng: random.Random):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng
+        self.requests = 0
+        self.injected_errors = 0
+
+    def _answer(self) -> str:
+        return json.dumps({
+            "dish": f"Тестовое блюдо {self.rng.randint(1, 999)}",
+            "calories": self.rng.randint(150, 900),
+            "protein": self.rng.randint(5, 60),
+            "fat": self.rng.randint(3, 50),
+            "carbs": self.rng.randint(10, 120),
+            "comment": "Сбалансированная порция.",
+        }, ensure_ascii=False)
+
+    @staticmethod
+    def _response(text: str) -> Dict[str, Any]:
+        return {
+            "id": "resp_loadtest",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": "gpt-4.1-mini",
+            "status": "completed",
+            "output": [{
+                "id": "msg_loadtest",
+                "type": "message",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+        }
+
+    async def handle(self, method: str, target: str, headers: Dict[str, str], body: bytes) -> Response:
+        if method != "POST" or not urlsplit(target).path.endswith("/responses"):
+            return Response(404, {"error": {"message": "not found"}})
+        self.requests += 1
+        request = json.loads(body or b"{}")
+        latency = self.latency * self.rng.uniform(0.7, 1.3)
+        if self.rng.random() < self.error_rate:
+            self.injected_errors += 1
+            await asyncio.sleep(latency / 4)
+            return Response(500, {"error": {"message": "injected error", "type": "server_error"}})
+        text = self._answer()
+        if not request.get("stream"):
+            await asyncio.sleep(latency)
+            return Response(200, self._response(text))
+        return Response(200, content_type="text/event-stream", chunks=self._stream(text, latency))
+
+    async def _stream(self, text: str, latency: float) -> AsyncIterator[bytes]:
+        def event(data: Dict[str, Any]) -> bytes:
+            return f"event: {data['type']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        parts = 8
+        size = max(1, len(text) // parts + 1)
+        seq = 0
+        for i in range(0, len(text), size):
+            await asyncio.sleep(latency / parts)
+            seq += 1
+            yield event({"type": "response.output_text.delta", "item_id": "msg_loadtest", "output_index": 0,
+                         "content_index": 0, "delta": text[i:i + size], "sequence_number": seq})
+        yield event({"type": "response.completed", "response": self._response(text), "sequence_number": seq + 1})
+
+# ================== ФОТО ==================
+def make_photo(rng: random.Random) -> bytes:
+    # разные картинки, чтобы кеш анализа (file_unique_id + перцептивный хеш) не отвечал за модель
+    if Image is None:
+        with open(SAMPLE_PHOTO, "rb") as f:
+            return f.read()
+    img = Image.new("RGB", (800, 600), tuple(rng.randint(0, 255) for _ in range(3)))
+    for _ in range(24):
+        x, y = rng.randint(0, 700), rng.randint(0, 500)
+        img.paste(tuple(rng.randint(0, 255) for _ in range(3)), (x, y, x + rng.randint(20, 100), y + rng.randint(20, 100)))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+# ================== ОТВЕТЫ ==================
+def answer_for(question: Dict[str, Any], rng: random.Random) -> str:
+    answer = question["answer"]
+    if answer.rows is not None:
+        return rng.choice([t for row in answer.rows for t in row])
+    if isinstance(answer, Number):
+        value = rng.uniform(answer.lo, answer.hi)
+        return str(int(value)) if answer.integer else f"{value:.1f}"
+    return "Всё хорошо, спасибо"
+
+# ================== ПОЛЬЗОВАТЕЛИ ==================
+class Chat:
+    """Один синтетический пользователь: пишет боту и ждёт первый ответ; хвост ответов вычитывает."""
+
+    def __init__(self, tg: FakeTelegram, rec: Recorder, chat_id: int, rng: random.Random, think: float, timeout: float):
+        self.tg = tg
+        self.rec = rec
+        self.chat_id = chat_id
+        self.rng = rng
+        self.think = think
+        self.timeout = timeout
+        self.inbox = tg.inbox(chat_id)
+        self.timeouts = 0
+
+    def _drain(self):
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+
+    async def _pause(self):
+        # «думает» перед ответом; заодно бот успевает дослать хвост прошлого шага
+        await asyncio.sleep(self.think * self.rng.uniform(0.5, 1.5))
+        self._drain()
+
+    async def expect(self, kind: str, since: float) -> Optional[Tuple[float, str, str, Optional[str]]]:
+        try:
+            msg = await asyncio.wait_for(self.inbox.get(), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.rec.add(f"{kind} (timeout)", self.timeout)
+            return None
+        self.rec.add(kind, msg[0] - since)
+        return msg
+
+    async def say(self, kind: str, text: str):
+        await self._pause()
+        t0 = time.perf_counter()
+        self.tg.send_text(self.chat_id, text)
+        return await self.expect(kind, t0)
+
+    async def photo(self, image: bytes):
+        await self._pause()
+        t0 = time.perf_counter()
+        self.tg.send_photo(self.chat_id, image)
+        if await self.expect("photo_first_reply", t0) is None:
+            return
+        # готово — сообщение с итогом, без «⏳ Уточняю…»
+        while True:
+            try:
+                _, _, text, _ = await asyncio.wait_for(self.inbox.get(), self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                return
+            if "⏳" not in text:
+                self.rec.add("photo_done", time.perf_counter() - t0)
+                return
+
+    async def survey(self, photos: List[bytes]):
+        await self.say("start", "/start")
+        await self.say("survey_step", "Начать анкетирование")
+        for i, q in enumerate(QUESTIONS):
+            kind = "survey_summary" if i == len(QUESTIONS) - 1 else "survey_step"
+            await self.say(kind, answer_for(q, self.rng))
+        await self.say("subscribe", "🔔 Подписаться на уведомления")
+        for image in photos:
+            await self.photo(image)
+
+    async def checkin(self, slot: str, due: float, until: float) -> bool:
+        # ждём первый вопрос рассылки; due — время слота по часам perf_counter
+        first = CHECKIN_FLOWS[slot].first.text
+        while True:
+            left = until - time.perf_counter()
+            if left <= 0:
+                self.rec.add(f"broadcast_{slot} (missed)", 0.0)
+                return False
+            try:
+                received, _, text, _ = await asyncio.wait_for(self.inbox.get(), left)
+            except asyncio.TimeoutError:
+                continue
+            if text == first:
+                break
+        self.rec.add(f"broadcast_{slot}_delivery", received - due)
+        for i, q in enumerate(CHECKIN_QUESTIONS[slot]):
+            kind = "checkin_done" if i == len(CHECKIN_QUESTIONS[slot]) - 1 else "checkin_step"
+            await self.say(kind, answer_for(q, self.rng))
+        return True
+
+# ================== ПРОЦЕСС БОТА ==================
+def seed_storage(directory: str, passive: List[int], active: List[int], times: Dict[str, str]):
+    # пассивные подписчики — сразу в подписке; активные подписываются кнопкой, время — из настроек
+    settings = {
+        "subscribers": passive,
+        "chat_settings": {str(c): {"tz": "+00:00", "times": times} for c in passive + active},
+    }
+    with open(os.path.join(directory, "user_settings.json"), "w", encoding="utf-8") as f:
+        json.dump(settings, f)
+
+def read_memory(pid: int) -> Dict[str, int]:
+    # VmHWM — пик RSS за всё время процесса (Linux)
+    result = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    result[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return result
+
+async def start_bot(args, tg_port: int, ai_port: int, directory: str) -> Tuple[asyncio.subprocess.Process, str]:
+    env = dict(os.environ)
+    env.update(
+        BOT_TOKEN=TOKEN,
+        OPENAI_API_KEY="sk-loadtest",
+        BOT_API_BASE_URL=f"http://127.0.0.1:{tg_port}",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{ai_port}/v1",
+        BOT_MODE="polling",
+        SHARD_ROLE="single",
+        STORAGE_DIR=directory,
+        PYTHONUNBUFFERED="1",
+    )
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    log_path = os.path.join(directory, "bot.log")
+    log = open(log_path, "wb")
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(ROOT, "bot.py"), cwd=ROOT, env=env, stdout=log, stderr=log,
+    )
+    log.close()
+    return proc, log_path
+
+async def stop_bot(proc: asyncio.subprocess.Process, grace: float = 15.0):
+    if proc.returncode is not None:
+        return
+    proc.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(proc.wait(), grace)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+# ================== ПРОГОН ==================
+async def run(args) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    rec = Recorder()
+    tg = FakeTelegram(args.telegram_latency / 1000, args.telegram_error_rate, rng)
+    ai = FakeOpenAI(args.openai_latency / 1000, args.openai_error_rate, rng)
+    tg_server, ai_server = MiniServer(tg.handle), MiniServer(ai.handle)
+    await tg_server.start()
+    await ai_server.start()
+
+    slots = [s for s in args.checkins.split(",") if s]
+    # время слотов: первая рассылка не раньше чем через broadcast_in секунд, дальше — через slot_gap минут
+    first = datetime.now(timezone.utc) + timedelta(seconds=args.broadcast_in)
+    first = first.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    due_at = {slot: first + timedelta(minutes=i * args.slot_gap) for i, slot in enumerate(slots)}
+    times = {slot: due.strftime("%H:%M") for slot, due in due_at.items()}
+
+    active = [ACTIVE_BASE + i for i in range(args.users)]
+    passive = [PASSIVE_BASE + i for i in range(args.subscribers)]
+    directory = tempfile.mkdtemp(prefix="loadtest-")
+    seed_storage(directory, passive, active, times)
+
+    started = time.perf_counter()
+    proc, log_path = await start_bot(args, tg_server.port, ai_server.port, directory)
+    peak = {"VmRSS": 0}
+
+    async def sample_memory():
+        while proc.returncode is None:
+            rss = read_memory(proc.pid).get("VmRSS", 0)
+            peak["VmRSS"] = max(peak["VmRSS"], rss)
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.create_task(sample_memory())
+    report: Dict[str, Any] = {"config": vars(args), "bot_log": log_path}
+    chats: Dict[int, Chat] = {}
+    try:
+        await asyncio.wait_for(tg.polling.wait(), args.timeout)
+        report["boot_to_first_poll_s"] = round(time.perf_counter() - started, 3)
+        print(f"bot polling after {report['boot_to_first_poll_s']}s; slots at {times} UTC", flush=True)
+
+        chats = {c: Chat(tg, rec, c, random.Random(rng.random()), args.think, args.timeout) for c in active + passive}
+
+        # 1) анкета, подписка, фото
+        photos = {c: [make_photo(rng) for _ in range(args.photos)] for c in active}
+        t0 = time.perf_counter()
+        calls0 = sum(tg.calls.values())
+        await asyncio.gather(*(chats[c].survey(photos[c]) for c in active))
+        interactive = time.perf_counter() - t0
+        updates = args.users * (len(QUESTIONS) + 3 + args.photos)
+        report["interactive"] = {
+            "seconds": round(interactive, 2),
+            "updates": updates,
+            "updates_per_s": round(updates / interactive, 1) if interactive else 0.0,
+            "bot_api_calls_per_s": round((sum(tg.calls.values()) - calls0) / interactive, 1) if interactive else 0.0,
+        }
+        if slots and datetime.now(timezone.utc) >= due_at[slots[0]]:
+            print("warning: the interactive phase ran into the first broadcast; raise --broadcast-in", flush=True)
+
+        # 2) рассылки: все подписчики отвечают на чек-ины
+        for slot in slots:
+            due = time.perf_counter() + (due_at[slot] - datetime.now(timezone.utc)).total_seconds()
+            until = due + args.timeout + args.broadcast_window
+            print(f"waiting for {slot} broadcast to {len(chats)} chats at {times[slot]} UTC", flush=True)
+            t0 = time.perf_counter()
+            calls0 = sum(tg.calls.values())
+            done = await asyncio.gather(*(chat.checkin(slot, due, until) for chat in chats.values()))
+            elapsed = time.perf_counter() - max(t0, due)
+            report[f"broadcast_{slot}"] = {
+                "chats": len(chats),
+                "completed": sum(done),
+                "seconds_from_due": round(elapsed, 2),
+                "bot_api_calls_per_s": round((sum(tg.calls.values()) - calls0) / elapsed, 1) if elapsed > 0 else 0.0,
+            }
+        report["memory"] = {**read_memory(proc.pid), "VmRSS_peak_sampled": peak["VmRSS"]}
+    finally:
+        await stop_bot(proc)
+        sampler.cancel()
+        await tg_server.stop()
+        await ai_server.stop()
+
+    report["latency"] = rec.summary()
+    report["timeouts"] = sum(c.timeouts for c in chats.values())
+    report["bot_api_calls"] = dict(sorted(tg.calls.items()))
+    report["openai"] = {"requests": ai.requests, "injected_errors": ai.injected_errors}
+    report["telegram_injected_errors"] = tg.injected_errors
+    report["bot_exit_code"] = proc.returncode
+    return report
+
+def print_report(report: Dict[str, Any]):
+    print()
+    print(f"{'kind':<32}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, s in report["latency"].items():
+        print(f"{kind:<32}{s['count']:>8}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+    print()
+    for key in ("interactive", *[k for k in report if k.startswith("broadcast_")], "memory", "openai", "bot_api_calls"):
+        if key in report:
+            print(f"{key}: {report[key]}")
+    mem = report.get("memory", {})
+    if "VmHWM" in mem:
+        print(f"peak memory: {mem['VmHWM'] / 2**20:.1f} MB")
+    print(f"timeouts: {report['timeouts']}, telegram 429 injected: {report['telegram_injected_errors']}, "
+          f"bot exit code: {report['bot_exit_code']}")
+    print(f"bot log: {report['bot_log']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50, help="пользователей, проходящих анкету и фото")
+    parser.add_argument("--subscribers", type=int, default=1000, help="дополнительных подписчиков рассылки")
+    parser.add_argument("--photos", type=int, default=2, help="фото на пользователя")
+    parser.add_argument("--think", type=float, default=0.3, help="пауза пользователя перед ответом, с")
+    parser.add_argument("--telegram-latency", type=float, default=30.0, help="задержка Bot API, мс")
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="доля 429 на отправку")
+    parser.add_argument("--openai-latency", type=float, default=1500.0, help="время ответа модели, мс")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="доля 500 от модели")
+    parser.add_argument("--checkins", default="morning,day,evening", help="слоты рассылки по порядку")
+    parser.add_argument("--broadcast-in", type=float, default=90.0, help="первая рассылка не раньше, с")
+    parser.add_argument("--slot-gap", type=int, default=2, help="минут между слотами")
+    parser.add_argument("--broadcast-window", type=float, default=120.0, help="сколько ждать доставку рассылки, с")
+    parser.add_argument("--timeout", type=float, default=60.0, help="ожидание одного ответа бота, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для процесса бота (можно повторять)")
+    parser.add_argument("--json", help="записать отчёт в файл")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
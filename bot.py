@@ -2,17 +2,24 @@
 import logging
 import json
 import base64
+import importlib
 import re
 import os
 import asyncio
-from datetime import datetime, timedelta, timezone
+import random
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
 from typing import Dict, Any, Optional, List, Tuple
 
+# отсчёт старта — до тяжёлых импортов (см. boot_stats)
+BOOT_STARTED = time.perf_counter()
+
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
-    ReplyKeyboardRemove,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
@@ -20,14 +27,41 @@ from telegram.error import Conflict
 
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
 
-from openai import OpenAI
+import httpx
+
+from aggregates import WeeklyAggregates, STATUSES, WINDOW_DAYS
+from analytics import cohort_report, format_report
+from survey_scoring import SURVEY_FORMAT, Scorer, encode_survey, score_delta
+from food_diary import food_entry, format_totals, sum_totals
+from chat_ordering import ChatOrderedProcessor
+from conversation_state import ChatStateMap, StoragePersistence
+from imaging import ImageStats, dhash, pick_photo_size, preprocess_image
+from flows import REMOVE_KEYBOARD
+from questionnaire import CHECKIN_FLOWS, SURVEY
+from food_stream import FirstContentStats, ThrottledEditor, extract_partial_fields
+from photo_cache import AnalysisCache
+from photo_queue import PhotoJobQueue
+from outbox import Outbox, BROADCAST
+from persistence import PersistenceWorker
+from metrics import BYTES_BUCKETS, MetricsServer, Registry, timed
+from profiling import SamplingProfiler
+from tracing import Tracer, span, traced
+from sharding import HashRing, ShardRouter, ShardServer, shard_path
+from scheduler import CheckinScheduler, normalize_tz, parse_tz, parse_hhmm
+from storage import create_storage
+from journal import atomic_write_text, read_json_file
+
+# время до первого апдейта: импорты -> готовность (post_init) -> первый апдейт
+boot_stats: Dict[str, Any] = {"imports_s": round(time.perf_counter() - BOOT_STARTED, 3)}
 
 # ================== НАСТРОЙКИ ==================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -40,18 +74,292 @@ if not BOT_TOKEN:
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY not found in environment variables")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-app = ApplicationBuilder().token(BOT_TOKEN).build()
+# Режим приёма апдейтов: polling (по умолчанию) или webhook со встроенным HTTP-сервером.
+# BOT_API_BASE_URL — другой адрес Bot API (локальный сервер или заглушка для тестов).
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "").rstrip("/")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # публичный адрес, без пути
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise RuntimeError("BOT_MODE must be 'polling' or 'webhook'")
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    # секрет общий для всех воркеров за балансировщиком: каждый из них регистрирует webhook
+    raise RuntimeError("WEBHOOK_URL and WEBHOOK_SECRET are required in webhook mode")
+
+# Шардирование: single — один процесс (как раньше);
+# ingress — только принимает апдейты (polling/webhook) и пересылает владельцу чата;
+# worker — обрабатывает чаты своего шарда, апдейты получает от ingress по HTTP.
+SHARD_ROLE = os.getenv("SHARD_ROLE", "single")
+SHARD_WORKERS = [u for u in os.getenv("SHARD_WORKERS", "").split(",") if u.strip()]  # адреса воркеров по номеру шарда
+SHARD_COUNT = len(SHARD_WORKERS) if SHARD_ROLE == "ingress" else int(os.getenv("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_LISTEN = os.getenv("SHARD_LISTEN", "127.0.0.1")
+SHARD_PORT = int(os.getenv("SHARD_PORT", str(8800 + SHARD_INDEX)))
+SHARD_SECRET = os.getenv("SHARD_SECRET", "")
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+
+if SHARD_ROLE not in ("single", "ingress", "worker"):
+    raise RuntimeError("SHARD_ROLE must be 'single', 'ingress' or 'worker'")
+if SHARD_ROLE != "single" and not SHARD_SECRET:
+    raise RuntimeError("SHARD_SECRET is required for ingress and worker roles")
+if SHARD_ROLE == "ingress" and not SHARD_WORKERS:
+    raise RuntimeError("SHARD_WORKERS is required for the ingress role")
+if SHARD_ROLE == "worker" and not 0 <= SHARD_INDEX < SHARD_COUNT:
+    raise RuntimeError("SHARD_INDEX must be in [0, SHARD_COUNT)")
+
+# Параллельная обработка апдейтов: разные чаты — одновременно, один чат — по порядку.
+# UPDATE_CONCURRENCY=1 — прежняя последовательная обработка.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+
+# Лимиты исходящих сообщений (Telegram: ~30 msg/s на бота, ~1 msg/s на чат)
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))
+# Рассылка по расписанию: сколько сообщений одного слота одновременно ждут очереди outbox
+# (по умолчанию — около секунды отправки); остальные чаты группы ждут своей очереди списком
+SCHEDULER_FANOUT = int(os.getenv("SCHEDULER_FANOUT", str(max(1, int(OUTBOX_GLOBAL_RATE)))))
+
+# OpenAI: общий пул HTTP-соединений, ограничение параллельных запросов и таймаут на запрос
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "10"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+# Чек-ин закрывается после стольких неподходящих ответов подряд (текст вне кнопок,
+# ответ анкеты во время чек-ина) — иначе чат застревал бы в повторах вопроса
+CHECKIN_MAX_INVALID = int(os.getenv("CHECKIN_MAX_INVALID", "2"))
+
+# Потоки для CPU-работы с фото (хеш, пережатие) — не трогаем default executor
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# Диагностика. ADMIN_IDS — user id через запятую: им доступны /profile N (сэмплирующий
+# профайлер на N секунд, дамп в формате flamegraph) и /traces (самые медленные трассы).
+# SIGUSR2 — то же без Telegram: профиль на PROFILE_SIGNAL_SECONDS и дамп трасс.
+# TRACE_SAMPLE — доля апдейтов, для которых пишутся спаны (0 — выключено).
+ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x]
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")  # относительно STORAGE_DIR
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+PROFILE_SIGNAL_SECONDS = int(os.getenv("PROFILE_SIGNAL_SECONDS", "30"))
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0"))
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "50"))
+
+# /analytics (тоже для ADMIN_IDS): сводка по всем подписчикам за период.
+# Без аргументов — последние ANALYTICS_DAYS дней; выборка идёт порциями по ANALYTICS_CHUNK чатов.
+ANALYTICS_DAYS = int(os.getenv("ANALYTICS_DAYS", "28"))
+ANALYTICS_MAX_DAYS = int(os.getenv("ANALYTICS_MAX_DAYS", "400"))
+ANALYTICS_CHUNK = int(os.getenv("ANALYTICS_CHUNK", "500"))
+
+_openai_client = None
+
+def openai_client():
+    # openai тяжёлый: импорт и клиент — при первом фото (после старта модуль прогревается в потоке)
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+
+        openai_http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=30,
+            ),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10),
+        )
+        _openai_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            http_client=openai_http,
+            max_retries=OPENAI_MAX_RETRIES,
+            timeout=OPENAI_TIMEOUT,
+        )
+    return _openai_client
+
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
 
-# ================== ФАЙЛЫ ХРАНЕНИЯ ==================
-SETTINGS_FILE = "user_settings.json"
-WEEKLY_DATA_FILE = "weekly_data.json"
+outbox = Outbox(
+    # лимит Telegram общий на бота — делим между воркерами
+    global_rate=OUTBOX_GLOBAL_RATE / (SHARD_COUNT if SHARD_ROLE == "worker" else 1),
+    chat_rate=OUTBOX_CHAT_RATE,
+    max_retries=OUTBOX_MAX_RETRIES,
+)
+builder = ApplicationBuilder().token(BOT_TOKEN).rate_limiter(outbox)
+if BOT_API_BASE_URL:
+    builder = builder.base_url(f"{BOT_API_BASE_URL}/bot").base_file_url(f"{BOT_API_BASE_URL}/file/bot")
+tracer = Tracer(TRACE_SAMPLE, TRACE_KEEP)
+profiler = SamplingProfiler(interval=PROFILE_INTERVAL_MS / 1000)
+update_processor = None
+if UPDATE_CONCURRENCY > 1 or tracer.enabled:
+    # трасса апдейта начинается в процессоре, поэтому с трассировкой он нужен и при UPDATE_CONCURRENCY=1
+    update_processor = ChatOrderedProcessor(UPDATE_CONCURRENCY, tracer)
+    builder = builder.concurrent_updates(update_processor)
+
+# ================== ХРАНИЛИЩЕ ==================
+# json — user_settings.json / weekly_data.json (+ журналы), sqlite — одна база SQLite
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+STORAGE_DIR = os.getenv("STORAGE_DIR", ".")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")
+
+if SHARD_ROLE == "worker":
+    # каждый воркер хранит только свои чаты: bot.db -> bot.shard-N.db;
+    # при смене числа шардов строки переносит `python sharding.py --from N --to M`
+    if STORAGE_BACKEND != "sqlite":
+        raise RuntimeError("SHARD_ROLE=worker requires STORAGE_BACKEND=sqlite")
+    SQLITE_PATH = shard_path(SQLITE_PATH, SHARD_INDEX)
+
+# Компактация журнала: по числу записей или по таймеру
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "5000"))
+JOURNAL_COMPACT_INTERVAL = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "300"))
+
+# Ротация истории чек-инов (JSON): в памяти последние RETENTION_HOT_DAYS дней,
+# старше — в архиве по месяцам (0 — без ротации). Окно не меньше недели отчёта + 1 день.
+RETENTION_HOT_DAYS = int(os.getenv("RETENTION_HOT_DAYS", "14"))
+if RETENTION_HOT_DAYS:
+    RETENTION_HOT_DAYS = max(RETENTION_HOT_DAYS, WINDOW_DAYS + 1)
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "1000"))
+
+# Фоновое сохранение: не чаще раза в PERSIST_INTERVAL_MS или после PERSIST_MAX_PENDING изменений
+PERSIST_INTERVAL_MS = int(os.getenv("PERSIST_INTERVAL_MS", "500"))
+PERSIST_MAX_PENDING = int(os.getenv("PERSIST_MAX_PENDING", "1000"))
+
+# Фото еды: минимальная короткая сторона PhotoSize, уменьшение и качество JPEG.
+# PHOTO_PREPROCESS_SAMPLE — доля фото, идущих через предобработку (остальные — как раньше),
+# чтобы сравнивать байты/задержки/точность двух режимов.
+PHOTO_MIN_SIDE = int(os.getenv("PHOTO_MIN_SIDE", "512"))
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "1024"))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "80"))
+PHOTO_PREPROCESS_SAMPLE = float(os.getenv("PHOTO_PREPROCESS_SAMPLE", "1.0"))
+
+# Кеш результатов анализа фото (file_unique_id + перцептивный хеш)
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "2000"))
+PHOTO_CACHE_TTL = float(os.getenv("PHOTO_CACHE_TTL", str(7 * 24 * 3600)))
+PHOTO_CACHE_MAX_DISTANCE = int(os.getenv("PHOTO_CACHE_MAX_DISTANCE", "6"))
+PHOTO_CACHE_FILE = os.getenv("PHOTO_CACHE_FILE", "photo_cache.json")  # пусто — только в памяти
+if SHARD_ROLE == "worker" and PHOTO_CACHE_FILE:
+    PHOTO_CACHE_FILE = shard_path(PHOTO_CACHE_FILE, SHARD_INDEX)
+
+# Очередь анализа фото: воркеры, общий лимит глубины и лимит на чат
+PHOTO_WORKERS = int(os.getenv("PHOTO_WORKERS", str(OPENAI_MAX_CONCURRENCY)))
+PHOTO_QUEUE_MAX_DEPTH = int(os.getenv("PHOTO_QUEUE_MAX_DEPTH", "200"))
+PHOTO_QUEUE_MAX_PER_CHAT = int(os.getenv("PHOTO_QUEUE_MAX_PER_CHAT", "10"))
+
+# Потоковый ответ модели: заглушка «Фото получено…» правится по мере прихода полей.
+# PHOTO_STREAMING_SAMPLE — доля фото в потоковом режиме (остальные — ответ целиком).
+PHOTO_STREAMING_SAMPLE = float(os.getenv("PHOTO_STREAMING_SAMPLE", "1.0"))
+PHOTO_EDIT_INTERVAL = float(os.getenv("PHOTO_EDIT_INTERVAL", "1.0"))
+
+# Состояние анкеты (ConversationHandler + user_data): как часто PTB отдаёт изменения в хранилище
+STATE_UPDATE_INTERVAL = float(os.getenv("STATE_UPDATE_INTERVAL", "1"))
+
+# Компактный индекс расписаний: при старте группы поднимаются из него целиком,
+# без чтения настроек каждого подписчика. Пусто — всегда пересобирать из хранилища.
+SCHEDULE_INDEX_FILE = os.getenv("SCHEDULE_INDEX_FILE", "schedule_index.json")
+if SHARD_ROLE == "worker" and SCHEDULE_INDEX_FILE:
+    SCHEDULE_INDEX_FILE = shard_path(SCHEDULE_INDEX_FILE, SHARD_INDEX)
+SCHEDULE_REBUILD_BATCH = int(os.getenv("SCHEDULE_REBUILD_BATCH", "500"))
+
+# Сверять скользящие счётчики недельного отчёта с полным пересчётом (для отладки)
+AGGREGATES_VERIFY = os.getenv("AGGREGATES_VERIFY", "0") == "1"
+
+# Метрики в формате Prometheus: GET http://METRICS_LISTEN:METRICS_PORT/metrics (0 — выключено).
+# Воркер шарда слушает METRICS_PORT + 1 + SHARD_INDEX, чтобы не спорить за порт с ingress.
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+if SHARD_ROLE == "worker" and METRICS_PORT:
+    METRICS_PORT += 1 + SHARD_INDEX
 
 # ================== ДАННЫЕ ==================
-user_settings: Dict[str, Any] = {}     # тут будем хранить subscribers: [chat_id...]
-weekly_data: Dict[str, Any] = {}       # {chat_id: {date: {checkin_type: {field:value}}}}
-scheduled_tasks: Dict[int, List[asyncio.Task]] = {}
-checkin_progress: Dict[int, Dict[str, Any]] = {}
+persistence = PersistenceWorker(interval_ms=PERSIST_INTERVAL_MS, max_pending=PERSIST_MAX_PENDING)
+storage = create_storage(
+    STORAGE_BACKEND,
+    persistence,
+    directory=STORAGE_DIR,
+    sqlite_path=SQLITE_PATH,
+    compact_every=JOURNAL_COMPACT_EVERY,
+    hot_days=RETENTION_HOT_DAYS,
+)
+weekly_aggregates = WeeklyAggregates(storage.get_checkins, verify=AGGREGATES_VERIFY)
+# незаконченные чек-ины и анкеты переживают рестарт; чат поднимается при первом обращении
+checkin_progress = ChatStateMap(storage, "checkin")
+state_persistence = StoragePersistence(storage, update_interval=STATE_UPDATE_INTERVAL)
+if SHARD_ROLE != "ingress":
+    builder = builder.persistence(state_persistence)
+app = builder.build()
+image_stats = ImageStats()
+photo_cache = AnalysisCache(
+    capacity=PHOTO_CACHE_SIZE,
+    ttl=PHOTO_CACHE_TTL,
+    max_distance=PHOTO_CACHE_MAX_DISTANCE,
+    path=os.path.join(STORAGE_DIR, PHOTO_CACHE_FILE) if PHOTO_CACHE_FILE else None,
+)
+if photo_cache.path:
+    persistence.register("photo_cache", photo_cache.dump, photo_cache.save)
+first_content_stats = FirstContentStats()
+photo_queue = PhotoJobQueue(
+    workers=PHOTO_WORKERS,
+    max_depth=PHOTO_QUEUE_MAX_DEPTH,
+    max_per_chat=PHOTO_QUEUE_MAX_PER_CHAT,
+)
+
+# ================== МЕТРИКИ ==================
+# В пути апдейта — только гистограммы (bisect + два сложения); размеры очередей и словарей
+# и счётчики из stats снимаются при запросе /metrics.
+metrics = Registry()
+handler_seconds = metrics.histogram("bot_handler_seconds", "Handler run time", ["handler"])
+
+def instrumented(name: str):
+    # время хендлера в гистограмму и, если апдейт трассируется, спан в его трассу
+    def decorator(fn):
+        return timed(handler_seconds, name)(traced(name)(fn))
+    return decorator
+openai_seconds = metrics.histogram("bot_openai_request_seconds", "OpenAI request time", ["mode"])
+openai_errors = metrics.counter("bot_openai_errors_total", "Failed OpenAI requests", ["error"])
+photo_seconds = metrics.histogram("bot_photo_analysis_seconds", "Photo job time from download to reply", ["result"])
+persist_seconds = metrics.histogram("bot_persistence_write_seconds", "Persistence write time", ["target"])
+persist_bytes = metrics.histogram("bot_persistence_write_bytes", "Persistence write size", ["target"], BYTES_BUCKETS)
+persist_errors = metrics.counter("bot_persistence_write_errors_total", "Failed persistence writes", ["target"])
+scheduler_lag = metrics.histogram("bot_scheduler_lag_seconds", "Slot firing delay after its due time", ["slot"])
+scheduler_fanout = metrics.histogram("bot_scheduler_fanout_seconds", "Time to send a slot to all its chats", ["slot"])
+
+def _on_persistence_write(name: str, seconds: float, written: int, ok: bool):
+    # поток PersistenceWorker — единственный, кто пишет в эти три метрики (читает /metrics — по копии)
+    persist_seconds.observe(seconds, name)
+    if ok:
+        persist_bytes.observe(written, name)
+    else:
+        persist_errors.inc(name)
+    if tracer.enabled:
+        now = time.perf_counter()
+        tracer.record("persist", [(f"write:{name}", now - seconds, now)])
+
+persistence.on_write = _on_persistence_write
+
+metrics.observe("bot_outbox_requests_total", "Outbound Bot API requests by result",
+                lambda: {(k,): v for k, v in outbox.counters.items()}, "counter", ["result"])
+metrics.observe("bot_outbox_depth", "Requests waiting in the outbox",
+                lambda: {("interactive",): outbox.stats()["depth_interactive"],
+                         ("broadcast",): outbox.stats()["depth_broadcast"]}, labelnames=["lane"])
+metrics.observe("bot_outbox_drain_rate", "Outbound sends per second (last window)", lambda: outbox.drain_rate())
+metrics.observe("bot_persistence_flushes_total", "Persistence flushes", lambda: persistence.stats["flushes"], "counter")
+metrics.observe("bot_checkins_open", "Chats with an unfinished check-in (loaded)", lambda: len(checkin_progress))
+metrics.observe("bot_scheduled_chats", "Chats with check-in schedules", lambda: len(scheduler))
+metrics.observe("bot_scheduler_firings_total", "Slot firings", lambda: scheduler.stats["firings"], "counter")
+metrics.observe("bot_scheduler_skipped_total", "Slot firings skipped as too late",
+                lambda: scheduler.stats["skipped"], "counter")
+metrics.observe("bot_photo_queue", "Photo jobs by state",
+                lambda: {("queued",): photo_queue.queued, ("running",): photo_queue.running}, labelnames=["state"])
+metrics.observe("bot_photo_cache_entries", "Cached photo analyses", lambda: len(photo_cache))
+metrics.observe("bot_weekly_aggregates_chats", "Chats with rolling weekly counters", lambda: len(weekly_aggregates))
+metrics.observe("bot_updates", "Updates by state (ordered processor)",
+                lambda: {("running",): update_processor.running, ("waiting",): update_processor.waiting}
+                if update_processor is not None else {}, labelnames=["state"])
+metrics_server = MetricsServer(metrics, METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None
 
 # ================== СОСТОЯНИЯ ==================
 START_MENU, QUESTION_FLOW, FINAL_MENU_STATE = range(3)
@@ -63,73 +371,6 @@ START_KEYBOARD = ReplyKeyboardMarkup(
     one_time_keyboard=False,
 )
 
-YES_NO = ReplyKeyboardMarkup([["да", "нет"]], resize_keyboard=True, one_time_keyboard=True)
-SCALE_0_5 = ReplyKeyboardMarkup([[str(i) for i in range(0, 6)]], resize_keyboard=True, one_time_keyboard=True)
-
-STOOL_FREQ = ReplyKeyboardMarkup(
-    [
-        ["2–3 раза в сутки", "1 раз в сутки"],
-        ["1 раз в 1–2 дня", "1 раз в 2–3 дня", "1 раз в 3–5 дней"],
-    ],
-    resize_keyboard=True,
-    one_time_keyboard=True,
-)
-
-STOOL_TYPE = ReplyKeyboardMarkup(
-    [
-        ["оформленный, нормальный"],
-        ["твёрдый", "жидкий"],
-        ["иногда твёрдый, иногда жидкий", "чередуется"],
-    ],
-    resize_keyboard=True,
-    one_time_keyboard=True,
-)
-
-CYCLE = ReplyKeyboardMarkup(
-    [["я мужчина", "я женщина, цикла нет"], ["регулярный", "нерегулярный"]],
-    resize_keyboard=True,
-    one_time_keyboard=True,
-)
-
-APPETITE = ReplyKeyboardMarkup(
-    [["нормальный", "повышенный", "пониженный"]],
-    resize_keyboard=True,
-    one_time_keyboard=True,
-)
-
-ACTIVITY = ReplyKeyboardMarkup(
-    [["нет", "1–2 раза в неделю", "3 и более раз в неделю"]],
-    resize_keyboard=True,
-    one_time_keyboard=True,
-)
-
-CHECKIN_DAY_RESULT = ReplyKeyboardMarkup(
-    [["Отлично", "Нормально", "Плохо"]],
-    resize_keyboard=True,
-    one_time_keyboard=True,
-)
-
-CHECKIN_STATUS = ReplyKeyboardMarkup(
-    [["Хорошо", "Нормально", "Плохо"]],
-    resize_keyboard=True,
-    one_time_keyboard=True,
-)
-
-MORNING_CHECKIN_QUESTIONS = [
-    ("sleep_quality", "🌅 Доброе утро! Быстрый чек-ин.\n\nКак вы спали?", CHECKIN_STATUS),
-    ("energy_level", "⚡ Энергия сейчас?", CHECKIN_STATUS),
-]
-
-DAY_CHECKIN_QUESTIONS = [
-    ("wellbeing", "🏙 Дневной чек-ин.\n\nКак самочувствие сейчас?", CHECKIN_STATUS),
-    ("energy_level", "⚡ Энергия сейчас?", CHECKIN_STATUS),
-]
-
-EVENING_CHECKIN_QUESTIONS = [
-    ("day_result", "🌙 Вечерний итог дня.\n\nКак прошёл день?", CHECKIN_DAY_RESULT),
-    ("sleep_plan", "😴 Во сколько планируете лечь спать?", None),
-]
-
 FINAL_KEYBOARD = ReplyKeyboardMarkup(
     [
         ["🔔 Подписаться на уведомления"],
@@ -145,95 +386,35 @@ AFTER_SUBSCRIBE_KEYBOARD = ReplyKeyboardMarkup(
     one_time_keyboard=True,
 )
 
+# кнопки анкеты и меню: нажатие во время чек-ина закрывает чек-ин и уходит в анкету
+MENU_TEXTS = ["Начать анкетирование", "🔔 Подписаться на уведомления", "Связь с командой Екатерины 🌿"]
+
 CONTACT_URL = "https://t.me/doc_kazachkova_team"
 CONTACT_INLINE_KEYBOARD = InlineKeyboardMarkup(
     [[InlineKeyboardButton("Связь с командой Екатерины 🌿", url=CONTACT_URL)]]
 )
 
-# ================== АНКЕТА ==================
-QUESTIONS = [
-    ("height_cm", "Ваш рост (см):", None),
-    ("weight_kg", "Ваш вес (кг):", None),
-    ("chest_cm", "Окружность груди (см):", None),
-    ("waist_cm", "Окружность талии (см):", None),
-    ("hips_cm", "Окружность бёдер (см):", None),
-    ("stool_frequency", "Как часто у вас бывает стул?", "stool_freq"),
-    ("stool_type", "Какой стул бывает чаще всего?", "stool_type"),
-    ("cycle_status", "Менструальный цикл?", "cycle"),
-    ("energy_level", "Оцените уровень энергии (0–5, где 0-Низкая 5-Все супер):", "scale"),
-    ("stress_level", "Оцените уровень стресса (0–5, где 0-Много стресса 5-Все супер):", "scale"),
-    ("sleep_quality", "Оцените качество сна (0–5, где 0-Плохо сплю 5-Все супер):", "scale"),
-    ("focus_issues", "Снижение концентрации внимания?", "yes_no"),
-    ("irritability_day", "Дневная раздражительность?", "yes_no"),
-    ("sleepiness_day", "Дневная сонливость?", "yes_no"),
-    ("appetite_level", "Какой аппетит вам больше подходит?", "appetite"),
-    ("sweet_craving", "Есть ли тяга к сладкому?", "yes_no"),
-    ("fat_craving", "Есть ли тяга к жирному?", "yes_no"),
-    ("palpitations", "Одышка или учащённое сердцебиение?", "yes_no"),
-    ("cold_hands_feet", "Зябкость рук и ног?", "yes_no"),
-    ("skin_itch", "Кожный зуд?", "yes_no"),
-    ("blue_sclera", "Голубоватый оттенок склер?", "yes_no"),
-    ("headache", "Беспокоит ли вас головная боль?", "yes_no"),
-    ("oily_skin", "Жирность кожи лица?", "yes_no"),
-    ("dry_skin", "Сухость кожи лица?", "yes_no"),
-    ("low_libido", "Сниженное либидо?", "yes_no"),
-    ("vaginal_itch", "Вагинальный зуд (для женщин)?", "yes_no"),
-    ("joint_pain", "Боли в суставах?", "yes_no"),
-    ("abdominal_pain", "Боли или спазмы в животе?", "yes_no"),
-    ("bloating", "Повышенное газообразование?", "yes_no"),
-    ("hair_loss", "Выпадение волос?", "yes_no"),
-    ("dry_mouth", "Сухость во рту?", "yes_no"),
-    ("steps_daily", "Сколько шагов в среднем в день?", None),
-    ("activity_level", "Есть ли дополнительная физическая активность?", "activity"),
-]
-
-# ================== ХРАНЕНИЕ (settings + weekly_data) ==================
-def _safe_json_load(path: str) -> dict:
-    try:
-        if not os.path.exists(path):
-            return {}
-        with open(path, "r", encoding="utf-8") as f:
-            raw = f.read().strip()
-            return json.loads(raw) if raw else {}
-    except Exception:
-        logging.exception("Failed to load %s", path)
-        return {}
-
-def _safe_json_save(path: str, data: dict) -> None:
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception:
-        logging.exception("Failed to save %s", path)
-
-def load_user_settings():
-    global user_settings
-    user_settings = _safe_json_load(SETTINGS_FILE)
-    if "subscribers" not in user_settings:
-        user_settings["subscribers"] = []
-
-def save_user_settings():
-    _safe_json_save(SETTINGS_FILE, user_settings)
+# ================== ХРАНЕНИЕ ==================
+async def _journal_compaction_loop():
+    while True:
+        await asyncio.sleep(JOURNAL_COMPACT_INTERVAL)
+        storage.compact()
 
-def load_weekly_data():
-    global weekly_data
-    weekly_data = _safe_json_load(WEEKLY_DATA_FILE)
+async def _aggregates_sweep_loop():
+    # скользящие окна чатов, переставших отвечать, не копятся в памяти
+    while True:
+        await asyncio.sleep(3600)
+        dropped = weekly_aggregates.sweep(datetime.now(timezone.utc).date())
+        if dropped:
+            logging.info("Weekly aggregates: dropped %d idle chats", dropped)
 
-def save_weekly_data():
-    _safe_json_save(WEEKLY_DATA_FILE, weekly_data)
+async def _retention_loop():
+    # порциями, чтобы не занимать event loop; при отсутствии работы — редкая проверка
+    while True:
+        more = storage.roll(RETENTION_BATCH)
+        await asyncio.sleep(0.05 if more else 60)
 
 # ================== УТИЛИТЫ ==================
-def get_keyboard(q_type):
-    return {
-        "yes_no": YES_NO,
-        "scale": SCALE_0_5,
-        "stool_freq": STOOL_FREQ,
-        "stool_type": STOOL_TYPE,
-        "cycle": CYCLE,
-        "appetite": APPETITE,
-        "activity": ACTIVITY,
-    }.get(q_type, ReplyKeyboardRemove())
-
 def calculate_bmi(height_cm, weight_kg):
     try:
         h = float(height_cm) / 100
@@ -242,70 +423,36 @@ def calculate_bmi(height_cm, weight_kg):
     except Exception:
         return None
 
+def get_chat_settings(chat_id: int) -> Dict[str, Any]:
+    return storage.get_chat_settings(chat_id)
+
 def get_user_tz(chat_id: int):
-    # фиксируем МСК: UTC+3
-    return timezone(timedelta(hours=3))
+    # по умолчанию МСК: UTC+3, можно переопределить через /timezone
+    return parse_tz(get_chat_settings(chat_id).get("tz"))
 
 def now_in_tz(tz: timezone) -> datetime:
     return datetime.now(tz=tz)
 
-def next_run_dt(tz: timezone, hour: int, minute: int) -> datetime:
-    n = now_in_tz(tz)
-    run = n.replace(hour=hour, minute=minute, second=0, microsecond=0)
-    if run <= n:
-        run += timedelta(days=1)
-    return run
-
-def next_run_weekly_dt(tz: timezone, weekday: int, hour: int, minute: int) -> datetime:
-    """
-    weekday: 0=Mon ... 6=Sun
-    """
-    n = now_in_tz(tz)
-    run = n.replace(hour=hour, minute=minute, second=0, microsecond=0)
-    days_ahead = (weekday - n.weekday()) % 7
-    run = run + timedelta(days=days_ahead)
-    if run <= n:
-        run += timedelta(days=7)
-    return run
-
 # ================== ЧЕК-ИНЫ ==================
-def _get_checkin_questions(checkin_type: str):
-    if checkin_type == "morning":
-        return MORNING_CHECKIN_QUESTIONS
-    if checkin_type == "day":
-        return DAY_CHECKIN_QUESTIONS
-    if checkin_type == "evening":
-        return EVENING_CHECKIN_QUESTIONS
-    return []
-
-def _get_checkin_completion_message(checkin_type: str) -> str:
-    if checkin_type == "morning":
-        return "Ответы записаны ✅\n\n💧 Напоминаю выпить воды."
-    if checkin_type == "day":
-        return "Ответы записаны ✅\n\n🌤 Желаю хорошего дня."
-    if checkin_type == "evening":
-        return "Ответы записаны ✅\n\n😴 Напоминаю лечь спать пораньше."
-    return "Ответы записаны ✅"
-
 def _record_checkin_answer(chat_id: int, checkin_type: str, field: str, value: str):
     tz = get_user_tz(chat_id)
     date_key = now_in_tz(tz).date().isoformat()
 
-    chat_key = str(chat_id)
-    daily = weekly_data.setdefault(chat_key, {}).setdefault(date_key, {})
-    checkin = daily.setdefault(checkin_type, {})
-    checkin[field] = value
-
-    save_weekly_data()
+    previous = storage.record_checkin_answer(chat_id, date_key, checkin_type, field, value)
+    weekly_aggregates.on_answer(chat_id, date_key, checkin_type, field, previous, value)
 
 async def start_checkin(bot, chat_id: int, checkin_type: str):
-    questions = _get_checkin_questions(checkin_type)
-    if not questions:
+    flow = CHECKIN_FLOWS.get(checkin_type)
+    if flow is None:
         return
+    step = flow.first
+    # чек-ины рассылаются по расписанию — низкий приоритет в outbox
+    await bot.send_message(chat_id, step.text, reply_markup=step.reply_markup, rate_limit_args=BROADCAST)
+    # состояние — только после доставки: чат, который вопрос не получил (заблокировал бота),
+    # не должен застревать в чек-ине
     checkin_progress[chat_id] = {"type": checkin_type, "step": 0}
-    _, text, markup = questions[0]
-    await bot.send_message(chat_id, text, reply_markup=markup)
 
+@instrumented("handle_checkin_response")
 async def handle_checkin_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     progress = checkin_progress.get(chat_id)
@@ -313,34 +460,52 @@ async def handle_checkin_response(update: Update, context: ContextTypes.DEFAULT_
         return
 
     checkin_type = progress["type"]
-    questions = _get_checkin_questions(checkin_type)
-    step = progress["step"]
-
-    if step >= len(questions):
+    flow = CHECKIN_FLOWS.get(checkin_type)
+    step = flow.step(progress["step"]) if flow else None
+    if step is None:
         checkin_progress.pop(chat_id, None)
         return
 
-    field, _, _ = questions[step]
-    answer_text = (update.message.text or "").strip()
-    _record_checkin_answer(chat_id, checkin_type, field, answer_text)
+    value = step.parse((update.message.text or "").strip())
+    if value is None:
+        misses = progress.get("misses", 0) + 1
+        if misses >= CHECKIN_MAX_INVALID:
+            # не отвечают на чек-ин, а пишут своё — закрываем, следующий придёт по расписанию
+            checkin_progress.pop(chat_id, None)
+            await update.message.reply_text(
+                "Закрыл чек-ин без ответа — следующий пришлю по расписанию 💚", reply_markup=REMOVE_KEYBOARD
+            )
+            return
+        # ответ не подошёл — задаём тот же вопрос ещё раз
+        progress["misses"] = misses
+        checkin_progress.save(chat_id)
+        await update.message.reply_text(f"{step.error}\n\n{step.text}", reply_markup=step.reply_markup)
+        return
+    progress.pop("misses", None)
+    _record_checkin_answer(chat_id, checkin_type, step.field, value)
 
-    step += 1
-    if step >= len(questions):
+    if step.next is None:
         checkin_progress.pop(chat_id, None)
-        await update.message.reply_text(
-            _get_checkin_completion_message(checkin_type),
-            reply_markup=ReplyKeyboardRemove(),
-        )
+        text = flow.done_text
+        totals = food_totals(chat_id) if checkin_type == "evening" else None
+        if totals:
+            text += "\n\n📒 Питание за день\n" + format_totals(totals, calorie_target(chat_id))
+        await update.message.reply_text(text, reply_markup=REMOVE_KEYBOARD)
         return
 
-    progress["step"] = step
-    _, next_text, next_markup = questions[step]
-    await update.message.reply_text(next_text, reply_markup=next_markup)
+    progress["step"] = step.next
+    checkin_progress.save(chat_id)
+    next_step = flow.steps[step.next]
+    await update.message.reply_text(next_step.text, reply_markup=next_step.reply_markup)
 
 class CheckinActiveFilter(filters.MessageFilter):
     def filter(self, message):
         return bool(message and message.chat_id in checkin_progress)
 
+async def cancel_checkin_for_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # кнопка анкеты/меню во время чек-ина: чек-ин закрываем, сообщение обработает анкета (группа 0)
+    checkin_progress.pop(update.effective_chat.id, None)
+
 # ================== ЕЖЕНЕДЕЛЬНЫЙ ОТЧЁТ ==================
 def _status_to_score(v: str) -> Optional[int]:
     # Для усреднения, если захочешь
@@ -351,55 +516,25 @@ def build_weekly_report_text(chat_id: int) -> str:
     tz = get_user_tz(chat_id)
     today = now_in_tz(tz).date()
 
-    chat_key = str(chat_id)
-    data_by_date = weekly_data.get(chat_key, {})
+    # скользящие счётчики: без пересчёта истории (см. aggregates.py)
+    c = weekly_aggregates.counts(chat_id, today)
+    days_with_morning, days_with_day, days_with_evening = c[0], c[1], c[2]
 
-    last_7 = []
-    for i in range(7):
-        d = (today - timedelta(days=i)).isoformat()
-        if d in data_by_date:
-            last_7.append((d, data_by_date[d]))
-
-    if not last_7:
+    if not (days_with_morning or days_with_day or days_with_evening):
         return (
             "📊 Недельный отчёт\n\n"
             "За последние 7 дней у меня нет ваших ответов в чек-инах.\n"
             "Подсказка: отвечайте на утренние/дневные/вечерние вопросы — и я соберу статистику 💚"
         )
 
-    sleep_counts = {"Хорошо": 0, "Нормально": 0, "Плохо": 0}
-    morning_energy_counts = {"Хорошо": 0, "Нормально": 0, "Плохо": 0}
-    day_wellbeing_counts = {"Хорошо": 0, "Нормально": 0, "Плохо": 0}
-    day_energy_counts = {"Хорошо": 0, "Нормально": 0, "Плохо": 0}
-
-    days_with_morning = 0
-    days_with_day = 0
-    days_with_evening = 0
-
-    for d, payload in last_7:
-        m = payload.get("morning", {})
-        if m:
-            days_with_morning += 1
-            sq = m.get("sleep_quality")
-            en = m.get("energy_level")
-            if sq in sleep_counts:
-                sleep_counts[sq] += 1
-            if en in morning_energy_counts:
-                morning_energy_counts[en] += 1
-
-        day = payload.get("day", {})
-        if day:
-            days_with_day += 1
-            wb = day.get("wellbeing")
-            en = day.get("energy_level")
-            if wb in day_wellbeing_counts:
-                day_wellbeing_counts[wb] += 1
-            if en in day_energy_counts:
-                day_energy_counts[en] += 1
-
-        e = payload.get("evening", {})
-        if e:
-            days_with_evening += 1
+    sleep_counts = dict(zip(STATUSES, c[3:6]))
+    morning_energy_counts = dict(zip(STATUSES, c[6:9]))
+    day_wellbeing_counts = dict(zip(STATUSES, c[9:12]))
+    day_energy_counts = dict(zip(STATUSES, c[12:15]))
+    food = food_totals(chat_id, WINDOW_DAYS)
+    food_text = ""
+    if food:
+        food_text = f"🍽 Питание (по фото):\n{format_totals(food, calorie_target(chat_id))}\n\n"
 
     return (
         "📊 Недельный отчёт (последние 7 дней)\n\n"
@@ -422,6 +557,7 @@ def build_weekly_report_text(chat_id: int) -> str:
         f"• Хорошо: {day_energy_counts['Хорошо']}\n"
         f"• Нормально: {day_energy_counts['Нормально']}\n"
         f"• Плохо: {day_energy_counts['Плохо']}\n\n"
+        f"{food_text}"
         "💡 Мини-вывод:\n"
         "Если часто «Плохо» по сну/энергии — начинаем с режима сна + воды + лёгкой активности 💚"
     )
@@ -429,58 +565,127 @@ def build_weekly_report_text(chat_id: int) -> str:
 async def send_weekly_report(bot, chat_id: int):
     try:
         text = build_weekly_report_text(chat_id)
-        await bot.send_message(chat_id, text)
+        await bot.send_message(chat_id, text, rate_limit_args=BROADCAST)
     except Exception:
         logging.exception("Failed to send weekly report chat_id=%s", chat_id)
 
-async def _weekly_loop(bot, chat_id: int, tz: timezone, weekday: int, hour: int, minute: int):
-    while True:
-        run = next_run_weekly_dt(tz, weekday, hour, minute)
-        delay = (run - now_in_tz(tz)).total_seconds()
-        if delay > 0:
-            await asyncio.sleep(delay)
-        await send_weekly_report(bot, chat_id)
-        await asyncio.sleep(1)
-
 # ================== ПЛАНИРОВЩИК УВЕДОМЛЕНИЙ (без JobQueue) ==================
-async def _daily_loop(bot, chat_id, tz: timezone, hour: int, minute: int, payload):
-    while True:
-        run = next_run_dt(tz, hour, minute)
-        delay = (run - now_in_tz(tz)).total_seconds()
-        if delay > 0:
-            await asyncio.sleep(delay)
+# Одна задача на весь бот: куча по времени срабатывания, чаты с одинаковым
+# расписанием объединены в группы (см. scheduler.py).
+async def _fire_slot(slot: str, chat_ids: List[int], lag: float):
+    bot = app.bot
+    scheduler_lag.observe(lag, slot)
+    started = time.perf_counter()
+
+    async def _one(chat_id: int):
         try:
-            if isinstance(payload, tuple) and payload[0] == "checkin":
-                await start_checkin(bot, chat_id, payload[1])
+            if slot == "weekly":
+                await send_weekly_report(bot, chat_id)
             else:
-                await bot.send_message(chat_id, str(payload))
+                await start_checkin(bot, chat_id, slot)
         except Exception:
             logging.exception("Не удалось отправить scheduled message chat_id=%s", chat_id)
-        await asyncio.sleep(1)
 
-def schedule_all_for_chat(application, chat_id: int):
-    # отменяем старые задачи
-    old = scheduled_tasks.get(chat_id, [])
-    for t in old:
-        t.cancel()
+    # не по корутине на подписчика: SCHEDULER_FANOUT исполнителей разбирают общий список
+    pending = iter(chat_ids)
 
-    tz = get_user_tz(chat_id)
+    async def _worker():
+        for chat_id in pending:
+            await _one(chat_id)
 
-    tasks = [
-        application.create_task(_daily_loop(application.bot, chat_id, tz, 9, 30, ("checkin", "morning"))),
-        application.create_task(_daily_loop(application.bot, chat_id, tz, 15, 0, ("checkin", "day"))),
-        application.create_task(_daily_loop(application.bot, chat_id, tz, 20, 0, ("checkin", "evening"))),
+    await asyncio.gather(*(_worker() for _ in range(min(SCHEDULER_FANOUT, len(chat_ids)))))
+    scheduler_fanout.observe(time.perf_counter() - started, slot)
 
-        # ✅ еженедельный отчет: воскресенье (6) 21:00 МСК
-        application.create_task(_weekly_loop(application.bot, chat_id, tz, 6, 21, 0)),
-    ]
-    scheduled_tasks[chat_id] = tasks
+scheduler = CheckinScheduler(_fire_slot)
+
+shard_ring = HashRing(SHARD_COUNT, SHARD_VNODES)
+
+def owns_chat(chat_id: int) -> bool:
+    return SHARD_ROLE != "worker" or shard_ring.owner(chat_id) == SHARD_INDEX
+
+schedule_index_path = os.path.join(STORAGE_DIR, SCHEDULE_INDEX_FILE) if SCHEDULE_INDEX_FILE else None
+# индекс воркера собран под своё кольцо: после `sharding.py --from N --to M` он не подходит
+schedule_index_meta = (
+    {"shards": SHARD_COUNT, "shard": SHARD_INDEX, "vnodes": SHARD_VNODES} if SHARD_ROLE == "worker" else {}
+)
+if schedule_index_path:
+    persistence.register(
+        "schedule_index",
+        lambda: json.dumps(scheduler.index(schedule_index_meta), separators=(",", ":")),
+        lambda text: atomic_write_text(schedule_index_path, text),
+    )
+
+def schedule_all_for_chat(chat_id: int):
+    cs = get_chat_settings(chat_id)
+    scheduler.schedule_chat(chat_id, tz=cs.get("tz"), times=cs.get("times"))
+    if schedule_index_path:
+        persistence.mark_dirty("schedule_index")
+
+def load_schedule_index() -> Optional[int]:
+    # None — индекса нет или он не читается: нужна пересборка из хранилища
+    if not schedule_index_path or not os.path.exists(schedule_index_path):
+        return None
+    try:
+        # чужие чаты отбрасываются и при совпавшем кольце — индекс мог пережить ручной перенос
+        return scheduler.load_index(read_json_file(schedule_index_path), schedule_index_meta, owns_chat)
+    except Exception:
+        logging.exception("Failed to load schedule index %s", schedule_index_path)
+        return None
+
+async def rebuild_schedules():
+    # первый запуск или битый индекс: по одному чату, отдавая управление event loop
+    started = time.perf_counter()
+    subs = [c for c in storage.list_subscribers() if owns_chat(c)]
+    for i, chat_id in enumerate(subs, 1):
+        schedule_all_for_chat(chat_id)
+        if i % SCHEDULE_REBUILD_BATCH == 0:
+            await asyncio.sleep(0)
+    logging.info("Rebuilt schedules for %d subscribers in %.3fs", len(subs), time.perf_counter() - started)
+
+def _update_chat_settings(chat_id: int, **changes):
+    storage.update_chat_settings(chat_id, **changes)
+    if scheduler.is_scheduled(chat_id):
+        schedule_all_for_chat(chat_id)
+
+# ================== /timezone и /time ==================
+@instrumented("timezone_command")
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    tz = normalize_tz(context.args[0]) if context.args else None
+    if not tz:
+        current = get_chat_settings(chat_id).get("tz") or "+03:00"
+        await update.message.reply_text(
+            f"Текущий часовой пояс: {current}\n\n"
+            "Чтобы изменить, отправьте, например:\n/timezone +5\n/timezone Europe/Moscow"
+        )
+        return
+    _update_chat_settings(chat_id, tz=tz)
+    await update.message.reply_text(f"Часовой пояс сохранён: {tz} ✅")
+
+@instrumented("time_command")
+async def time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    args = context.args or []
+    slot = args[0] if args else ""
+    hhmm = parse_hhmm(args[1]) if len(args) > 1 else None
+    if slot not in ("morning", "day", "evening") or not hhmm:
+        await update.message.reply_text(
+            "Время чек-ина можно изменить так:\n"
+            "/time morning 08:00\n/time day 14:00\n/time evening 21:30"
+        )
+        return
+    times = dict(get_chat_settings(chat_id).get("times", {}))
+    times[slot] = f"{hhmm[0]:02d}:{hhmm[1]:02d}"
+    _update_chat_settings(chat_id, times=times)
+    await update.message.reply_text(f"Время чек-ина «{slot}» изменено на {times[slot]} ✅")
 
 # ================== /notify и /start notify ==================
+@instrumented("notify_entry")
 async def notify_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔔 Включить уведомления?", reply_markup=FINAL_KEYBOARD)
     return FINAL_MENU_STATE
 
+@instrumented("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     payload = (context.args[0] if context.args else "").strip()
 
@@ -517,29 +722,69 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return START_MENU
 
 # ================== АНКЕТИРОВАНИЕ ==================
+@instrumented("start_survey")
 async def start_survey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     context.user_data["q_index"] = 0
-    _, text, q_type = QUESTIONS[0]
-    await update.message.reply_text(text, reply_markup=get_keyboard(q_type))
+    step = SURVEY.first
+    await update.message.reply_text(step.text, reply_markup=step.reply_markup)
     return QUESTION_FLOW
 
+@instrumented("handle_answer")
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q_index = context.user_data.get("q_index", 0)
-    key, _, _ = QUESTIONS[q_index]
-    context.user_data[key] = (update.message.text or "").strip()
-
-    q_index += 1
-    if q_index >= len(QUESTIONS):
+    step = SURVEY.step(context.user_data.get("q_index", 0)) or SURVEY.first
+    value = step.parse((update.message.text or "").strip())
+    if value is None:
+        await update.message.reply_text(f"{step.error}\n\n{step.text}", reply_markup=step.reply_markup)
+        return QUESTION_FLOW
+    context.user_data[step.field] = value
+
+    if step.next is None:
         return await summary(update, context)
 
-    context.user_data["q_index"] = q_index
-    _, text, q_type = QUESTIONS[q_index]
-    await update.message.reply_text(text, reply_markup=get_keyboard(q_type))
+    context.user_data["q_index"] = step.next
+    next_step = SURVEY.steps[step.next]
+    await update.message.reply_text(next_step.text, reply_markup=next_step.reply_markup)
     return QUESTION_FLOW
 
 # ================== ФОТО (OpenAI) ==================
-async def analyze_food_image(image_bytes: bytes) -> dict:
+def _response_text(response) -> str:
+    text = (getattr(response, "output_text", None) or "").strip()
+    if not text:
+        try:
+            parts = []
+            for item in getattr(response, "output", []) or []:
+                if getattr(item, "type", None) == "message":
+                    for c in getattr(item, "content", []) or []:
+                        if getattr(c, "type", None) in ("output_text", "text"):
+                            parts.append(getattr(c, "text", "") or "")
+            text = "\n".join([p for p in parts if p]).strip()
+        except Exception:
+            text = ""
+    return text
+
+async def _stream_response_text(request: Dict[str, Any], on_partial) -> str:
+    # читаем ответ по кускам и отдаём on_partial поля, как только они дописаны
+    chunks: List[str] = []
+    seen = 0
+    final = None
+    stream = await openai_client().responses.create(stream=True, **request)
+    async for event in stream:
+        etype = getattr(event, "type", "")
+        if etype == "response.output_text.delta":
+            chunks.append(getattr(event, "delta", "") or "")
+            fields = extract_partial_fields("".join(chunks))
+            if len(fields) > seen:
+                seen = len(fields)
+                await on_partial(fields)
+        elif etype == "response.completed":
+            final = getattr(event, "response", None)
+    text = "".join(chunks).strip()
+    if not text and final is not None:
+        text = _response_text(final)
+    return text
+
+async def analyze_food_image(image_bytes: bytes, on_partial=None) -> dict:
     encoded = base64.b64encode(image_bytes).decode("utf-8")
 
     prompt = (
@@ -556,34 +801,34 @@ async def analyze_food_image(image_bytes: bytes) -> dict:
         "Если есть сомнения — укажи приблизительные значения."
     )
 
-    def _call():
-        return client.responses.create(
-            model="gpt-4.1-mini",
-            input=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": prompt},
-                        {"type": "input_image", "image_url": f"data:image/jpeg;base64,{encoded}"},
-                    ],
-                }
-            ],
-        )
-
-    response = await asyncio.to_thread(_call)
+    request = dict(
+        model="gpt-4.1-mini",
+        input=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": prompt},
+                    {"type": "input_image", "image_url": f"data:image/jpeg;base64,{encoded}"},
+                ],
+            }
+        ],
+        timeout=OPENAI_TIMEOUT,
+    )
 
-    text = (getattr(response, "output_text", None) or "").strip()
-    if not text:
+    async with openai_semaphore:
+        mode = "buffered" if on_partial is None else "streaming"
+        started = time.perf_counter()
         try:
-            parts = []
-            for item in getattr(response, "output", []) or []:
-                if getattr(item, "type", None) == "message":
-                    for c in getattr(item, "content", []) or []:
-                        if getattr(c, "type", None) in ("output_text", "text"):
-                            parts.append(getattr(c, "text", "") or "")
-            text = "\n".join([p for p in parts if p]).strip()
-        except Exception:
-            text = ""
+            with span("openai", mode=mode):
+                if on_partial is None:
+                    text = _response_text(await openai_client().responses.create(**request))
+                else:
+                    text = await _stream_response_text(request, on_partial)
+        except Exception as e:
+            openai_errors.inc(type(e).__name__)
+            raise
+        finally:
+            openai_seconds.observe(time.perf_counter() - started, mode)
 
     if not text:
         raise ValueError("Empty model output")
@@ -596,36 +841,187 @@ async def analyze_food_image(image_bytes: bytes) -> dict:
             return json.loads(m.group(0))
         raise
 
+def _format_food_reply(result: dict, partial: bool = False) -> str:
+    # partial — ответ модели ещё приходит: недостающие поля показываем как «…»
+    missing = "…" if partial else "—"
+    return (
+        f"🍽 Блюдо: {result.get('dish', missing)}\n\n"
+        f"🔥 Калории: ~{result.get('calories', missing)} ккал\n"
+        f"🥩 Белки: ~{result.get('protein', missing)} г\n"
+        f"🧈 Жиры: ~{result.get('fat', missing)} г\n"
+        f"🍞 Углеводы: ~{result.get('carbs', missing)} г\n\n"
+        + (
+            "⏳ Уточняю…"
+            if partial else
+            f"💬 {result.get('comment','')}\n\n"
+            "⚠️ Значения приблизительные и основаны на визуальной оценке."
+        )
+    )
+
+def _prepare_photo(raw_bytes: bytes, processed: bool) -> Tuple[bytes, Optional[int]]:
+    # выполняется в потоке: хеш для кеша + (опционально) пережатие
+    phash = dhash(raw_bytes)
+    if not processed:
+        return raw_bytes, phash
+    image_bytes, _ = preprocess_image(raw_bytes, PHOTO_MAX_SIDE, PHOTO_JPEG_QUALITY)
+    return image_bytes, phash
+
+@instrumented("photo_handler")
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    placeholder = None
     try:
-        await update.message.reply_text("📸 Фото получено. Считаю калории и БЖУ…")
-
         if not update.message.photo:
             await update.message.reply_text("Не вижу фото 😕 Попробуйте отправить изображение еще раз.")
             return
 
-        photo = update.message.photo[-1]
-        file = await photo.get_file()
-        image_bytes = await file.download_as_bytearray()
-        result = await analyze_food_image(bytes(image_bytes))
-
-        reply = (
-            f"🍽 Блюдо: {result.get('dish','—')}\n\n"
-            f"🔥 Калории: ~{result.get('calories','—')} ккал\n"
-            f"🥩 Белки: ~{result.get('protein','—')} г\n"
-            f"🧈 Жиры: ~{result.get('fat','—')} г\n"
-            f"🍞 Углеводы: ~{result.get('carbs','—')} г\n\n"
-            f"💬 {result.get('comment','')}\n\n"
-            "⚠️ Значения приблизительные и основаны на визуальной оценке."
+        # то же фото, присланное повторно, — ответ без скачивания и без очереди.
+        # В дневник повтор не пишется, если этот file_unique_id уже есть за сегодня (см. _log_food)
+        uid = update.message.photo[-1].file_unique_id
+        result = photo_cache.get_by_uid(uid)
+        if result is not None:
+            await update.message.reply_text(_format_food_reply(result) + _log_food(update.effective_chat.id, result, uid))
+            return
+
+        # анализ — в очереди с воркерами; хендлер сразу освобождается.
+        # Заглушку потом правим на результат (в потоковом режиме — по мере прихода полей).
+        placeholder = await update.message.reply_text("📸 Фото получено. Считаю калории и БЖУ…")
+        if not photo_queue.submit(update.effective_chat.id, lambda: _process_photo(update, uid, placeholder)):
+            # очередь полна: заглушка «Считаю калории…» заменяется просьбой повторить,
+            # а если её не удалось править — просьба уходит новым сообщением
+            await _show_in_placeholder(
+                update, placeholder,
+                "Сейчас много фото на анализе ⏳\n"
+                "Пожалуйста, отправьте это фото ещё раз через пару минут.",
+            )
+
+    except Exception:
+        logging.exception("Ошибка приёма фото")
+        # заглушка «Считаю калории…» не должна остаться висеть
+        if placeholder is not None:
+            await _show_in_placeholder(update, placeholder, PHOTO_ERROR_TEXT)
+        else:
+            await update.message.reply_text(PHOTO_ERROR_TEXT)
+
+PHOTO_ERROR_TEXT = (
+    "Не получилось распознать блюдо 😕\n"
+    "Попробуйте сделать фото ближе и при хорошем освещении."
+)
+
+async def _show_in_placeholder(update: Update, placeholder, text: str):
+    # ответ — в заглушку «Фото получено…»; новым сообщением, только если её не удалось править
+    try:
+        await placeholder.edit_text(text)
+    except Exception:
+        logging.debug("placeholder edit failed", exc_info=True)
+        await update.message.reply_text(text)
+
+async def _process_photo(update: Update, uid: str, placeholder):
+    job_started = time.perf_counter()
+    # фото разбирается в воркере очереди, вне апдейта, — у задачи своя трасса
+    trace = tracer.begin("photo", update.effective_chat.id, update.update_id)
+    editor = None
+    try:
+        processed = random.random() < PHOTO_PREPROCESS_SAMPLE
+        if processed:
+            photo = pick_photo_size(update.message.photo, PHOTO_MIN_SIDE)
+        else:
+            photo = update.message.photo[-1]
+
+        t0 = time.perf_counter()
+        with span("download"):
+            file = await photo.get_file()
+            raw_bytes = bytes(await file.download_as_bytearray())
+        t1 = time.perf_counter()
+        with span("prepare", processed=processed):
+            image_bytes, phash = await asyncio.get_running_loop().run_in_executor(
+                image_executor, _prepare_photo, raw_bytes, processed
+            )
+        t2 = time.perf_counter()
+
+        # почти такое же фото той же тарелки
+        near = photo_cache.get_by_hash(phash)
+        if near is not None:
+            source_uid, result = near
+            photo_cache.alias(uid, source_uid)
+            if photo_cache.path:
+                persistence.mark_dirty("photo_cache")
+            # почти-дубль — это новое фото (свой file_unique_id), поэтому идёт в дневник
+            reply = _format_food_reply(result) + _log_food(update.effective_chat.id, result, uid)
+            await _show_in_placeholder(update, placeholder, reply)
+            photo_seconds.observe(time.perf_counter() - t0, "cache")
+            return
+
+        photo_cache.miss()
+        first_content: Dict[str, float] = {}
+        if random.random() < PHOTO_STREAMING_SAMPLE:
+            editor = ThrottledEditor(placeholder, PHOTO_EDIT_INTERVAL)
+
+        async def on_partial(fields: Dict[str, Any]):
+            if "dish" in fields and "t" not in first_content:
+                first_content["t"] = time.perf_counter()
+                await editor.update(_format_food_reply(fields, partial=True), force=True)
+            else:
+                await editor.update(_format_food_reply(fields, partial=True))
+
+        result = await analyze_food_image(image_bytes, on_partial if editor else None)
+        t3 = time.perf_counter()
+        photo_cache.put(uid, phash, result, t3 - t0)
+        if photo_cache.path:
+            persistence.mark_dirty("photo_cache")
+
+        image_stats.record(
+            "processed" if processed else "raw",
+            len(raw_bytes), len(image_bytes), t1 - t0, t2 - t1, t3 - t2,
+        )
+        final_text = _format_food_reply(result) + _log_food(update.effective_chat.id, result, uid)
+        if editor is None:
+            await _show_in_placeholder(update, placeholder, final_text)
+        elif not await editor.update(final_text, force=True):
+            await update.message.reply_text(final_text)
+        t4 = time.perf_counter()
+        photo_seconds.observe(t4 - t0, "model")
+        first_content_stats.record(
+            "streaming" if editor else "buffered",
+            first_content.get("t", t4) - t0, t4 - t0, editor.edits if editor else 0,
         )
-        await update.message.reply_text(reply)
 
     except Exception:
         logging.exception("Ошибка анализа фото")
-        await update.message.reply_text(
-            "Не получилось распознать блюдо 😕\n"
-            "Попробуйте сделать фото ближе и при хорошем освещении."
-        )
+        photo_seconds.observe(time.perf_counter() - job_started, "error")
+        # в потоковом режиме в заглушке могли остаться поля с «…» — ошибку пишем поверх них
+        if editor is None or not await editor.update(PHOTO_ERROR_TEXT, force=True):
+            await _show_in_placeholder(update, placeholder, PHOTO_ERROR_TEXT)
+    finally:
+        tracer.finish(trace)
+
+# ================== ДНЕВНИК ПИТАНИЯ ==================
+def food_totals(chat_id: int, days: int = 1) -> Optional[Dict[str, float]]:
+    # итоги за последние days дней по часовому поясу чата, включая сегодня (days поисков по индексу)
+    today = now_in_tz(get_user_tz(chat_id)).date()
+    by_day = storage.get_food_totals(chat_id, today - timedelta(days=days - 1), today)
+    return sum_totals(by_day) if by_day else None
+
+def calorie_target(chat_id: int) -> Optional[int]:
+    # рекомендованная калорийность из итогов анкеты (см. summary)
+    return get_chat_settings(chat_id).get("calorie_target")
+
+def _log_food(chat_id: int, result: dict, uid: str) -> str:
+    # разбор фото -> запись дневника; возвращает строку с итогом дня для ответа
+    # пересланное или случайно отправленное ещё раз то же фото не добавляет вторую порцию
+    today = now_in_tz(get_user_tz(chat_id)).date()
+    if not any(e.get("uid") == uid for e in storage.get_food_entries(chat_id, today, today)):
+        storage.add_food_entry(chat_id, today.isoformat(), food_entry(result, uid=uid))
+    totals = food_totals(chat_id)
+    target = calorie_target(chat_id)
+    line = f"\n\n📒 За сегодня: ~{totals['calories']:.0f} ккал"
+    return line + (f" из ~{target}" if target else "") + " (/today)"
+
+@instrumented("today_command")
+async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    await update.message.reply_text(
+        "📒 Питание за сегодня\n\n" + format_totals(food_totals(chat_id), calorie_target(chat_id))
+    )
 
 # ================== ИТОГИ (анкетирование) ==================
 ZONE_TEXTS = {
@@ -641,65 +1037,38 @@ ZONE_TEXTS = {
     "zone_red_flags": "🔴 Важно: симптомы требуют консультации специалиста.",
 }
 
-def calculate_general_score(u):
-    score, max_score = 0, 0
-    YES_NO_QUESTIONS = [
-        "focus_issues", "irritability_day", "sleepiness_day", "palpitations", "cold_hands_feet",
-        "skin_itch", "blue_sclera", "headache", "sweet_craving", "fat_craving",
-        "oily_skin", "dry_skin", "low_libido", "vaginal_itch", "joint_pain", "abdominal_pain",
-        "bloating", "hair_loss", "dry_mouth",
+survey_scorer = Scorer()
+
+def _survey_delta_text(chat_id: int, current: Dict[str, Any]) -> str:
+    # прошлая попытка пересчитывается по текущим правилам — сравниваем одинаковое
+    previous = None
+    for rec in reversed(storage.list_surveys(chat_id)):
+        if (rec.get("answers") or {}).get("format") == SURVEY_FORMAT:
+            previous = rec
+            break
+    if previous is None:
+        return ""
+    delta = score_delta(survey_scorer, current, survey_scorer.score(previous["answers"]))
+    when = datetime.fromtimestamp(previous["ts"], get_user_tz(chat_id)).strftime("%d.%m.%Y")
+    lines = [
+        f"📈 По сравнению с анкетой от {when}:",
+        f"общее состояние {delta['general']:+d}, здоровье организма {delta['health']:+d}",
     ]
-    SCALE_QUESTIONS = ["energy_level", "sleep_quality"]
-
-    for q in YES_NO_QUESTIONS:
-        max_score += 2
-        if u.get(q) == "нет":
-            score += 2
-
-    scale_sum = 0
-    for q in SCALE_QUESTIONS:
-        max_score += 5
-        try:
-            val = int((u.get(q, "0") or "0")[0])
-            score += val
-            scale_sum += val
-        except Exception:
-            pass
-
-    health_score = round((scale_sum / (len(SCALE_QUESTIONS) * 5)) * 10) if SCALE_QUESTIONS else 0
-    general_score = round((score / max_score) * 100) if max_score else 0
-    return general_score, health_score
-
-def calculate_zones(u):
-    zones = {k: 0 for k in ZONE_TEXTS.keys()}
-    if u.get("stool_frequency") in ["1 раз в 2–3 дня", "1 раз в 3–5 дней"] or u.get("bloating") == "да" or u.get("abdominal_pain") == "да":
-        zones["zone_gut"] = 1
-    try:
-        if float(u.get("waist_cm", 0)) >= 85:
-            zones["zone_bmi"] = 1
-    except Exception:
-        pass
-    if u.get("cycle_status") in ["нерегулярный", "я женщина, цикла нет"]:
-        zones["zone_cycle"] = 1
-    if u.get("appetite_level") in ["повышенный", "пониженный"] or u.get("sweet_craving") == "да" or u.get("fat_craving") == "да":
-        zones["zone_appetite"] = 1
-    if u.get("focus_issues") == "да" or u.get("irritability_day") == "да" or u.get("sleepiness_day") == "да":
-        zones["zone_symptoms"] = 1
-    if u.get("oily_skin") == "да" or u.get("dry_skin") == "да" or u.get("skin_itch") == "да":
-        zones["zone_skin"] = 1
-    if u.get("low_libido") == "да" or u.get("vaginal_itch") == "да":
-        zones["zone_libido"] = 1
-    if u.get("headache") == "да" or u.get("joint_pain") == "да" or u.get("abdominal_pain") == "да":
-        zones["zone_pain"] = 1
-    if u.get("dry_mouth") == "да":
-        zones["zone_dry_mouth"] = 1
-    if u.get("blue_sclera") == "да" or u.get("palpitations") == "да":
-        zones["zone_red_flags"] = 1
-    return zones
+    if delta["new_zones"]:
+        lines.append("Новые зоны внимания:\n" + "\n".join(ZONE_TEXTS[z] for z in delta["new_zones"]))
+    if delta["gone_zones"]:
+        lines.append("Ушли из зон внимания:\n" + "\n".join(ZONE_TEXTS[z] for z in delta["gone_zones"]))
+    return "\n\n" + "\n\n".join(lines)
 
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = context.user_data
-    general_score, health_score = calculate_general_score(u)
+    chat_id = update.effective_chat.id
+    # анкета сохраняется компактно, вместе с итогом — для истории и пересчёта по новым правилам
+    record = encode_survey(u)
+    result = record["score"] = survey_scorer.score(record)
+    general_score, health_score = result["general"], result["health"]
+    delta_text = _survey_delta_text(chat_id, result)
+    storage.save_survey(chat_id, record)
 
     height, weight = u.get("height_cm"), u.get("weight_kg")
     bmi = calculate_bmi(height, weight)
@@ -725,12 +1094,13 @@ async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
             calories = 2200
         elif bmi > 25:
             calories = 1800
+    # цель для дневника питания (/today, вечерний чек-ин, недельный отчёт)
+    _update_chat_settings(chat_id, calorie_target=calories)
 
     energy = u.get("energy_level", "0")
     sleep = u.get("sleep_quality", "0")
 
-    zones = calculate_zones(u)
-    zone_msgs = [ZONE_TEXTS[k] for k, v in zones.items() if v == 1]
+    zone_msgs = [ZONE_TEXTS[k] for k in survey_scorer.zone_names(result["zones"])]
     zones_text = "\n\n".join(zone_msgs) if zone_msgs else "🟢 По анкете не выявлено выраженных зон напряжения."
 
     result_message = (
@@ -743,6 +1113,7 @@ async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🔥 Рекомендационная калорийность: ~{calories} ккал/день\n"
         f"💧 Воды: не менее {water} л/день\n\n"
         f"Зоны внимания:\n\n{zones_text}"
+        f"{delta_text}"
     )
     await update.message.reply_text(result_message)
 
@@ -761,6 +1132,7 @@ async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return FINAL_MENU_STATE
 
 # ================== ФИНАЛЬНОЕ МЕНЮ ==================
+@instrumented("final_menu_handler")
 async def final_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     chat_id = update.effective_chat.id
@@ -769,13 +1141,10 @@ async def final_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     if text == "🔔 Подписаться на уведомления":
         # сохраняем подписчика
-        subs = set(user_settings.get("subscribers", []))
-        subs.add(chat_id)
-        user_settings["subscribers"] = sorted(subs)
-        save_user_settings()
+        storage.add_subscriber(chat_id)
 
         # ставим расписание: ежедневные чек-ины + еженедельный отчет
-        schedule_all_for_chat(context.application, chat_id)
+        schedule_all_for_chat(chat_id)
 
         await update.message.reply_text(
             "Уведомления включены ✅\n\n"
@@ -797,24 +1166,260 @@ async def final_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text("Пожалуйста, выберите действие кнопкой ниже.")
     return FINAL_MENU_STATE
 
-# ================== STARTUP / ERROR ==================
-async def on_startup(application):
-    # чтобы не было конфликтов webhook vs polling
+# ================== ДИАГНОСТИКА (профайлер и трассы) ==================
+def _diagnostics_path(kind: str, ext: str) -> str:
+    directory = os.path.join(STORAGE_DIR, PROFILE_DIR)
+    os.makedirs(directory, exist_ok=True)
+    shard = f"-shard{SHARD_INDEX}" if SHARD_ROLE == "worker" else ""
+    return os.path.join(directory, f"{kind}{shard}-{time.strftime('%Y%m%d-%H%M%S')}.{ext}")
+
+def start_profile(seconds: int, chat_id: Optional[int] = None) -> bool:
+    if not profiler.start():
+        return False
+    logging.info("Profiler started for %ds", seconds)
+    app.create_task(_finish_profile(seconds, chat_id))
+    return True
+
+async def _finish_profile(seconds: int, chat_id: Optional[int]):
+    await asyncio.sleep(seconds)
+    if not profiler.running:  # уже остановлен на выходе
+        return
+    path = _diagnostics_path("profile", "folded")
+    result = await asyncio.to_thread(profiler.stop, path)
+    if chat_id is None:
+        return
+    top = "\n".join(f"{share:.0%} {name}" for name, share in profiler.top(10).items())
+    await app.bot.send_message(
+        chat_id,
+        f"Профиль готов: {result['samples']} сэмплов за {result['seconds']} с.\n"
+        f"Больше всего на вершине стека:\n{top}",
+    )
+    with open(path, "rb") as f:
+        await app.bot.send_document(chat_id, f, filename=os.path.basename(path))
+
+def dump_traces() -> Optional[str]:
+    if not tracer.stats["finished"]:
+        return None
+    path = _diagnostics_path("traces", "json")
+    count = tracer.dump(path)
+    logging.info("Dumped %d slowest traces to %s (%s)", count, path, tracer.stats)
+    return path
+
+@instrumented("profile_command")
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    seconds = PROFILE_SIGNAL_SECONDS
+    if context.args:
+        try:
+            seconds = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Формат: /profile 30 (секунды)")
+            return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if not start_profile(seconds, update.effective_chat.id):
+        await update.message.reply_text("Профайлер уже запущен.")
+        return
+    await update.message.reply_text(f"Профилирую {seconds} с, потом пришлю дамп.")
+
+@instrumented("traces_command")
+async def traces_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /traces — самые медленные трассы; /traces 0.05 — поменять долю трассируемых апдейтов
+    if context.args:
+        try:
+            rate = float(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Формат: /traces или /traces 0.05 (доля апдейтов)")
+            return
+        if update_processor is None:
+            await update.message.reply_text("Трассировка апдейтов недоступна при UPDATE_CONCURRENCY=1 без TRACE_SAMPLE.")
+            return
+        tracer.sample_rate = max(0.0, min(rate, 1.0))
+        await update.message.reply_text(f"Трассируется доля апдейтов: {tracer.sample_rate}")
+        return
+    path = dump_traces()
+    if path is None:
+        await update.message.reply_text(
+            f"Трасс пока нет (доля апдейтов: {tracer.sample_rate}). Включить: /traces 0.05"
+        )
+        return
+    await update.message.reply_text(f"Самые медленные трассы ({path}):\n{tracer.summary(5)}")
+
+def _on_profile_signal():
+    if not start_profile(PROFILE_SIGNAL_SECONDS):
+        logging.info("Profiler is already running")
+    dump_traces()
+
+def install_profile_signal():
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, _on_profile_signal)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        pass  # Windows: только /profile
+
+# ================== АНАЛИТИКА ==================
+analytics_running = False
+
+def _parse_analytics_range(args: List[str]) -> Optional[Tuple[date, date]]:
+    # "" — последние ANALYTICS_DAYS дней, "90" — последние 90, "2026-09-01 2026-09-30" — период
+    today = date.today()
     try:
-        await application.bot.delete_webhook(drop_pending_updates=True)
+        if not args:
+            return today - timedelta(days=ANALYTICS_DAYS - 1), today
+        if len(args) == 1:
+            return today - timedelta(days=int(args[0]) - 1), today
+        return date.fromisoformat(args[0]), date.fromisoformat(args[1])
+    except ValueError:
+        return None
+
+@instrumented("analytics_command")
+async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global analytics_running
+    period = _parse_analytics_range(context.args or [])
+    if period is None or not 1 <= (period[1] - period[0]).days + 1 <= ANALYTICS_MAX_DAYS:
+        await update.message.reply_text(
+            f"Формат: /analytics, /analytics 90 или /analytics 2026-09-01 2026-09-30 "
+            f"(не больше {ANALYTICS_MAX_DAYS} дней)"
+        )
+        return
+    if analytics_running:
+        await update.message.reply_text("Аналитика уже считается, подождите.")
+        return
+    analytics_running = True
+    await update.message.reply_text("Считаю аналитику…")
+    # расчёт — отдельной задачей, чтобы не держать очередь апдейтов этого чата
+    context.application.create_task(_run_analytics(update.effective_chat.id, *period))
+
+async def _run_analytics(chat_id: int, start: date, end: date):
+    global analytics_running
+    try:
+        result = await cohort_report(storage, start, end, ANALYTICS_CHUNK)
+        logging.info("Analytics %s..%s: %s", start, end, result["timing"])
+        await app.bot.send_message(chat_id, format_report(result))
     except Exception:
-        logging.exception("delete_webhook failed")
+        logging.exception("Analytics failed")
+        await app.bot.send_message(chat_id, "Не получилось посчитать аналитику, подробности в логе.")
+    finally:
+        analytics_running = False
+
+rescore_running = False
+
+@instrumented("rescore_command")
+async def rescore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # пересчёт последних анкет всех чатов по текущим правилам зон; изменившиеся итоги сохраняются
+    global rescore_running
+    if rescore_running:
+        await update.message.reply_text("Пересчёт уже идёт, подождите.")
+        return
+    rescore_running = True
+    await update.message.reply_text("Пересчитываю анкеты…")
+    context.application.create_task(_run_rescore(update.effective_chat.id))
 
-    # ✅ Авто-восстановление расписания для подписчиков после рестарта
+async def _run_rescore(chat_id: int):
+    global rescore_running
     try:
-        subs = user_settings.get("subscribers", []) or []
-        for chat_id in subs:
-            schedule_all_for_chat(application, int(chat_id))
-        logging.info("Restored schedules for %d subscribers", len(subs))
+        # чтение и подсчёт — в потоке; запись итогов — здесь, порциями, как выборка в аналитике
+        stats, updates = await asyncio.to_thread(lambda: survey_scorer.rescore(storage.iter_surveys()))
+        for i in range(0, len(updates), ANALYTICS_CHUNK):
+            storage.update_survey_scores(updates[i:i + ANALYTICS_CHUNK])
+            await asyncio.sleep(0)
+        logging.info("Survey rescore: %s", stats)
+        zones = "\n".join(
+            f"• {ZONE_TEXTS[z]} — {n} ({n / stats['chats']:.0%})" for z, n in stats["zones"].items() if stats["chats"]
+        )
+        await app.bot.send_message(
+            chat_id,
+            f"Пересчёт анкет (правила v{stats['rules']}): {stats['chats']} чатов, {stats['surveys']} анкет, "
+            f"{stats['seconds']} с.\n"
+            f"Итог изменился и сохранён у {stats['changed']}, старый формат пропущен: {stats['skipped']}.\n\n{zones}",
+        )
     except Exception:
-        logging.exception("Failed to restore schedules")
+        logging.exception("Survey rescore failed")
+        await app.bot.send_message(chat_id, "Не получилось пересчитать анкеты, подробности в логе.")
+    finally:
+        rescore_running = False
+
+# ================== STARTUP / ERROR ==================
+def webhook_full_url() -> str:
+    return f"{WEBHOOK_URL}/{WEBHOOK_PATH}"
+
+async def on_startup(application):
+    if SHARD_ROLE == "worker":
+        # апдейты приходят от ingress, с Bot API работает только он
+        pass
+    elif BOT_MODE == "webhook":
+        # setWebhook делает run_webhook (см. __main__), здесь — только лог
+        logging.info("Webhook mode: %s (max_connections=%d)", webhook_full_url(), WEBHOOK_MAX_CONNECTIONS)
+    else:
+        # чтобы не было конфликтов webhook vs polling
+        try:
+            await application.bot.delete_webhook(drop_pending_updates=True)
+        except Exception:
+            logging.exception("delete_webhook failed")
+
+    install_profile_signal()
+    if SHARD_ROLE == "ingress":
+        shard_router.start()
+        if metrics_server is not None:
+            await metrics_server.start()
+        _note_ready()
+        return
+
+    # ✅ Авто-восстановление расписания для подписчиков после рестарта
+    restored = load_schedule_index()
+    if restored is not None:
+        logging.info("Restored schedules for %d subscribers from index", restored)
+    else:
+        application.create_task(rebuild_schedules())
+
+    persistence.start()
+    photo_queue.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+    application.create_task(scheduler.run())
+    application.create_task(_journal_compaction_loop())
+    application.create_task(_retention_loop())
+    application.create_task(_aggregates_sweep_loop())
+    application.create_task(_warm_up())
+    _note_ready()
+
+def _note_ready():
+    boot_stats["ready_s"] = round(time.perf_counter() - BOOT_STARTED, 3)
+    logging.info("Boot: %s", boot_stats)
+
+async def _warm_up():
+    # тяжёлые модули — в потоке, уже после старта, чтобы первое фото не ждало импорта
+    for module in ("openai", "PIL.Image"):
+        try:
+            await asyncio.to_thread(importlib.import_module, module)
+        except ImportError:
+            pass
+
+async def note_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if "first_update_s" not in boot_stats:
+        boot_stats["first_update_s"] = round(time.perf_counter() - BOOT_STARTED, 3)
+        logging.info("Boot: first update %s", boot_stats)
+
+async def on_shutdown(application):
+    if metrics_server is not None:
+        await metrics_server.stop()
+    if profiler.running:
+        await asyncio.to_thread(profiler.stop, _diagnostics_path("profile", "folded"))
+    dump_traces()
+    if SHARD_ROLE == "ingress":
+        await shard_router.stop()
+        logging.info("Shard router stopped: %s", shard_router.stats)
+        return
+    # гарантированно дописываем всё, что накопилось
+    await photo_queue.stop()
+    await persistence.stop()
+    storage.close()
+    if _openai_client is not None:
+        await _openai_client.close()
+    image_executor.shutdown(wait=False)
+    logging.info("Persistence flushed on shutdown: %s (state: %s)", persistence.stats, state_persistence.stats)
+    if update_processor is not None:
+        logging.info("Update processor: %s", update_processor.stats())
 
 app.post_init = on_startup
+app.post_shutdown = on_shutdown
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     err = context.error
@@ -823,6 +1428,42 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         logging.error("Conflict: another bot instance is already polling getUpdates. Stopping this instance.")
         await context.application.stop()
 
+# ================== ШАРДЫ ==================
+shard_router = ShardRouter(SHARD_WORKERS, SHARD_SECRET, vnodes=SHARD_VNODES) if SHARD_ROLE == "ingress" else None
+
+async def forward_to_shard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # ingress: никакой обработки, только пересылка владельцу чата
+    chat = update.effective_chat or update.effective_user
+    shard_router.route(chat.id if chat else None, update.to_dict())
+    raise ApplicationHandlerStop
+
+async def receive_from_ingress(updates: List[Dict[str, Any]]):
+    for data in updates:
+        update = Update.de_json(data, app.bot)
+        chat = update.effective_chat or update.effective_user
+        if chat is not None and not owns_chat(chat.id):
+            # ingress и воркеры запущены с разным числом шардов — обрабатываем, но сигналим
+            logging.warning("Update for chat_id=%s routed to shard %d, owner is %d",
+                            chat.id, SHARD_INDEX, shard_ring.owner(chat.id))
+        await app.update_queue.put(update)
+
+async def run_shard_worker():
+    # без run_polling/run_webhook: post_init/post_shutdown вызываем сами
+    server = ShardServer(SHARD_LISTEN, SHARD_PORT, SHARD_SECRET, receive_from_ingress)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with app:
+        await on_startup(app)
+        await app.start()
+        await server.start()
+        logging.info("Shard worker %d/%d started", SHARD_INDEX, SHARD_COUNT)
+        await stop.wait()
+        await server.stop()
+        await app.stop()
+        await on_shutdown(app)
+
 # ================== ХЕНДЛЕРЫ ==================
 survey_handler = ConversationHandler(
     entry_points=[
@@ -839,13 +1480,30 @@ survey_handler = ConversationHandler(
         CommandHandler("notify", notify_entry),
     ],
     allow_reentry=True,
+    name="survey",
+    persistent=SHARD_ROLE != "ingress",
 )
 
-# 1) Фото
+app.add_handler(TypeHandler(Update, note_first_update), group=-1000)
+if SHARD_ROLE == "ingress":
+    app.add_handler(TypeHandler(Update, forward_to_shard), group=-100)
+
+# 0) Настройки расписания
+app.add_handler(CommandHandler("timezone", timezone_command))
+app.add_handler(CommandHandler("time", time_command))
+if ADMIN_IDS:
+    app.add_handler(CommandHandler("profile", profile_command, filters=filters.User(user_id=ADMIN_IDS)))
+    app.add_handler(CommandHandler("traces", traces_command, filters=filters.User(user_id=ADMIN_IDS)))
+    app.add_handler(CommandHandler("analytics", analytics_command, filters=filters.User(user_id=ADMIN_IDS)))
+    app.add_handler(CommandHandler("rescore", rescore_command, filters=filters.User(user_id=ADMIN_IDS)))
+
+# 1) Фото и дневник питания
 app.add_handler(MessageHandler(filters.PHOTO, photo_handler))
+app.add_handler(CommandHandler("today", today_command))
 
 # 2) ✅ Чек-ины должны перехватываться ПЕРЕД conversation,
-#    иначе ConversationHandler может “съесть” ответы.
+#    иначе ConversationHandler может “съесть” ответы. Кнопки анкеты/меню чек-ин закрывают (группа -1).
+app.add_handler(MessageHandler(CheckinActiveFilter() & filters.Text(MENU_TEXTS), cancel_checkin_for_menu), group=-1)
 app.add_handler(MessageHandler(CheckinActiveFilter() & filters.TEXT & ~filters.COMMAND, handle_checkin_response))
 
 # 3) Анкета/меню
@@ -854,9 +1512,26 @@ app.add_handler(survey_handler)
 app.add_error_handler(error_handler)
 
 # ================== RUN ==================
-load_user_settings()
-load_weekly_data()
+if SHARD_ROLE != "ingress":
+    storage.load()
+    photo_cache.load()
 
 if __name__ == "__main__":
     print("Бот запущен")
-    app.run_polling(drop_pending_updates=True)
+    if SHARD_ROLE == "worker":
+        asyncio.run(run_shard_worker())
+    elif BOT_MODE == "webhook":
+        # setWebhook — только здесь. Telegram будет слать апдейты с заголовком
+        # X-Telegram-Bot-Api-Secret-Token, встроенный сервер отвечает 403 на запросы без него.
+        # Накопившиеся апдейты не сбрасываем: при рестарте процесса они бы пропали
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_full_url(),
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        app.run_polling(drop_pending_updates=True)
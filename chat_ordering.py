@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+from typing import Dict, Any, Optional, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from tracing import Tracer
+
+STATS_LOG_INTERVAL = 60.0
+
+def update_chat_key(update: object) -> Optional[int]:
+    # апдейты одного чата (или пользователя, если чата нет) идут строго по порядку
+    if not isinstance(update, Update):
+        return None
+    chat = update.effective_chat or update.effective_user
+    return chat.id if chat is not None else None
+
+# ================== ПАРАЛЛЕЛЬНО МЕЖДУ ЧАТАМИ, ПО ПОРЯДКУ ВНУТРИ ЧАТА ==================
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """
+    Разные чаты обрабатываются параллельно (не больше max_concurrent_updates сразу),
+    апдейты одного чата — строго друг за другом, в порядке поступления.
+    ConversationHandler и checkin_progress видят ту же последовательность, что и раньше.
+
+    Общий лимит — семафор базового класса (его final process_update);
+    очередь чата выстраивается в do_process_update, уже внутри слота.
+    Апдейт, ждущий предыдущий апдейт своего чата, держит слот: при очереди в одном чате
+    параллельность для остальных временно ниже, зато ожидающий не бывает вне лимита.
+    Порядок внутри чата держится на том, что asyncio.Semaphore отдаёт слоты по очереди
+    (FIFO, без обгона — так с Python 3.11.9, см. runtime.txt): задачи апдейтов создаются
+    в порядке поступления, и хвост чата регистрируется сразу после слота, до первого await.
+
+    Если передан tracer, здесь же начинается и заканчивается трасса апдейта
+    (попавшего в выборку): ожидание очереди чата и сама обработка.
+    """
+
+    def __init__(self, max_concurrent_updates: int, tracer: Optional[Tracer] = None):
+        super().__init__(max_concurrent_updates)
+        self.tracer = tracer
+        # chat_id -> future последнего поставленного апдейта чата
+        self._tails: Dict[int, asyncio.Future] = {}
+        self._depth: Dict[int, int] = {}
+        self.running = 0
+        self.waiting = 0
+        self._last_stats_log = time.monotonic()
+        self.counters: Dict[str, float] = {
+            "processed": 0,
+            "queued_behind_chat": 0,   # пришлось ждать предыдущий апдейт своего чата
+            "chat_wait_s": 0.0,
+            "max_chat_wait_s": 0.0,
+            "max_chat_depth": 0,
+        }
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # вызывается базовым process_update под семафором общего лимита
+        key = update_chat_key(update)
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.begin("update", key, getattr(update, "update_id", None))
+        queued = time.perf_counter()
+        previous = None
+        done = None
+        if key is not None:
+            previous = self._tails.get(key)
+            done = asyncio.get_running_loop().create_future()
+            self._tails[key] = done
+            depth = self._depth[key] = self._depth.get(key, 0) + 1
+            if depth > self.counters["max_chat_depth"]:
+                self.counters["max_chat_depth"] = depth
+        self.waiting += 1
+        waiting = True
+        try:
+            if previous is not None:
+                self.counters["queued_behind_chat"] += 1
+                await previous
+            started = time.perf_counter()
+            self.waiting -= 1
+            waiting = False
+            self.running += 1
+            if trace is not None:
+                trace[0].add("chat_wait", queued, started)
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+            self._record(started - queued)
+        finally:
+            if trace is not None:
+                self.tracer.finish(trace)
+            if waiting:
+                self.waiting -= 1
+            if done is not None:
+                done.set_result(None)
+                if self._tails.get(key) is done:
+                    del self._tails[key]
+                self._depth[key] -= 1
+                if not self._depth[key]:
+                    del self._depth[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    # ---------- метрики ----------
+    def _record(self, chat_wait: float):
+        c = self.counters
+        c["processed"] += 1
+        c["chat_wait_s"] += chat_wait
+        if chat_wait > c["max_chat_wait_s"]:
+            c["max_chat_wait_s"] = chat_wait
+        now = time.monotonic()
+        if now - self._last_stats_log >= STATS_LOG_INTERVAL:
+            self._last_stats_log = now
+            logging.info("Update processor: %s", self.stats())
+
+    def stats(self) -> Dict[str, Any]:
+        c = self.counters
+        n = c["processed"] or 1
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "chats_active": len(self._tails),
+            "avg_chat_wait_s": round(c["chat_wait_s"] / n, 4),
+            **{k: round(v, 4) if isinstance(v, float) else v for k, v in c.items()},
+        }
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+import json
+from array import array
+from datetime import date
+from typing import Dict, Any, Optional, List, Tuple, Iterator
+
+from aggregates import STATUSES
+from journal import read_json_file
+
+# ================== КОДЫ ОТВЕТОВ ==================
+# Поля чек-инов с кнопками — слоты по 3 бита в одном uint16 на день:
+# 0 — ответа нет, 1..N — номер варианта. Всё прочее (sleep_plan, неизвестные поля
+# и значения не из списка) лежит в боковой таблице строк — преобразование без потерь.
+DAY_RESULTS = ("Отлично", "Нормально", "Плохо")
+SLOTS: Tuple[Tuple[str, str, Tuple[str, ...]], ...] = (
+    ("morning", "sleep_quality", STATUSES),
+    ("morning", "energy_level", STATUSES),
+    ("day", "wellbeing", STATUSES),
+    ("day", "energy_level", STATUSES),
+    ("evening", "day_result", DAY_RESULTS),
+)
+SLOT_BITS = 3
+SLOT_MASK = (1 << SLOT_BITS) - 1
+SLOT_INDEX = {(t, f): i for i, (t, f, _) in enumerate(SLOTS)}
+VALUE_CODES = [{v: j + 1 for j, v in enumerate(values)} for _, _, values in SLOTS]
+COMPACT_FORMAT = "checkins-compact/1"
+
+CheckinDays = Dict[str, Dict[str, Dict[str, str]]]
+# боковая таблица: (checkin_type, field) -> {смещение дня: текст}; полей обычно одно-два
+TextTable = Dict[Tuple[str, str], Dict[int, str]]
+
+def slot_code(checkin_type: str, field: str, value: str) -> int:
+    # код ответа, уже сдвинутый в свой слот; 0 — поле/значение не кодируются
+    slot = SLOT_INDEX.get((checkin_type, field))
+    if slot is None:
+        return 0
+    return VALUE_CODES[slot].get(value, 0) << (slot * SLOT_BITS)
+
+def _decode_day(code: int, slots=SLOTS) -> Dict[str, Dict[str, str]]:
+    day: Dict[str, Dict[str, str]] = {}
+    i = 0
+    while code:
+        v = code & SLOT_MASK
+        if v:
+            t, f, values = slots[i]
+            day.setdefault(t, {})[f] = values[v - 1]
+        code >>= SLOT_BITS
+        i += 1
+    return day
+
+# ================== ИСТОРИЯ ОДНОГО ЧАТА ==================
+class ChatDays:
+    """
+    Дни чата подряд начиная с start (ordinal даты): codes[i] — ответы-кнопки дня start+i.
+    text — боковая таблица свободного текста, создаётся только при необходимости.
+    """
+
+    __slots__ = ("start", "codes", "text")
+
+    def __init__(self, start: int):
+        self.start = start
+        self.codes = array("H")
+        self.text: Optional[TextTable] = None
+
+    def _offset(self, ordinal: int) -> int:
+        if not self.codes and not self.text:
+            self.start = ordinal
+        if ordinal < self.start:
+            # ответ за день раньше первого — сдвигаем начало (редко: перенос старых данных)
+            shift = self.start - ordinal
+            self.codes[0:0] = array("H", [0]) * shift
+            if self.text:
+                self.text = {k: {o + shift: v for o, v in by_offset.items()} for k, by_offset in self.text.items()}
+            self.start = ordinal
+        offset = ordinal - self.start
+        grow = offset + 1 - len(self.codes)
+        if grow > 0:
+            self.codes.extend(array("H", [0]) * grow)
+        return offset
+
+    def set(self, ordinal: int, checkin_type: str, field: str, value: str) -> Optional[str]:
+        # возвращает прежнее значение
+        offset = self._offset(ordinal)
+        previous = self.get(ordinal, checkin_type, field)
+        slot = SLOT_INDEX.get((checkin_type, field))
+        code = VALUE_CODES[slot].get(value) if slot is not None else None
+        shift = slot * SLOT_BITS if slot is not None else 0
+        if code is not None:
+            self.codes[offset] = (self.codes[offset] & ~(SLOT_MASK << shift)) | (code << shift)
+            if self.text:
+                by_offset = self.text.get((checkin_type, field))
+                if by_offset:
+                    by_offset.pop(offset, None)
+        else:
+            if slot is not None:
+                self.codes[offset] &= ~(SLOT_MASK << shift)
+            if self.text is None:
+                self.text = {}
+            self.text.setdefault((checkin_type, field), {})[offset] = value
+        return previous
+
+    def get(self, ordinal: int, checkin_type: str, field: str) -> Optional[str]:
+        offset = ordinal - self.start
+        if 0 <= offset < len(self.codes):
+            slot = SLOT_INDEX.get((checkin_type, field))
+            if slot is not None:
+                v = (self.codes[offset] >> (slot * SLOT_BITS)) & SLOT_MASK
+                if v:
+                    return SLOTS[slot][2][v - 1]
+        if self.text:
+            by_offset = self.text.get((checkin_type, field))
+            if by_offset:
+                return by_offset.get(offset)
+        return None
+
+    def day(self, ordinal: int) -> Dict[str, Dict[str, str]]:
+        offset = ordinal - self.start
+        result = _decode_day(self.codes[offset]) if 0 <= offset < len(self.codes) else {}
+        if self.text:
+            for (t, f), by_offset in self.text.items():
+                v = by_offset.get(offset)
+                if v is not None:
+                    result.setdefault(t, {})[f] = v
+        return result
+
+    def split_before(self, ordinal: int) -> Optional["ChatDays"]:
+        # отрезает дни раньше ordinal; возвращает их отдельной записью (None — нечего резать)
+        cut = min(ordinal - self.start, len(self.codes))
+        if cut <= 0:
+            return None
+        old = ChatDays(self.start)
+        old.codes = self.codes[:cut]
+        del self.codes[:cut]
+        if self.text:
+            old_text: TextTable = {}
+            new_text: TextTable = {}
+            for k, by_offset in self.text.items():
+                for o, v in by_offset.items():
+                    if o < cut:
+                        old_text.setdefault(k, {})[o] = v
+                    else:
+                        new_text.setdefault(k, {})[o - cut] = v
+            old.text = old_text or None
+            self.text = new_text or None
+        self.start += cut
+        return old
+
+    def is_empty(self) -> bool:
+        return not any(self.codes) and not self.text
+
+    def ordinals(self) -> Iterator[int]:
+        # дни, за которые есть хоть один ответ
+        text_offsets = {o for by_offset in self.text.values() for o in by_offset} if self.text else set()
+        for offset, code in enumerate(self.codes):
+            if code or offset in text_offsets:
+                yield self.start + offset
+
+# ================== ВСЯ ИСТОРИЯ ==================
+class CheckinHistory:
+    """
+    Компактная замена weekly_data {chat: {date: {type: {field: value}}}}.
+    to_json()/from_json() — прежний формат без потерь; на диске — компактный (to_compact).
+    """
+
+    def __init__(self):
+        self._chats: Dict[str, ChatDays] = {}
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def __contains__(self, chat_key: str) -> bool:
+        return chat_key in self._chats
+
+    def chats(self) -> List[str]:
+        return list(self._chats)
+
+    def record(self, chat_key: str, date_key: str, checkin_type: str, field: str, value: str) -> Optional[str]:
+        ordinal = date.fromisoformat(date_key).toordinal()
+        chat = self._chats.get(chat_key)
+        if chat is None:
+            chat = self._chats[chat_key] = ChatDays(ordinal)
+        return chat.set(ordinal, checkin_type, field, value)
+
+    def get(self, chat_key: str, date_key: str, checkin_type: str, field: str) -> Optional[str]:
+        chat = self._chats.get(chat_key)
+        if chat is None:
+            return None
+        return chat.get(date.fromisoformat(date_key).toordinal(), checkin_type, field)
+
+    def get_range(self, chat_key: str, start: date, end: date) -> CheckinDays:
+        chat = self._chats.get(chat_key)
+        if chat is None:
+            return {}
+        result: CheckinDays = {}
+        lo = max(start.toordinal(), chat.start)
+        hi = min(end.toordinal(), chat.start + len(chat.codes) - 1)
+        for ordinal in range(lo, hi + 1):
+            day = chat.day(ordinal)
+            if day:
+                result[date.fromordinal(ordinal).isoformat()] = day
+        return result
+
+    def codes_matrix(self, chat_keys: List[str], start: int, days: int) -> array:
+        # коды-кнопки чатов за days дней с ordinal start: строка на чат подряд, 0 — ответа нет
+        out = array("H", bytes(2 * days * len(chat_keys)))
+        for row, chat_key in enumerate(chat_keys):
+            chat = self._chats.get(chat_key)
+            if chat is None:
+                continue
+            lo = max(start, chat.start)
+            hi = min(start + days, chat.start + len(chat.codes))
+            if lo < hi:
+                base = row * days - start
+                out[base + lo:base + hi] = chat.codes[lo - chat.start:hi - chat.start]
+        return out
+
+    def chat_json(self, chat_key: str) -> CheckinDays:
+        chat = self._chats.get(chat_key)
+        if chat is None:
+            return {}
+        return {date.fromordinal(o).isoformat(): chat.day(o) for o in chat.ordinals()}
+
+    # ---------- разбиение по времени ----------
+    def split_before(self, ordinal: int, chat_keys: Optional[List[str]] = None) -> "CheckinHistory":
+        # переносит дни раньше ordinal в новую историю; опустевшие чаты удаляются
+        old = CheckinHistory()
+        for chat_key in (self.chats() if chat_keys is None else chat_keys):
+            chat = self._chats.get(chat_key)
+            if chat is None:
+                continue
+            part = chat.split_before(ordinal)
+            if part is not None and not part.is_empty():
+                old._chats[chat_key] = part
+            if chat.is_empty():
+                del self._chats[chat_key]
+        return old
+
+    def merge(self, other: "CheckinHistory") -> None:
+        # ответы other перекрывают совпадающие
+        for chat_key in other.chats():
+            for date_key, day in other.chat_json(chat_key).items():
+                for checkin_type, fields in day.items():
+                    for field, value in fields.items():
+                        self.record(chat_key, date_key, checkin_type, field, value)
+
+    def by_month(self) -> Dict[str, "CheckinHistory"]:
+        # {"YYYY-MM": история за месяц}
+        months: Dict[str, CheckinHistory] = {}
+        for chat_key in self.chats():
+            for date_key, day in self.chat_json(chat_key).items():
+                part = months.setdefault(date_key[:7], CheckinHistory())
+                for checkin_type, fields in day.items():
+                    for field, value in fields.items():
+                        part.record(chat_key, date_key, checkin_type, field, value)
+        return months
+
+    # ---------- прежний JSON ----------
+    def to_json(self) -> Dict[str, CheckinDays]:
+        return {chat_key: self.chat_json(chat_key) for chat_key in self._chats}
+
+    @classmethod
+    def from_json(cls, data: Dict[str, CheckinDays]) -> "CheckinHistory":
+        history = cls()
+        for chat_key, by_date in data.items():
+            # по возрастанию даты: массив дней растёт только в конец
+            for date_key in sorted(by_date):
+                for checkin_type, fields in by_date[date_key].items():
+                    for field, value in fields.items():
+                        history.record(chat_key, date_key, checkin_type, field, value)
+        return history
+
+    # ---------- компактный формат ----------
+    def to_compact(self) -> Dict[str, Any]:
+        chats = {}
+        for chat_key, chat in self._chats.items():
+            text = [[o, t, f, v] for (t, f), by_offset in chat.text.items() for o, v in by_offset.items()] if chat.text else []
+            chats[chat_key] = [chat.start, chat.codes.tolist(), text]
+        return {
+            "format": COMPACT_FORMAT,
+            "slots": [[t, f, list(values)] for t, f, values in SLOTS],
+            "chats": chats,
+        }
+
+    @classmethod
+    def from_compact(cls, data: Dict[str, Any]) -> "CheckinHistory":
+        slots = tuple((t, f, tuple(values)) for t, f, values in data.get("slots", []))
+        if slots != SLOTS:
+            # файл записан с другим набором слотов — раскодируем его таблицей и перекодируем
+            legacy: Dict[str, CheckinDays] = {}
+            for chat_key, (start, codes, text) in data.get("chats", {}).items():
+                by_date = legacy.setdefault(chat_key, {})
+                for offset, code in enumerate(codes):
+                    if code:
+                        by_date[date.fromordinal(start + offset).isoformat()] = _decode_day(code, slots)
+                for o, t, f, v in text:
+                    by_date.setdefault(date.fromordinal(start + o).isoformat(), {}).setdefault(t, {})[f] = v
+            return cls.from_json(legacy)
+
+        history = cls()
+        for chat_key, (start, codes, text) in data.get("chats", {}).items():
+            chat = history._chats[chat_key] = ChatDays(start)
+            chat.codes = array("H", codes)
+            if text:
+                chat.text = {}
+                for o, t, f, v in text:
+                    chat.text.setdefault((t, f), {})[o] = v
+        return history
+
+# ================== ЖУРНАЛ ==================
+def apply_checkin_record(history: CheckinHistory, rec: Dict[str, Any]) -> None:
+    # rec: {"c": chat_id, "d": date, "t": checkin_type, "f": field, "v": value}
+    history.record(rec["c"], rec["d"], rec["t"], rec["f"], rec["v"])
+
+def load_history(path: str) -> CheckinHistory:
+    # понимает и компактный снимок, и прежний weekly_data.json
+    data = read_json_file(path)
+    if data.get("format") == COMPACT_FORMAT:
+        return CheckinHistory.from_compact(data)
+    return CheckinHistory.from_json(data)
+
+def dump_history(history: CheckinHistory) -> str:
+    return json.dumps(history.to_compact(), ensure_ascii=False, separators=(",", ":"))
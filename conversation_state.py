@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from storage import Storage
+
+# ================== СОСТОЯНИЕ ЧАТОВ (чек-ины) ==================
+class ChatStateMap:
+    """
+    chat_id -> dict, поверх Storage.set_state/get_state.
+    Чат поднимается из хранилища при первом обращении после рестарта;
+    каждое изменение пишется одной записью только для этого чата.
+    После правки значения на месте нужно вызвать save(chat_id).
+    """
+
+    def __init__(self, storage: Storage, kind: str, miss_capacity: int = 10000):
+        self.storage = storage
+        self.kind = kind
+        # только чаты с состоянием: len() — число открытых без обхода
+        self._data: Dict[int, Dict[str, Any]] = {}
+        # чаты, уже проверенные и без состояния, — ограниченный LRU: фильтр текстовых
+        # сообщений спрашивает про каждый писавший чат, и запоминать всех нельзя
+        self.miss_capacity = miss_capacity
+        self._misses: "OrderedDict[int, None]" = OrderedDict()
+
+    def _get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        value = self._data.get(chat_id)
+        if value is not None:
+            return value
+        if chat_id in self._misses:
+            self._misses.move_to_end(chat_id)
+            return None
+        value = self.storage.get_state(self.kind, chat_id)
+        if value is None:
+            self._remember_miss(chat_id)
+        else:
+            self._data[chat_id] = value
+        return value
+
+    def _remember_miss(self, chat_id: int):
+        self._misses[chat_id] = None
+        self._misses.move_to_end(chat_id)
+        while len(self._misses) > self.miss_capacity:
+            self._misses.popitem(last=False)
+
+    def get(self, chat_id: int, default=None):
+        value = self._get(chat_id)
+        return default if value is None else value
+
+    def __contains__(self, chat_id: int) -> bool:
+        return self._get(chat_id) is not None
+
+    def __setitem__(self, chat_id: int, value: Dict[str, Any]):
+        self._misses.pop(chat_id, None)
+        self._data[chat_id] = value
+        self.storage.set_state(self.kind, chat_id, dict(value))
+
+    def __delitem__(self, chat_id: int):
+        if self.pop(chat_id) is None:
+            raise KeyError(chat_id)
+
+    def save(self, chat_id: int):
+        value = self._data.get(chat_id)
+        if value is not None:
+            self.storage.set_state(self.kind, chat_id, dict(value))
+
+    def pop(self, chat_id: int, default=None):
+        value = self._get(chat_id)
+        if value is None:
+            return default
+        del self._data[chat_id]
+        self._remember_miss(chat_id)
+        self.storage.set_state(self.kind, chat_id, None)
+        return value
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+# ================== PERSISTENCE ДЛЯ PTB ==================
+def _conv_key(key: Tuple[Any, ...]) -> Tuple[int, str]:
+    # (chat_id, user_id) -> chat_id + остаток ключа строкой
+    return int(key[0]), json.dumps(list(key[1:]))
+
+class StoragePersistence(BasePersistence):
+    """
+    Состояния ConversationHandler и context.user_data в том же Storage.
+    PTB сам передаёт только чаты/пользователей, которых трогали с прошлого сохранения;
+    user_data дополнительно сравнивается с последней записанной копией — неизменённое не пишется.
+    user_data поднимается лениво (refresh_user_data перед обработкой апдейта пользователя),
+    состояния разговоров — целиком при старте: это по одному числу на активный разговор.
+    """
+
+    def __init__(self, storage: Storage, update_interval: float = 1.0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.storage = storage
+        # user_id -> копия последнего записанного/прочитанного user_data
+        self._user_snapshots: Dict[int, Dict[str, Any]] = {}
+        self.stats = {"user_loads": 0, "user_writes": 0, "user_skipped": 0, "conversation_writes": 0}
+
+    # ---------- user_data ----------
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        if user_id in self._user_snapshots:
+            return
+        stored = self.storage.get_state("user", user_id) or {}
+        self._user_snapshots[user_id] = dict(stored)
+        if stored:
+            self.stats["user_loads"] += 1
+            # то, что успел записать текущий апдейт, важнее сохранённого
+            for k, v in stored.items():
+                user_data.setdefault(k, v)
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        if self._user_snapshots.get(user_id) == data:
+            self.stats["user_skipped"] += 1
+            return
+        snapshot = dict(data)
+        self._user_snapshots[user_id] = snapshot
+        self.storage.set_state("user", user_id, dict(snapshot) or None)
+        self.stats["user_writes"] += 1
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._user_snapshots[user_id] = {}
+        self.storage.set_state("user", user_id, None)
+
+    # ---------- разговоры ----------
+    async def get_conversations(self, name: str) -> Dict[Tuple[Any, ...], object]:
+        conversations = {}
+        for chat_id, rest, state in self.storage.list_states(f"conv:{name}"):
+            conversations[(chat_id, *json.loads(rest))] = state
+        logging.info("Restored %d conversations for %s", len(conversations), name)
+        return conversations
+
+    async def update_conversation(self, name: str, key: Tuple[Any, ...], new_state: Optional[object]) -> None:
+        chat_id, rest = _conv_key(key)
+        self.storage.set_state(f"conv:{name}", chat_id, new_state, key=rest)
+        self.stats["conversation_writes"] += 1
+
+    # ---------- не храним ----------
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # на диск пишет PersistenceWorker (его stop() в on_shutdown)
+        pass
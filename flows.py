@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, Any, Optional, List, Tuple, Sequence, Callable, Union
+
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
+
+# ================== КЛАВИАТУРЫ ==================
+# Объекты клавиатур шагов собираются один раз при сборке потока и переиспользуются:
+# в PTB они неизменяемые, при отправке остаётся только их to_dict().
+Markup = Union[ReplyKeyboardMarkup, ReplyKeyboardRemove]
+
+def keyboard_markup(rows: Sequence[Sequence[str]], one_time: bool = True) -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup([list(row) for row in rows], resize_keyboard=True, one_time_keyboard=one_time)
+
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+# ================== ПРОВЕРКА ОТВЕТОВ ==================
+# Валидатор: текст ответа -> нормализованное значение или None (тогда вопрос задаётся снова).
+class Answer:
+    error = "Не понял ответ, попробуйте ещё раз."
+    rows: Optional[Tuple[Tuple[str, ...], ...]] = None
+
+    def parse(self, text: str) -> Optional[str]:
+        raise NotImplementedError
+
+class FreeText(Answer):
+    error = "Напишите ответ текстом."
+
+    def parse(self, text: str) -> Optional[str]:
+        return text or None
+
+class Number(Answer):
+    def __init__(self, lo: float, hi: float, integer: bool = False):
+        self.lo = lo
+        self.hi = hi
+        self.integer = integer
+        self.error = f"Введите {'целое ' if integer else ''}число от {lo:g} до {hi:g}."
+
+    def parse(self, text: str) -> Optional[str]:
+        raw = text.replace(" ", "").replace(",", ".")
+        try:
+            value = int(raw) if self.integer else float(raw)
+        except ValueError:
+            return None
+        if not self.lo <= value <= self.hi:
+            return None
+        if self.integer:
+            return str(value)
+        return str(int(value)) if value.is_integer() else str(value)
+
+class Choice(Answer):
+    error = "Пожалуйста, выберите вариант на клавиатуре 👇"
+
+    def __init__(self, rows: Sequence[Sequence[str]]):
+        self.rows = tuple(tuple(r) for r in rows)
+        # регистр и пробелы по краям не важны; возвращаем текст кнопки
+        self._allowed = {t.casefold(): t for row in self.rows for t in row}
+
+    def parse(self, text: str) -> Optional[str]:
+        return self._allowed.get(text.strip().casefold())
+
+# ================== ОПИСАНИЕ И СБОРКА ПОТОКА ==================
+def ask(field: str, text: str, answer: Answer, remove_keyboard: bool = True) -> Dict[str, Any]:
+    # remove_keyboard=False — у вопроса без кнопок клавиатура не трогается (reply_markup=None)
+    return {"field": field, "text": text, "answer": answer, "remove_keyboard": remove_keyboard}
+
+class Step:
+    __slots__ = ("index", "field", "text", "reply_markup", "parse", "error", "next")
+
+    def __init__(self, index: int, field: str, text: str, reply_markup: Optional[Markup],
+                 parse: Callable[[str], Optional[str]], error: str, next_index: Optional[int]):
+        self.index = index
+        self.field = field
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse = parse
+        self.error = error
+        self.next = next_index
+
+class Flow:
+    """
+    Собранный поток вопросов: таблица шагов с готовыми клавиатурами.
+    Шаг по номеру — O(1), переход — step.next (None — поток закончен).
+    """
+
+    def __init__(self, name: str, steps: Sequence[Step], done_text: str = ""):
+        self.name = name
+        self.steps = tuple(steps)
+        self.done_text = done_text
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    @property
+    def first(self) -> Step:
+        return self.steps[0]
+
+    def step(self, index: int) -> Optional[Step]:
+        return self.steps[index] if 0 <= index < len(self.steps) else None
+
+def compile_flow(name: str, questions: Sequence[Dict[str, Any]], done_text: str = "") -> Flow:
+    if not questions:
+        raise ValueError(f"flow {name!r} has no questions")
+    markups: Dict[Tuple[Tuple[str, ...], ...], ReplyKeyboardMarkup] = {}
+    steps: List[Step] = []
+    seen = set()
+    for i, q in enumerate(questions):
+        if q["field"] in seen:
+            raise ValueError(f"flow {name!r}: duplicate field {q['field']!r}")
+        seen.add(q["field"])
+        answer: Answer = q["answer"]
+        if answer.rows is not None:
+            # одинаковые клавиатуры разных шагов — один и тот же объект
+            markup = markups.get(answer.rows)
+            if markup is None:
+                markup = markups[answer.rows] = keyboard_markup(answer.rows)
+        else:
+            markup = REMOVE_KEYBOARD if q["remove_keyboard"] else None
+        next_index = i + 1 if i + 1 < len(questions) else None
+        steps.append(Step(i, q["field"], q["text"], markup, answer.parse, answer.error, next_index))
+    return Flow(name, steps, done_text)
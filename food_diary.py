@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import re
+from typing import Dict, Any, Optional, List
+
+# ================== ДНЕВНИК ПИТАНИЯ ==================
+# Итоги дня — вектор [ккал, белки, жиры, углеводы, записей]: дополняется при каждой записи,
+# поэтому «сколько съедено сегодня» — один поиск по (чат, дата), без прохода по журналу.
+NUTRIENTS = ("calories", "protein", "fat", "carbs")
+TOTALS_SIZE = len(NUTRIENTS) + 1
+
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+def parse_amount(value: Any) -> float:
+    # модель обычно отвечает числом, но бывает "~350" или "300–400 ккал" — тогда среднее
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    numbers = [float(x.replace(",", ".")) for x in _NUMBER_RE.findall(str(value or ""))[:2]]
+    return sum(numbers) / len(numbers) if numbers else 0.0
+
+def food_entry(result: Dict[str, Any], **extra) -> Dict[str, Any]:
+    # ответ модели -> запись дневника: название и числа (для storage.add_food_entry)
+    entry = {"dish": str(result.get("dish") or "")[:200]}
+    for n in NUTRIENTS:
+        entry[n] = round(parse_amount(result.get(n)), 1)
+    entry.update(extra)
+    return entry
+
+def add_to_totals(totals: Optional[List[float]], entry: Dict[str, Any]) -> List[float]:
+    if totals is None:
+        totals = [0.0] * TOTALS_SIZE
+    for i, n in enumerate(NUTRIENTS):
+        totals[i] += parse_amount(entry.get(n))
+    totals[-1] += 1
+    return totals
+
+def totals_dict(totals: List[float]) -> Dict[str, float]:
+    return {**{n: round(totals[i], 1) for i, n in enumerate(NUTRIENTS)}, "entries": int(totals[-1])}
+
+def sum_totals(days: Dict[str, Dict[str, float]]) -> Dict[str, float]:
+    # итоги нескольких дней (из storage.get_food_totals) в один; days — сколько дней с записями
+    out: Dict[str, float] = {n: 0.0 for n in NUTRIENTS}
+    out["entries"] = 0
+    for day in days.values():
+        for k in out:
+            out[k] += day.get(k, 0)
+    out = {k: int(v) if k == "entries" else round(v, 1) for k, v in out.items()}
+    out["days"] = sum(1 for day in days.values() if day.get("entries"))
+    return out
+
+def format_totals(totals: Optional[Dict[str, float]], target: Optional[float] = None) -> str:
+    if not totals or not totals.get("entries"):
+        return "Записей о еде пока нет — пришлите фото блюда 📸"
+    calories = totals["calories"]
+    days = totals.get("days", 1)
+    if days > 1:
+        line = f"🔥 ~{calories:.0f} ккал за {days} дн. с записями, в среднем ~{calories / days:.0f} в день"
+        if target:
+            line += f" (цель ~{target:.0f})"
+    else:
+        line = f"🔥 ~{calories:.0f} ккал"
+        if target:
+            left = target - calories
+            line += f" из ~{target:.0f}" + (f" (осталось ~{left:.0f})" if left > 0 else f" (больше на ~{-left:.0f})")
+    return (
+        f"🍽 Записей: {totals['entries']}\n"
+        f"{line}\n"
+        f"🥩 Б ~{totals['protein']:.0f} г · 🧈 Ж ~{totals['fat']:.0f} г · 🍞 У ~{totals['carbs']:.0f} г"
+    )
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import re
+import time
+from typing import Dict, Any, Optional
+
+# ================== РАЗБОР НЕДОПИСАННОГО JSON ==================
+# Модель отвечает JSON-объектом; пока он приходит кусками, вытаскиваем
+# только поля, которые уже дописаны целиком.
+STRING_FIELDS = ("dish", "comment")
+NUMBER_FIELDS = ("calories", "protein", "fat", "carbs")
+
+_STRING_RE = {f: re.compile(r'"%s"\s*:\s*"((?:[^"\\]|\\.)*)"' % f) for f in STRING_FIELDS}
+# число считается готовым, только если за ним уже идёт разделитель
+_NUMBER_RE = {f: re.compile(r'"%s"\s*:\s*(-?\d+(?:\.\d+)?)\s*[,}\s]' % f) for f in NUMBER_FIELDS}
+
+def extract_partial_fields(text: str) -> Dict[str, Any]:
+    fields: Dict[str, Any] = {}
+    for f, rx in _STRING_RE.items():
+        m = rx.search(text)
+        if m:
+            try:
+                fields[f] = json.loads('"' + m.group(1) + '"')
+            except json.JSONDecodeError:
+                pass
+    for f, rx in _NUMBER_RE.items():
+        m = rx.search(text)
+        if m:
+            num = float(m.group(1))
+            fields[f] = int(num) if num.is_integer() else num
+    return fields
+
+# ================== ТРОТТЛИНГ ПРАВОК ==================
+class ThrottledEditor:
+    # правит одно сообщение не чаще, чем раз в min_interval секунд
+    def __init__(self, message, min_interval: float = 1.0):
+        self.message = message
+        self.min_interval = min_interval
+        self.edits = 0
+        self._last_text: Optional[str] = None
+        self._last_at = 0.0
+
+    async def update(self, text: str, force: bool = False) -> bool:
+        # True — этот текст сейчас на экране
+        if text == self._last_text:
+            return True
+        now = time.monotonic()
+        if not force and now - self._last_at < self.min_interval:
+            return False
+        try:
+            await self.message.edit_text(text)
+        except Exception:
+            # например, «message is not modified» или сообщение удалено
+            logging.debug("edit_text failed", exc_info=True)
+            return False
+        self._last_text = text
+        self._last_at = now
+        self.edits += 1
+        return True
+
+# ================== ВРЕМЯ ДО ПЕРВОГО ПОЛЕЗНОГО ОТВЕТА ==================
+class FirstContentStats:
+    """
+    streaming — правки заглушки по мере прихода полей (первый полезный ответ = блюдо);
+    buffered  — прежний путь: ответ целиком одним сообщением.
+    """
+
+    def __init__(self, log_every: int = 50):
+        self.log_every = log_every
+        self.modes: Dict[str, Dict[str, float]] = {}
+
+    def record(self, mode: str, first_content_s: float, total_s: float, edits: int = 0):
+        m = self.modes.setdefault(mode, {"count": 0, "first_content_s": 0.0, "total_s": 0.0, "edits": 0})
+        m["count"] += 1
+        m["first_content_s"] += first_content_s
+        m["total_s"] += total_s
+        m["edits"] += edits
+        if self.log_every and sum(x["count"] for x in self.modes.values()) % self.log_every == 0:
+            logging.info("Photo first content: %s", self.summary())
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for mode, m in self.modes.items():
+            n = m["count"] or 1
+            result[mode] = {
+                "count": m["count"],
+                "avg_first_content_s": round(m["first_content_s"] / n, 3),
+                "avg_total_s": round(m["total_s"] / n, 3),
+                "avg_edits": round(m["edits"] / n, 2),
+            }
+        return result
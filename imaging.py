@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import io
+import logging
+from typing import Dict, Any, Optional, Tuple, Sequence
+
+_pil_modules: Optional[Tuple[Any, Any]] = None
+
+def _pil() -> Tuple[Any, Any]:
+    # Pillow импортируется при первом фото, а не при старте бота.
+    # (None, None) — Pillow не установлен: фото уходит в модель как есть
+    global _pil_modules
+    if _pil_modules is None:
+        try:
+            from PIL import Image, ImageOps
+            _pil_modules = (Image, ImageOps)
+        except ImportError:
+            _pil_modules = (None, None)
+    return _pil_modules
+
+# ================== ВЫБОР РАЗМЕРА ==================
+def pick_photo_size(photos: Sequence[Any], min_side: int):
+    """
+    Telegram присылает несколько PhotoSize по возрастанию размера.
+    Берём самый маленький, у которого короткая сторона не меньше min_side,
+    иначе — самый большой из имеющихся.
+    """
+    if not photos:
+        return None
+    fitting = [p for p in photos if min(p.width, p.height) >= min_side]
+    if fitting:
+        return min(fitting, key=lambda p: p.width * p.height)
+    return max(photos, key=lambda p: p.width * p.height)
+
+# ================== ПЕРЕКОДИРОВАНИЕ ==================
+def preprocess_image(data: bytes, max_side: int, quality: int) -> Tuple[bytes, Dict[str, Any]]:
+    # уменьшает до max_side по длинной стороне и пережимает в JPEG без EXIF/ICC
+    info: Dict[str, Any] = {"processed": False, "bytes_in": len(data), "bytes_out": len(data)}
+    Image, ImageOps = _pil()
+    if Image is None:
+        return data, info
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            info["size_in"] = img.size
+            img = ImageOps.exif_transpose(img)  # учитываем поворот до того, как выбросим EXIF
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.thumbnail((max_side, max_side))
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=quality, optimize=True)
+            info["size_out"] = img.size
+    except Exception:
+        logging.exception("Image preprocessing failed, sending original")
+        return data, info
+    result = out.getvalue()
+    info.update(processed=True, bytes_out=len(result))
+    return result, info
+
+# ================== ПЕРЦЕПТИВНЫЙ ХЕШ ==================
+def dhash(data: bytes, size: int = 8) -> Optional[int]:
+    # difference hash: 64 бита, устойчив к пережатию и небольшому масштабированию
+    Image, _ = _pil()
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            small = img.convert("L").resize((size + 1, size), Image.LANCZOS)
+            px = list(small.getdata())
+    except Exception:
+        logging.exception("dhash failed")
+        return None
+    h = 0
+    for row in range(size):
+        base = row * (size + 1)
+        for col in range(size):
+            h = (h << 1) | (1 if px[base + col] > px[base + col + 1] else 0)
+    return h
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+# ================== СТАТИСТИКА ==================
+class ImageStats:
+    """
+    Сравнение режимов «raw» (как раньше: самый большой PhotoSize как есть)
+    и «processed» (подбор размера + пережатие): байты и задержки по этапам.
+    """
+
+    FIELDS = ("count", "bytes_downloaded", "bytes_sent", "download_s", "preprocess_s", "model_s")
+
+    def __init__(self, log_every: int = 50):
+        self.log_every = log_every
+        self.modes: Dict[str, Dict[str, float]] = {}
+        self._total = 0
+
+    def record(self, mode: str, bytes_downloaded: int, bytes_sent: int,
+               download_s: float, preprocess_s: float, model_s: float):
+        m = self.modes.setdefault(mode, {f: 0 for f in self.FIELDS})
+        m["count"] += 1
+        m["bytes_downloaded"] += bytes_downloaded
+        m["bytes_sent"] += bytes_sent
+        m["download_s"] += download_s
+        m["preprocess_s"] += preprocess_s
+        m["model_s"] += model_s
+        self._total += 1
+        if self.log_every and self._total % self.log_every == 0:
+            logging.info("Image pipeline: %s", self.summary())
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        # средние по режиму на одно фото
+        result = {}
+        for mode, m in self.modes.items():
+            n = m["count"] or 1
+            result[mode] = {
+                "count": m["count"],
+                "avg_bytes_downloaded": round(m["bytes_downloaded"] / n),
+                "avg_bytes_sent": round(m["bytes_sent"] / n),
+                "avg_download_s": round(m["download_s"] / n, 3),
+                "avg_preprocess_s": round(m["preprocess_s"] / n, 3),
+                "avg_model_s": round(m["model_s"] / n, 3),
+            }
+        raw, processed = result.get("raw"), result.get("processed")
+        if raw and processed:
+            result["saved"] = {
+                "bytes_per_photo": raw["avg_bytes_sent"] - processed["avg_bytes_sent"],
+                "seconds_per_photo": round(
+                    (raw["avg_download_s"] + raw["avg_model_s"])
+                    - (processed["avg_download_s"] + processed["avg_preprocess_s"] + processed["avg_model_s"]),
+                    3,
+                ),
+            }
+        return result
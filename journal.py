@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, Any, Optional, List, Tuple, Callable, IO
+
+# ================== АТОМАРНАЯ ЗАПИСЬ ==================
+def atomic_write_text(path: str, text: str) -> int:
+    # пишем во временный файл рядом и подменяем: при падении старый файл цел
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return len(text)
+
+def read_json_file(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        raw = f.read().strip()
+        return json.loads(raw) if raw else {}
+
+def dump_record(record: Dict[str, Any]) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+# ================== ЖУРНАЛ ==================
+class Journal:
+    """
+    Снимок (обычный JSON-файл) + журнал дозаписи (по одной JSON-записи на строку).
+    Каждое изменение дописывается в журнал; компактация сворачивает журнал в снимок.
+
+    Компактация работает только с файлами: активный журнал переименовывается
+    в *.sealed, затем снимок с диска + sealed сворачиваются в новый снимок.
+    Поэтому она не трогает словари в памяти и может идти в отдельном потоке.
+    load() и compact() идут под одной блокировкой: данные можно поднимать лениво,
+    уже после запуска PersistenceWorker, и не попасть между записью снимка и удалением sealed.
+    """
+
+    def __init__(
+        self,
+        snapshot_path: str,
+        journal_path: str,
+        apply: Callable[[dict, Dict[str, Any]], None],
+        load_snapshot: Callable[[str], dict] = read_json_file,
+        dump_snapshot: Optional[Callable[[dict], str]] = None,
+        empty: Callable[[], Any] = dict,
+    ):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.sealed_path = journal_path + ".sealed"
+        self.apply = apply
+        self.load_snapshot = load_snapshot
+        self.empty = empty  # пустые данные, если снимок не читается
+        self.dump_snapshot = dump_snapshot or (lambda data: json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+        self.pending = 0  # записей в журнале с последней компактации
+        self._fh: Optional[IO[str]] = None
+        self._buffer: List[str] = []  # ещё не записанные строки (см. PersistenceWorker)
+        self.lock = threading.RLock()
+
+    # ---------- загрузка ----------
+    def _replay(self, path: str, data: dict) -> int:
+        if not os.path.exists(path):
+            return 0
+        n = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # недописанная последняя строка после падения — пропускаем
+                    logging.warning("Journal %s: skip broken line %d", path, lineno)
+                    continue
+                self.apply(data, record)
+                n += 1
+        return n
+
+    def load(self) -> dict:
+        with self.lock:
+            return self._load()
+
+    def _load(self) -> dict:
+        try:
+            data = self.load_snapshot(self.snapshot_path)
+        except Exception:
+            logging.exception("Failed to load snapshot %s", self.snapshot_path)
+            data = self.empty()
+        replayed = self._replay(self.sealed_path, data)
+        self.pending = self._replay(self.journal_path, data)
+        if replayed or self.pending:
+            logging.info(
+                "Journal %s: replayed %d sealed + %d records",
+                self.journal_path, replayed, self.pending,
+            )
+        return data
+
+    # ---------- запись ----------
+    def _open(self) -> IO[str]:
+        if self._fh is None:
+            torn = False
+            if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > 0:
+                with open(self.journal_path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    torn = f.read(1) != b"\n"
+            self._fh = open(self.journal_path, "a", encoding="utf-8")
+            if torn:
+                # не склеиваем новую запись с оборванной строкой
+                self._fh.write("\n")
+        return self._fh
+
+    def append(self, record: Dict[str, Any]):
+        self.write_lines(dump_record(record), 1)
+
+    def write_lines(self, text: str, count: int) -> int:
+        if not count:
+            return 0
+        fh = self._open()
+        fh.write(text)
+        fh.flush()
+        self.pending += count
+        return len(text)
+
+    # ---------- буфер для фоновой записи ----------
+    def buffer(self, record: Dict[str, Any]):
+        self._buffer.append(dump_record(record))
+
+    def take_buffer(self) -> Tuple[str, int]:
+        lines, self._buffer = self._buffer, []
+        return "".join(lines), len(lines)
+
+    def restore_buffer(self, payload: Tuple[str, int]):
+        text, count = payload
+        if count:
+            self._buffer.insert(0, text)
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    # ---------- компактация ----------
+    def seal(self) -> bool:
+        # переименование дёшево; вызывать из того же потока, что и write_lines
+        if self.pending == 0 or os.path.exists(self.sealed_path):
+            return os.path.exists(self.sealed_path)
+        self.close()
+        if os.path.exists(self.journal_path):
+            os.replace(self.journal_path, self.sealed_path)
+        self.pending = 0
+        return True
+
+    def fold(self) -> int:
+        # сворачиваем снимок + sealed в новый снимок; возвращает размер снимка в байтах
+        if not os.path.exists(self.sealed_path):
+            return 0
+        data = self.load_snapshot(self.snapshot_path)
+        self._replay(self.sealed_path, data)
+        size = atomic_write_text(self.snapshot_path, self.dump_snapshot(data))
+        os.unlink(self.sealed_path)
+        return size
+
+    def compact(self) -> int:
+        with self.lock:
+            if self.seal():
+                return self.fold()
+            return 0
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+from typing import Dict, Any, Optional, List, Tuple, Callable, Sequence, Union
+
+# Границы по умолчанию (секунды): от быстрого хендлера до долгого ответа модели
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+Labels = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# ================== МЕТРИКИ ==================
+# У каждой метрики один пишущий поток (event loop или поток PersistenceWorker),
+# поэтому обновление — обычные операции над списком/словарём, без блокировок.
+# /metrics читает из event loop: samples() обходит копию словаря (list() под GIL),
+# иначе первая запись новой метки из другого потока рвала бы обход.
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in list(self._values.items())]
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [счётчики по корзинам (не накопленные) ..., +Inf, сумма]
+        self._series: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels: str) -> "_Timer":
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        out = []
+        for labels, series in list(self._series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                total += count
+                le = 'le="%s"' % _num(bound)
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {total}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_num(series[-1])}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {total}")
+        return out
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: Labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+class Observed:
+    """
+    Значение снимается только в момент запроса /metrics: размеры очередей и словарей,
+    счётчики из существующих stats — путь апдейта при этом не трогается.
+    fn() возвращает число или {значения меток (кортеж): число}.
+    """
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Union[float, Dict[Labels, float]]],
+                 type: str = "gauge", labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.type = type
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> List[str]:
+        value = self.fn()
+        if isinstance(value, dict):
+            return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in value.items()]
+        return [f"{self.name} {_num(value)}"]
+
+Metric = Union[Counter, Histogram, Observed]
+
+# ================== РЕЕСТР ==================
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name!r} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def observe(self, name: str, help: str, fn: Callable[[], Any], type: str = "gauge",
+                labelnames: Sequence[str] = ()) -> Observed:
+        return self.register(Observed(name, help, fn, type, labelnames))
+
+    def render(self) -> str:
+        # текстовый формат Prometheus 0.0.4
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception:
+                logging.exception("Metric %s failed", metric.name)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+def timed(histogram: Histogram, *labels: str):
+    # декоратор для async-хендлеров: время выполнения в histogram с метками labels
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+    return decorator
+
+# ================== HTTP ==================
+class MetricsServer:
+    """GET /metrics на локальном порту; отрисовка — в event loop, по запросу сборщика."""
+
+    def __init__(self, registry: Registry, listen: str, port: int):
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+        logging.info("Metrics on http://%s:%d/metrics", self.listen, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split(" ")
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                body = self.registry.render().encode("utf-8")
+                head = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            else:
+                body = b"not found\n"
+                head = "HTTP/1.1 404 Not Found\r\nContent-Type: text/plain\r\n"
+            writer.write(f"{head}Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Any, Optional, List, Tuple, Callable, Coroutine, Union, Deque
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from tracing import span
+
+# ================== ПРИОРИТЕТЫ ==================
+# Ответы пользователю (анкета, фото) всегда идут раньше рассылок.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BROADCAST = 1
+
+BROADCAST = {"priority": PRIORITY_BROADCAST}
+
+# Сколько ожидающих запросов просматриваем в полосе в поисках чата,
+# у которого уже есть токен (чтобы один «горячий» чат не блокировал очередь).
+SCAN_LIMIT = 64
+DRAIN_WINDOW_SECONDS = 10.0
+STATS_LOG_INTERVAL = 10.0
+
+# ================== TOKEN BUCKET ==================
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def drain(self, now: float):
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+# ================== OUTBOX ==================
+Waiter = Tuple[str, asyncio.Future, float]
+
+class Outbox(BaseRateLimiter[Dict[str, Any]]):
+    """
+    Очередь исходящих запросов к Bot API: общий лимит на бота, лимит на чат,
+    две полосы приоритета и повтор после RetryAfter.
+    Запросы без chat_id (getUpdates, setWebhook, ...) идут мимо очереди.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 25.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        group_rate: float = 20 / 60,
+        max_retries: int = 3,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[str, TokenBucket] = {}
+        self._lanes: Tuple[Deque[Waiter], Deque[Waiter]] = (deque(), deque())
+        self._paused_until = 0.0
+        self._event: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self._granted: Deque[float] = deque()
+        self._last_stats_log = 0.0
+        self.counters: Dict[str, int] = {"sent": 0, "retries": 0, "flood_waits": 0, "failed": 0}
+
+    # ---------- BaseRateLimiter ----------
+    async def initialize(self) -> None:
+        if self._task is None:
+            self._event = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # отпускаем всех, кто ещё ждёт, чтобы не зависнуть на остановке
+        for lane in self._lanes:
+            while lane:
+                _, fut, _ = lane.popleft()
+                if not fut.done():
+                    fut.set_result(None)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat_id = data.get("chat_id") if data else None
+        if chat_id is None or self._task is None:
+            with span(f"api:{endpoint}"):
+                return await callback(*args, **kwargs)
+
+        priority = PRIORITY_INTERACTIVE
+        if isinstance(rate_limit_args, dict):
+            priority = rate_limit_args.get("priority", PRIORITY_INTERACTIVE)
+        lane = self._lanes[PRIORITY_BROADCAST if priority >= PRIORITY_BROADCAST else PRIORITY_INTERACTIVE]
+
+        attempt = 0
+        while True:
+            with span("outbox_wait", endpoint=endpoint, attempt=attempt):
+                await self._acquire(str(chat_id), lane)
+            try:
+                with span(f"api:{endpoint}"):
+                    result = await callback(*args, **kwargs)
+                self.counters["sent"] += 1
+                return result
+            except RetryAfter as e:
+                attempt += 1
+                retry_after = float(getattr(e, "retry_after", 1) or 1)
+                self.counters["flood_waits"] += 1
+                self._pause(retry_after, str(chat_id))
+                if attempt > self.max_retries:
+                    self.counters["failed"] += 1
+                    raise
+                self.counters["retries"] += 1
+                logging.warning(
+                    "Outbox: RetryAfter %.1fs endpoint=%s chat_id=%s attempt=%d",
+                    retry_after, endpoint, chat_id, attempt,
+                )
+
+    # ---------- очередь ----------
+    async def _acquire(self, chat_key: str, lane: Deque[Waiter]):
+        fut = asyncio.get_running_loop().create_future()
+        lane.append((chat_key, fut, time.monotonic()))
+        self._event.set()
+        await fut
+
+    def _pause(self, seconds: float, chat_key: str):
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._global.drain(now)
+        self._chat_bucket(chat_key).drain(now)
+        if self._event is not None:
+            self._event.set()
+
+    def _chat_bucket(self, chat_key: str) -> TokenBucket:
+        bucket = self._chats.get(chat_key)
+        if bucket is None:
+            is_group = chat_key.startswith("-") or chat_key.startswith("@")
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chats[chat_key] = TokenBucket(rate, 1.0 if is_group else self.chat_burst)
+        return bucket
+
+    def _pick(self, now: float) -> Tuple[Optional[Waiter], float]:
+        # Возвращает (ожидающий, которому можно отправлять) или (None, сколько ждать)
+        # полоса рассылок получает токен, только если в интерактивной нет готовых
+        min_wait = float("inf")
+        for lane in self._lanes:
+            for i, waiter in enumerate(lane):
+                if i >= SCAN_LIMIT:
+                    break
+                chat_key, fut, _ = waiter
+                if fut.done():
+                    continue
+                wait = self._chat_bucket(chat_key).delay(now)
+                if wait <= 0:
+                    del lane[i]
+                    return waiter, 0.0
+                min_wait = min(min_wait, wait)
+        return None, min_wait
+
+    def _drop_done_heads(self):
+        for lane in self._lanes:
+            while lane and lane[0][1].done():
+                lane.popleft()
+
+    async def _dispatch_loop(self):
+        while True:
+            self._drop_done_heads()
+            if not (self._lanes[0] or self._lanes[1]):
+                self._maybe_log_stats()
+                self._prune_buckets()
+                self._event.clear()
+                await self._event.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            wait = self._global.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            waiter, wait = self._pick(now)
+            if waiter is None:
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), timeout=min(wait, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            chat_key, fut, _ = waiter
+            self._global.take(now)
+            self._chat_bucket(chat_key).take(now)
+            self._granted.append(now)
+            fut.set_result(None)
+            self._maybe_log_stats()
+
+    def _prune_buckets(self):
+        # простаивающие (полные) корзины чатов не нужны — создадим заново при надобности
+        if len(self._chats) < 10000:
+            return
+        now = time.monotonic()
+        for key in [k for k, b in self._chats.items() if b.is_full(now)]:
+            del self._chats[key]
+
+    # ---------- статистика ----------
+    def drain_rate(self) -> float:
+        cutoff = time.monotonic() - DRAIN_WINDOW_SECONDS
+        while self._granted and self._granted[0] < cutoff:
+            self._granted.popleft()
+        return len(self._granted) / DRAIN_WINDOW_SECONDS
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth_interactive": len(self._lanes[PRIORITY_INTERACTIVE]),
+            "depth_broadcast": len(self._lanes[PRIORITY_BROADCAST]),
+            "drain_rate": round(self.drain_rate(), 2),
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            **self.counters,
+        }
+
+    def _maybe_log_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats_log < STATS_LOG_INTERVAL:
+            return
+        self._last_stats_log = now
+        st = self.stats()
+        if st["depth_interactive"] or st["depth_broadcast"] or st["drain_rate"]:
+            logging.info("Outbox: %s", st)
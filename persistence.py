@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Tuple, Callable
+
+# ================== ФОНОВОЕ СОХРАНЕНИЕ ==================
+# Хендлеры только помечают данные «грязными» (mark_dirty). Воркер ждёт
+# interval_ms после первой пометки (или пока не наберётся max_pending изменений),
+# собирает данные в event loop (prepare — дёшево) и пишет их в отдельном потоке
+# (write — JSON-кодирование больших объёмов и файловый I/O).
+# Цель, у которой prepare или write упали, остаётся грязной и повторяется с паузой,
+# растущей вдвое (от interval до MAX_RETRY_SECONDS); stop() пробует всё сразу.
+
+MAX_RETRY_SECONDS = 60.0
+
+class _Target:
+    __slots__ = ("name", "prepare", "write", "restore")
+
+    def __init__(self, name, prepare, write, restore):
+        self.name = name
+        self.prepare = prepare
+        self.write = write
+        self.restore = restore
+
+class PersistenceWorker:
+    def __init__(self, interval_ms: int = 500, max_pending: int = 1000):
+        self.interval = interval_ms / 1000.0
+        self.max_pending = max_pending
+        self._targets: Dict[str, _Target] = {}
+        self._dirty: Dict[str, int] = {}
+        self._changes = 0
+        # name -> (неудач подряд, не раньше какого loop.time() повторять)
+        self._retry: Dict[str, Tuple[int, float]] = {}
+        self._event: Optional[asyncio.Event] = None
+        self._urgent: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        # один поток: записи никогда не пересекаются между собой
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self.stats: Dict[str, Any] = {
+            "marks": 0,
+            "flushes": 0,
+            "writes": 0,
+            "errors": 0,
+            "bytes": 0,
+            "last_flush_seconds": 0.0,
+        }
+        # on_write(name, seconds, bytes, ok) — вызывается в потоке воркера после каждой записи
+        self.on_write: Optional[Callable[[str, float, int, bool], None]] = None
+
+    def register(
+        self,
+        name: str,
+        prepare: Callable[[], Any],
+        write: Callable[[Any], Optional[int]],
+        restore: Optional[Callable[[Any], None]] = None,
+    ):
+        """
+        prepare() вызывается в event loop и должен быть дешёвым (снять копию/буфер).
+        write(payload) вызывается в потоке воркера, возвращает число записанных байт.
+        restore(payload) — вернуть payload обратно, если запись не удалась.
+        """
+        self._targets[name] = _Target(name, prepare, write, restore)
+
+    def mark_dirty(self, name: str):
+        self._dirty[name] = self._dirty.get(name, 0) + 1
+        self._changes += 1
+        self.stats["marks"] += 1
+        if self._event is not None:
+            self._event.set()
+            if self._changes >= self.max_pending:
+                self._urgent.set()
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._dirty)
+
+    # ---------- жизненный цикл ----------
+    def start(self):
+        if self._task is not None:
+            return
+        self._event = asyncio.Event()
+        self._urgent = asyncio.Event()
+        self._lock = asyncio.Lock()
+        if self._dirty:
+            self._event.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        await self.flush(force=True)
+        self._executor.shutdown(wait=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._event.wait()
+            deadline = loop.time() + self.interval
+            while self._changes < self.max_pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self._urgent.clear()
+                try:
+                    await asyncio.wait_for(self._urgent.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+            self._event.clear()
+            self._urgent.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Persistence flush failed")
+            delay = self._retry_delay(loop.time())
+            if delay is not None:
+                # грязными остались только цели в паузе после ошибки — ждём ближайший повтор
+                # (или новую пометку)
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    self._event.set()
+
+    def _retry_delay(self, now: float) -> Optional[float]:
+        if not self._dirty:
+            return None
+        waits = [self._retry.get(n, (0, 0.0))[1] - now for n in self._dirty]
+        return min(waits) if min(waits) > 0 else None
+
+    # ---------- сброс ----------
+    async def flush(self, force: bool = False):
+        # force — не ждать паузы после ошибок (последний сброс при остановке)
+        async with self._lock:
+            if not self._dirty:
+                return
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            names = [
+                n for n in self._targets
+                if n in self._dirty and (force or self._retry.get(n, (0, 0.0))[1] <= now)
+            ]
+            if not names:
+                return
+            for name in names:
+                del self._dirty[name]
+            self._changes = sum(self._dirty.values())
+
+            jobs: List[Tuple[_Target, Any]] = []
+            for name in names:
+                target = self._targets[name]
+                try:
+                    jobs.append((target, target.prepare()))
+                except Exception:
+                    logging.exception("Persistence prepare failed: %s", name)
+                    self._failed(name)
+
+            started = time.perf_counter()
+            failed = await loop.run_in_executor(self._executor, self._write_all, jobs)
+            self.stats["last_flush_seconds"] = time.perf_counter() - started
+            self.stats["flushes"] += 1
+
+            failed_names = set()
+            for target, payload in failed:
+                if target.restore is not None:
+                    target.restore(payload)
+                self._failed(target.name)
+                failed_names.add(target.name)
+            for target, _ in jobs:
+                if target.name not in failed_names:
+                    self._retry.pop(target.name, None)
+
+    def _failed(self, name: str):
+        self.stats["errors"] += 1
+        failures = self._retry.get(name, (0, 0.0))[0] + 1
+        delay = min(self.interval * 2 ** failures, MAX_RETRY_SECONDS)
+        self._retry[name] = (failures, asyncio.get_running_loop().time() + delay)
+        self.mark_dirty(name)
+
+    def _write_all(self, jobs: List[Tuple[_Target, Any]]) -> List[Tuple[_Target, Any]]:
+        failed = []
+        for target, payload in jobs:
+            started = time.perf_counter()
+            written, ok = 0, True
+            try:
+                written = target.write(payload) or 0
+                self.stats["writes"] += 1
+                self.stats["bytes"] += written
+            except Exception:
+                logging.exception("Persistence write failed: %s", target.name)
+                failed.append((target, payload))
+                ok = False
+            if self.on_write is not None:
+                self.on_write(target.name, time.perf_counter() - started, written, ok)
+        return failed
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from imaging import hamming
+from journal import atomic_write_text, read_json_file
+
+# ================== КЕШ АНАЛИЗА ФОТО ==================
+class AnalysisCache:
+    """
+    Кеш результатов analyze_food_image.
+    Ключ 1 — file_unique_id (проверяется до скачивания файла),
+    ключ 2 — перцептивный хеш (dhash) для почти одинаковых фото.
+    LRU по file_unique_id + TTL; опционально сохраняется на диск.
+    """
+
+    def __init__(self, capacity: int = 1000, ttl: float = 7 * 24 * 3600,
+                 max_distance: int = 6, path: Optional[str] = None, log_every: int = 50):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.path = path
+        self.log_every = log_every
+        # uid -> {"result": dict, "phash": int|None, "created": ts, "latency": seconds}
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.stats: Dict[str, float] = {"hits_uid": 0, "hits_phash": 0, "misses": 0, "saved_seconds": 0.0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _alive(self, entry: Dict[str, Any], now: float) -> bool:
+        return now - entry["created"] < self.ttl
+
+    def _hit(self, kind: str, entry: Dict[str, Any]) -> Dict[str, Any]:
+        self.stats[kind] += 1
+        self.stats["saved_seconds"] += entry.get("latency", 0.0)
+        self._maybe_log()
+        return entry["result"]
+
+    def get_by_uid(self, uid: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(uid)
+        if entry is None:
+            return None
+        if not self._alive(entry, time.time()):
+            del self._entries[uid]
+            return None
+        self._entries.move_to_end(uid)
+        return self._hit("hits_uid", entry)
+
+    def get_by_hash(self, phash: Optional[int]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        if phash is None:
+            return None
+        now = time.time()
+        best_uid, best_distance = None, self.max_distance + 1
+        # линейный проход: записей не больше capacity, сравнение — один XOR
+        for uid, entry in self._entries.items():
+            h = entry.get("phash")
+            if h is None or not self._alive(entry, now):
+                continue
+            distance = hamming(h, phash)
+            if distance < best_distance:
+                best_uid, best_distance = uid, distance
+                if distance == 0:
+                    break
+        if best_uid is None:
+            return None
+        self._entries.move_to_end(best_uid)
+        return best_uid, self._hit("hits_phash", self._entries[best_uid])
+
+    def miss(self):
+        self.stats["misses"] += 1
+        self._maybe_log()
+
+    def put(self, uid: str, phash: Optional[int], result: Dict[str, Any], latency: float):
+        self._entries[uid] = {"result": result, "phash": phash, "created": time.time(), "latency": latency}
+        self._entries.move_to_end(uid)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def alias(self, uid: str, source_uid: str):
+        # новый file_unique_id для уже известного (почти такого же) фото
+        source = self._entries.get(source_uid)
+        if source is not None:
+            self.put(uid, source.get("phash"), source["result"], source.get("latency", 0.0))
+
+    # ---------- статистика ----------
+    def hit_ratio(self) -> float:
+        hits = self.stats["hits_uid"] + self.stats["hits_phash"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def _maybe_log(self):
+        total = self.stats["hits_uid"] + self.stats["hits_phash"] + self.stats["misses"]
+        if self.log_every and total % self.log_every == 0:
+            logging.info("Photo cache: size=%d hit_ratio=%.2f %s", len(self), self.hit_ratio(), self.stats)
+
+    # ---------- диск ----------
+    def load(self):
+        if not self.path:
+            return
+        try:
+            data = read_json_file(self.path)
+        except Exception:
+            logging.exception("Failed to load %s", self.path)
+            return
+        now = time.time()
+        for uid, entry in data.get("entries", []):
+            if self._alive(entry, now):
+                self._entries[uid] = entry
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def dump(self) -> str:
+        return json.dumps({"entries": list(self._entries.items())}, ensure_ascii=False, separators=(",", ":"))
+
+    def save(self, text: str) -> int:
+        return atomic_write_text(self.path, text)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Any, Optional, List, Tuple, Callable, Awaitable, Deque
+
+Job = Callable[[], Awaitable[None]]
+
+# ================== ОЧЕРЕДЬ АНАЛИЗА ФОТО ==================
+class PhotoJobQueue:
+    """
+    Пул воркеров перед analyze_food_image.
+    - у одного чата в работе не больше одной задачи, остальные ждут по порядку;
+    - чаты обслуживаются по кругу: альбом из 10 фото не занимает все воркеры;
+    - общий лимит глубины (в очереди + в работе) и лимит на чат: сверх — отказ.
+    """
+
+    def __init__(self, workers: int = 4, max_depth: int = 200, max_per_chat: int = 10, log_every: int = 50):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_per_chat = max_per_chat
+        self.log_every = log_every
+        # chat_id в _pending <=> чат стоит в _ready или его задача сейчас выполняется
+        self._pending: Dict[int, Deque[Tuple[Job, float]]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.depth = 0
+        self.running = 0
+        self.stats: Dict[str, float] = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "wait_s": 0.0,
+            "service_s": 0.0,
+            "max_wait_s": 0.0,
+        }
+
+    def start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        # задачи, пришедшие до старта
+        for chat_id in self._pending:
+            self._ready.put_nowait(chat_id)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def queued(self) -> int:
+        # depth считает и выполняющиеся задачи, здесь — только ждущие воркера
+        return self.depth - self.running
+
+    def submit(self, chat_id: int, job: Job) -> bool:
+        queue = self._pending.get(chat_id)
+        if self.depth >= self.max_depth or (queue is not None and len(queue) >= self.max_per_chat):
+            self.stats["rejected"] += 1
+            return False
+        self.stats["submitted"] += 1
+        self.depth += 1
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+            queue.append((job, time.perf_counter()))
+            if self._ready is not None:
+                self._ready.put_nowait(chat_id)
+        else:
+            queue.append((job, time.perf_counter()))
+        return True
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            queue = self._pending[chat_id]
+            job, submitted = queue.popleft()
+
+            started = time.perf_counter()
+            wait = started - submitted
+            self.running += 1
+            try:
+                await job()
+                self.stats["completed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.stats["failed"] += 1
+                logging.exception("Photo job failed chat_id=%s", chat_id)
+            finally:
+                self.running -= 1
+                self.depth -= 1
+                self.stats["wait_s"] += wait
+                self.stats["service_s"] += time.perf_counter() - started
+                self.stats["max_wait_s"] = max(self.stats["max_wait_s"], wait)
+                # следующая задача чата встаёт в конец общей очереди — по кругу
+                if queue:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._pending[chat_id]
+                self._maybe_log()
+
+    def summary(self) -> Dict[str, Any]:
+        done = (self.stats["completed"] + self.stats["failed"]) or 1
+        return {
+            "depth": self.depth,
+            "running": self.running,
+            "chats_waiting": len(self._pending),
+            "avg_wait_s": round(self.stats["wait_s"] / done, 3),
+            "avg_service_s": round(self.stats["service_s"] / done, 3),
+            **{k: self.stats[k] for k in ("submitted", "rejected", "completed", "failed", "max_wait_s")},
+        }
+
+    def _maybe_log(self):
+        done = self.stats["completed"] + self.stats["failed"]
+        if self.log_every and done % self.log_every == 0:
+            logging.info("Photo queue: %s", self.summary())
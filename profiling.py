@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Any, Optional
+
+from journal import atomic_write_text
+
+# ================== СЭМПЛИРУЮЩИЙ ПРОФАЙЛЕР ==================
+class SamplingProfiler:
+    """
+    Профайлер без зависимостей для работающего бота: отдельный поток раз в interval
+    снимает стеки всех потоков (sys._current_frames) и считает одинаковые стеки.
+    Результат — «свёрнутые» стеки (folded: `поток;f1;f2;f3 N` на строку), их понимают
+    flamegraph.pl, speedscope и inferno. Останавливать — stop(), он же пишет файл.
+
+    Корутины, которые сейчас выполняются, видны в стеке потока event loop;
+    ожидание сети и таймеров выглядит как select() внутри run_forever.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._stacks: Counter = Counter()
+        self._samples = 0
+        self._started = 0.0
+        self._labels: Dict[Any, str] = {}  # code -> «функция (файл:строка)»
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> bool:
+        if self._thread is not None:
+            return False
+        self._stop.clear()
+        self._stacks = Counter()
+        self._samples = 0
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, path: str) -> Dict[str, Any]:
+        # блокирует до остановки потока — вызывать через asyncio.to_thread
+        thread = self._thread
+        if thread is None:
+            return {}
+        self._stop.set()
+        thread.join()
+        self._thread = None
+        elapsed = time.perf_counter() - self._started
+        lines = [f"{stack} {count}" for stack, count in self._stacks.most_common()]
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        atomic_write_text(path, "\n".join(lines) + "\n")
+        result = {"path": path, "seconds": round(elapsed, 2), "samples": self._samples, "stacks": len(lines)}
+        logging.info("Profile written: %s", result)
+        return result
+
+    def top(self, n: int = 10) -> Dict[str, float]:
+        # доля сэмплов, где функция на вершине стека (self time)
+        leaf: Counter = Counter()
+        for stack, count in self._stacks.items():
+            leaf[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaf.values()) or 1
+        return {name: round(count / total, 3) for name, count in leaf.most_common(n)}
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                parts = []
+                while frame is not None and len(parts) < self.max_depth:
+                    parts.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                parts.append(names.get(ident, str(ident)))
+                parts.reverse()
+                self._stacks[";".join(parts)] += 1
+            self._samples += 1
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from flows import Choice, FreeText, Number, ask, compile_flow
+
+# ================== ВАРИАНТЫ ОТВЕТОВ ==================
+YES_NO = Choice([["да", "нет"]])
+SCALE_0_5 = Choice([[str(i) for i in range(0, 6)]])
+
+STOOL_FREQ = Choice([
+    ["2–3 раза в сутки", "1 раз в сутки"],
+    ["1 раз в 1–2 дня", "1 раз в 2–3 дня", "1 раз в 3–5 дней"],
+])
+
+STOOL_TYPE = Choice([
+    ["оформленный, нормальный"],
+    ["твёрдый", "жидкий"],
+    ["иногда твёрдый, иногда жидкий", "чередуется"],
+])
+
+CYCLE = Choice([["я мужчина", "я женщина, цикла нет"], ["регулярный", "нерегулярный"]])
+APPETITE = Choice([["нормальный", "повышенный", "пониженный"]])
+ACTIVITY = Choice([["нет", "1–2 раза в неделю", "3 и более раз в неделю"]])
+
+CHECKIN_DAY_RESULT = Choice([["Отлично", "Нормально", "Плохо"]])
+CHECKIN_STATUS = Choice([["Хорошо", "Нормально", "Плохо"]])
+
+HEIGHT_CM = Number(100, 250)
+WEIGHT_KG = Number(30, 300)
+GIRTH_CM = Number(40, 200)
+STEPS = Number(0, 100000, integer=True)
+
+# ================== АНКЕТА ==================
+QUESTIONS = [
+    ask("height_cm", "Ваш рост (см):", HEIGHT_CM),
+    ask("weight_kg", "Ваш вес (кг):", WEIGHT_KG),
+    ask("chest_cm", "Окружность груди (см):", GIRTH_CM),
+    ask("waist_cm", "Окружность талии (см):", GIRTH_CM),
+    ask("hips_cm", "Окружность бёдер (см):", GIRTH_CM),
+    ask("stool_frequency", "Как часто у вас бывает стул?", STOOL_FREQ),
+    ask("stool_type", "Какой стул бывает чаще всего?", STOOL_TYPE),
+    ask("cycle_status", "Менструальный цикл?", CYCLE),
+    ask("energy_level", "Оцените уровень энергии (0–5, где 0-Низкая 5-Все супер):", SCALE_0_5),
+    ask("stress_level", "Оцените уровень стресса (0–5, где 0-Много стресса 5-Все супер):", SCALE_0_5),
+    ask("sleep_quality", "Оцените качество сна (0–5, где 0-Плохо сплю 5-Все супер):", SCALE_0_5),
+    ask("focus_issues", "Снижение концентрации внимания?", YES_NO),
+    ask("irritability_day", "Дневная раздражительность?", YES_NO),
+    ask("sleepiness_day", "Дневная сонливость?", YES_NO),
+    ask("appetite_level", "Какой аппетит вам больше подходит?", APPETITE),
+    ask("sweet_craving", "Есть ли тяга к сладкому?", YES_NO),
+    ask("fat_craving", "Есть ли тяга к жирному?", YES_NO),
+    ask("palpitations", "Одышка или учащённое сердцебиение?", YES_NO),
+    ask("cold_hands_feet", "Зябкость рук и ног?", YES_NO),
+    ask("skin_itch", "Кожный зуд?", YES_NO),
+    ask("blue_sclera", "Голубоватый оттенок склер?", YES_NO),
+    ask("headache", "Беспокоит ли вас головная боль?", YES_NO),
+    ask("oily_skin", "Жирность кожи лица?", YES_NO),
+    ask("dry_skin", "Сухость кожи лица?", YES_NO),
+    ask("low_libido", "Сниженное либидо?", YES_NO),
+    ask("vaginal_itch", "Вагинальный зуд (для женщин)?", YES_NO),
+    ask("joint_pain", "Боли в суставах?", YES_NO),
+    ask("abdominal_pain", "Боли или спазмы в животе?", YES_NO),
+    ask("bloating", "Повышенное газообразование?", YES_NO),
+    ask("hair_loss", "Выпадение волос?", YES_NO),
+    ask("dry_mouth", "Сухость во рту?", YES_NO),
+    ask("steps_daily", "Сколько шагов в среднем в день?", STEPS),
+    ask("activity_level", "Есть ли дополнительная физическая активность?", ACTIVITY),
+]
+
+# ================== ЧЕК-ИНЫ ==================
+MORNING_CHECKIN_QUESTIONS = [
+    ask("sleep_quality", "🌅 Доброе утро! Быстрый чек-ин.\n\nКак вы спали?", CHECKIN_STATUS),
+    ask("energy_level", "⚡ Энергия сейчас?", CHECKIN_STATUS),
+]
+
+DAY_CHECKIN_QUESTIONS = [
+    ask("wellbeing", "🏙 Дневной чек-ин.\n\nКак самочувствие сейчас?", CHECKIN_STATUS),
+    ask("energy_level", "⚡ Энергия сейчас?", CHECKIN_STATUS),
+]
+
+EVENING_CHECKIN_QUESTIONS = [
+    ask("day_result", "🌙 Вечерний итог дня.\n\nКак прошёл день?", CHECKIN_DAY_RESULT),
+    ask("sleep_plan", "😴 Во сколько планируете лечь спать?", FreeText(), remove_keyboard=False),
+]
+
+# ================== СБОРКА ==================
+# собирается один раз при импорте: таблица шагов + готовые клавиатуры
+SURVEY = compile_flow("survey", QUESTIONS)
+CHECKIN_FLOWS = {
+    "morning": compile_flow(
+        "morning", MORNING_CHECKIN_QUESTIONS, "Ответы записаны ✅\n\n💧 Напоминаю выпить воды."
+    ),
+    "day": compile_flow(
+        "day", DAY_CHECKIN_QUESTIONS, "Ответы записаны ✅\n\n🌤 Желаю хорошего дня."
+    ),
+    "evening": compile_flow(
+        "evening", EVENING_CHECKIN_QUESTIONS, "Ответы записаны ✅\n\n😴 Напоминаю лечь спать пораньше."
+    ),
+}
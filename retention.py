@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import List
+
+from compact import CheckinHistory, CheckinDays, COMPACT_FORMAT
+
+MONTH_FILE_RE = re.compile(r"^checkins-(\d{4}-\d{2})\.json\.gz$")
+
+# ================== АРХИВ ПО МЕСЯЦАМ ==================
+class CheckinArchive:
+    """
+    Холодная история чек-инов: один gzip-файл на месяц (компактный формат CheckinHistory).
+    Пишет поток PersistenceWorker; читается лениво — только запросами за старые даты,
+    последние прочитанные месяцы держатся в небольшом кеше.
+    """
+
+    def __init__(self, directory: str, cache_months: int = 2):
+        self.directory = directory
+        self.cache_months = cache_months
+        self._cache: "OrderedDict[str, CheckinHistory]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"months_loaded": 0, "months_written": 0, "days_archived": 0}
+
+    def path(self, month: str) -> str:
+        return os.path.join(self.directory, f"checkins-{month}.json.gz")
+
+    def months(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(m.group(1) for m in map(MONTH_FILE_RE.match, os.listdir(self.directory)) if m)
+
+    def _read(self, month: str) -> CheckinHistory:
+        path = self.path(month)
+        if not os.path.exists(path):
+            return CheckinHistory()
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format") == COMPACT_FORMAT:
+            return CheckinHistory.from_compact(data)
+        return CheckinHistory.from_json(data)
+
+    def _write(self, month: str, history: CheckinHistory):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(month)
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(json.dumps(history.to_compact(), ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    # ---------- запись (поток воркера) ----------
+    def absorb(self, old: CheckinHistory) -> int:
+        # дописывает старые дни в файлы их месяцев; возвращает число затронутых месяцев
+        parts = old.by_month()
+        for month, part in parts.items():
+            history = self._read(month)
+            history.merge(part)
+            self._write(month, history)
+            with self._lock:
+                self._cache.pop(month, None)
+            self.stats["months_written"] += 1
+            self.stats["days_archived"] += sum(len(part.chat_json(c)) for c in part.chats())
+        return len(parts)
+
+    # ---------- чтение ----------
+    def _month(self, month: str) -> CheckinHistory:
+        with self._lock:
+            history = self._cache.get(month)
+            if history is not None:
+                self._cache.move_to_end(month)
+                return history
+        history = self._read(month)
+        self.stats["months_loaded"] += 1
+        logging.info("Archive month %s loaded (%d chats)", month, len(history))
+        with self._lock:
+            self._cache[month] = history
+            while len(self._cache) > self.cache_months:
+                self._cache.popitem(last=False)
+        return history
+
+    def get_range(self, chat_key: str, start: date, end: date) -> CheckinDays:
+        result: CheckinDays = {}
+        if start > end:
+            return result
+        lo, hi = start.isoformat()[:7], end.isoformat()[:7]
+        for month in self.months():
+            if lo <= month <= hi:
+                result.update(self._month(month).get_range(chat_key, start, end))
+        return result
+
+    def read_range(self, start: date, end: date) -> List[CheckinHistory]:
+        # месяцы диапазона по отдельности и мимо кеша — для разовых выборок по всем чатам
+        lo, hi = start.isoformat()[:7], end.isoformat()[:7]
+        return [self._read(month) for month in self.months() if lo <= month <= hi]
+
+    def load_all(self) -> CheckinHistory:
+        # весь архив разом — для миграции/выгрузки
+        history = CheckinHistory()
+        for month in self.months():
+            history.merge(self._read(month))
+        return history
+
+def merge_days(older: CheckinDays, newer: CheckinDays) -> CheckinDays:
+    # поля newer перекрывают поля older за тот же день
+    for d, day in newer.items():
+        target = older.setdefault(d, {})
+        for checkin_type, fields in day.items():
+            target.setdefault(checkin_type, {}).update(fields)
+    return dict(sorted(older.items()))
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+import logging
+import re
+import time
+from datetime import datetime, timedelta, timezone, tzinfo
+from typing import Dict, Any, Optional, List, Tuple, Set, Callable, Awaitable, Iterable
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # pragma: no cover
+    ZoneInfo = None
+
+# ================== СЛОТЫ ==================
+# slot -> (weekday или None для ежедневных, hour, minute); weekday: 0=Mon ... 6=Sun
+DEFAULT_SLOTS: Dict[str, Tuple[Optional[int], int, int]] = {
+    "morning": (None, 9, 30),
+    "day": (None, 15, 0),
+    "evening": (None, 20, 0),
+    "weekly": (6, 21, 0),
+}
+DEFAULT_TZ = "+03:00"  # МСК
+
+# Ограничиваем сон, чтобы переводы системных часов не сбивали расписание надолго
+MAX_SLEEP_SECONDS = 60.0
+# Слот, опоздавший больше чем на это (стоп цикла, сон VM, скачок часов), не отправляется:
+# утренний чек-ин вечером только мешает
+MISSED_GRACE_SECONDS = 2 * 3600.0
+
+_OFFSET_RE = re.compile(r"^(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?$", re.IGNORECASE)
+
+# ================== ЧАСОВЫЕ ПОЯСА ==================
+def normalize_tz(value: Any) -> Optional[str]:
+    """
+    Принимает "+3", "+03:00", "UTC-5", "-0530" или IANA-имя ("Europe/Moscow").
+    Возвращает каноническую строку или None, если пояс не распознан.
+    """
+    if value is None:
+        return None
+    s = str(value).strip()
+    m = _OFFSET_RE.match(s)
+    if m:
+        sign, hh, mm = m.group(1), int(m.group(2)), int(m.group(3) or 0)
+        if hh > 14 or mm >= 60:
+            return None
+        return f"{sign}{hh:02d}:{mm:02d}"
+    if ZoneInfo is not None and "/" in s:
+        try:
+            ZoneInfo(s)
+            return s
+        except Exception:
+            return None
+    return None
+
+_tz_cache: Dict[str, tzinfo] = {}
+
+def parse_tz(value: Any) -> tzinfo:
+    key = normalize_tz(value) or DEFAULT_TZ
+    tz = _tz_cache.get(key)
+    if tz is None:
+        if key[0] in "+-":
+            sign = 1 if key[0] == "+" else -1
+            tz = timezone(sign * timedelta(hours=int(key[1:3]), minutes=int(key[4:6])))
+        else:
+            tz = ZoneInfo(key)
+        _tz_cache[key] = tz
+    return tz
+
+def parse_hhmm(value: str) -> Optional[Tuple[int, int]]:
+    m = re.match(r"^(\d{1,2})[:.](\d{2})$", (value or "").strip())
+    if not m:
+        return None
+    hour, minute = int(m.group(1)), int(m.group(2))
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+def next_occurrence(after: datetime, tz: tzinfo, weekday: Optional[int], hour: int, minute: int) -> datetime:
+    """
+    Ближайший момент строго после `after` в локальном времени пояса tz.
+    weekday: None — каждый день, иначе 0=Mon ... 6=Sun
+    """
+    n = after.astimezone(tz)
+    run = n.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if weekday is not None:
+        run += timedelta(days=(weekday - n.weekday()) % 7)
+    if run <= n:
+        run += timedelta(days=1 if weekday is None else 7)
+    return run
+
+# ================== ПЛАНИРОВЩИК ==================
+# Группа — все чаты с одинаковым (slot, tz, weekday, hour, minute).
+# В куче лежит одна запись на группу, а не на чат: при N подписчиках
+# с настройками по умолчанию в куче всего 4 записи.
+GroupKey = Tuple[str, str, Optional[int], int, int]
+# Расписание чата целиком: (tz, переопределённые слоты ((slot, hour, minute), ...)).
+# У большинства чатов оно одно и то же — индекс хранит чаты по расписаниям, а не наоборот.
+Signature = Tuple[str, Tuple[Tuple[str, int, int], ...]]
+SCHEDULE_INDEX_FORMAT = "schedule-index/1"
+
+class CheckinScheduler:
+    def __init__(
+        self,
+        fire: Callable[[str, List[int], float], Awaitable[None]],
+        slots: Optional[Dict[str, Tuple[Optional[int], int, int]]] = None,
+        default_tz: str = DEFAULT_TZ,
+        grace: float = MISSED_GRACE_SECONDS,
+    ):
+        self._fire = fire
+        self.grace = grace
+        self.slots = dict(slots or DEFAULT_SLOTS)
+        self.default_tz = default_tz
+        self._groups: Dict[GroupKey, Set[int]] = {}
+        self._chat_sig: Dict[int, Signature] = {}
+        self._sig_members: Dict[Signature, Set[int]] = {}
+        self._heap: List[Tuple[float, int, GroupKey]] = []
+        self._armed: Set[GroupKey] = set()
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._inflight: Set[asyncio.Task] = set()
+        self.stats: Dict[str, Any] = {
+            "firings": 0,
+            "chats_fired": 0,
+            "last_lag": 0.0,
+            "max_lag": 0.0,
+            "skipped": 0,
+        }
+
+    # ---------- регистрация чатов ----------
+    def signature(self, tz: Any = None, times: Optional[Dict[str, str]] = None) -> Signature:
+        tz_key = normalize_tz(tz) or self.default_tz
+        overrides = []
+        for slot, value in sorted((times or {}).items()):
+            hm = parse_hhmm(value) if slot in self.slots else None
+            if hm:
+                overrides.append((slot, hm[0], hm[1]))
+        return tz_key, tuple(overrides)
+
+    def _keys(self, sig: Signature) -> List[GroupKey]:
+        tz_key, overrides = sig
+        custom = {slot: (hour, minute) for slot, hour, minute in overrides}
+        keys = []
+        for slot, (weekday, hour, minute) in self.slots.items():
+            hour, minute = custom.get(slot, (hour, minute))
+            keys.append((slot, tz_key, weekday, hour, minute))
+        return keys
+
+    def _add(self, sig: Signature, chat_ids: Iterable[int]):
+        chat_ids = set(chat_ids)
+        now = time.time()
+        for key in self._keys(sig):
+            self._groups.setdefault(key, set()).update(chat_ids)
+            if key not in self._armed:
+                self._arm(key, now)
+        self._sig_members.setdefault(sig, set()).update(chat_ids)
+        for chat_id in chat_ids:
+            self._chat_sig[chat_id] = sig
+
+    def schedule_chat(self, chat_id: int, tz: Any = None, times: Optional[Dict[str, str]] = None):
+        self.unschedule_chat(chat_id)
+        self._add(self.signature(tz, times), (chat_id,))
+
+    def unschedule_chat(self, chat_id: int):
+        sig = self._chat_sig.pop(chat_id, None)
+        if sig is None:
+            return
+        members = self._sig_members[sig]
+        members.discard(chat_id)
+        if not members:
+            del self._sig_members[sig]
+        for key in self._keys(sig):
+            members = self._groups.get(key)
+            if members is not None:
+                members.discard(chat_id)
+                # запись в куче для пустой группы снимется лениво при срабатывании
+                if not members:
+                    del self._groups[key]
+
+    def is_scheduled(self, chat_id: int) -> bool:
+        return chat_id in self._chat_sig
+
+    def __len__(self) -> int:
+        return len(self._chat_sig)
+
+    # ---------- компактный индекс ----------
+    # {"format": ..., "meta": {...}, "groups": [[tz, [[slot, hour, minute], ...], [chat_id, ...]], ...]} —
+    # при старте группы поднимаются целиком, без чтения настроек каждого чата.
+    # meta — параметры, при которых индекс собран (например, кольцо шардов): не совпали — пересборка.
+    def index(self, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        return {
+            "format": SCHEDULE_INDEX_FORMAT,
+            "meta": meta or {},
+            "groups": [
+                [tz_key, [list(o) for o in overrides], sorted(members)]
+                for (tz_key, overrides), members in self._sig_members.items()
+            ],
+        }
+
+    def load_index(self, data: Dict[str, Any], meta: Optional[Dict[str, Any]] = None,
+                   keep: Optional[Callable[[int], bool]] = None) -> int:
+        # возвращает число чатов; индекс другого формата или с другими meta — ValueError
+        # (тогда пересборка из хранилища); keep — какие чаты из индекса брать (свои для шарда)
+        if data.get("format") != SCHEDULE_INDEX_FORMAT:
+            raise ValueError(f"unknown schedule index format: {data.get('format')!r}")
+        if data.get("meta", {}) != (meta or {}):
+            raise ValueError(f"schedule index built for {data.get('meta')!r}, expected {meta!r}")
+        for tz_key, overrides, chat_ids in data.get("groups", []):
+            if keep is not None:
+                chat_ids = [c for c in chat_ids if keep(c)]
+                if not chat_ids:
+                    continue
+            times = {slot: f"{hour:02d}:{minute:02d}" for slot, hour, minute in overrides}
+            sig = self.signature(tz_key, times)
+            for chat_id in chat_ids:
+                if chat_id in self._chat_sig:
+                    self.unschedule_chat(chat_id)
+            self._add(sig, chat_ids)
+        return len(self._chat_sig)
+
+    def _arm(self, key: GroupKey, after_ts: float):
+        _, tz_key, weekday, hour, minute = key
+        after = datetime.fromtimestamp(after_ts, tz=timezone.utc)
+        due = next_occurrence(after, parse_tz(tz_key), weekday, hour, minute).timestamp()
+        self._seq += 1
+        became_first = not self._heap or due < self._heap[0][0]
+        heapq.heappush(self._heap, (due, self._seq, key))
+        self._armed.add(key)
+        if became_first and self._wakeup is not None:
+            self._wakeup.set()
+
+    # ---------- основной цикл ----------
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        logging.info("Scheduler started: %d chats, %d groups", len(self._chat_sig), len(self._groups))
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(delay, MAX_SLEEP_SECONDS))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, key = heapq.heappop(self._heap)
+                self._armed.discard(key)
+                members = self._groups.get(key)
+                if not members:
+                    continue
+                # от max(due, now): после долгого простоя пропущенные повторы не стреляют подряд
+                self._arm(key, max(due, now))
+                lag = now - due
+                if lag > self.grace:
+                    self.stats["skipped"] += 1
+                    logging.warning("Scheduler skipped slot=%s chats=%d lag=%.0fs", key[0], len(members), lag)
+                    continue
+                self._dispatch(key[0], sorted(members), lag)
+
+    def _dispatch(self, slot: str, chat_ids: List[int], lag: float):
+        self.stats["firings"] += 1
+        self.stats["chats_fired"] += len(chat_ids)
+        self.stats["last_lag"] = lag
+        self.stats["max_lag"] = max(self.stats["max_lag"], lag)
+        logging.info("Scheduler fired slot=%s chats=%d lag=%.3fs", slot, len(chat_ids), lag)
+
+        task = asyncio.create_task(self._safe_fire(slot, chat_ids, lag))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _safe_fire(self, slot: str, chat_ids: List[int], lag: float):
+        try:
+            await self._fire(slot, chat_ids, lag)
+        except Exception:
+            logging.exception("Scheduler fan-out failed slot=%s", slot)
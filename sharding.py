@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Any, Optional, List, Tuple, Callable, Awaitable, Sequence
+
+import httpx
+
+# ================== КОНСИСТЕНТНОЕ ХЕШИРОВАНИЕ ==================
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """
+    Кольцо шардов с виртуальными узлами: чат принадлежит первому узлу по часовой стрелке.
+    При смене числа шардов N -> N+1 переезжает ~1/(N+1) чатов, остальные остаются на месте.
+    """
+
+    def __init__(self, shard_count: int, vnodes: int = 64):
+        if shard_count < 1:
+            raise ValueError("shard_count must be >= 1")
+        self.shard_count = shard_count
+        points = sorted(
+            (_hash(f"shard-{shard}#{v}"), shard)
+            for shard in range(shard_count)
+            for v in range(vnodes)
+        )
+        self._keys = [p for p, _ in points]
+        self._shards = [s for _, s in points]
+
+    def owner(self, chat_id: int) -> int:
+        if self.shard_count == 1:
+            return 0
+        i = bisect.bisect(self._keys, _hash(str(chat_id)))
+        return self._shards[i % len(self._shards)]
+
+def shard_path(path: str, shard: int) -> str:
+    # bot.db -> bot.shard-2.db: у каждого воркера своя база
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard}{ext}"
+
+# ================== ПРИЁМ АПДЕЙТОВ В ВОРКЕРЕ ==================
+SECRET_HEADER = "x-shard-secret"
+
+class ShardServer:
+    """
+    Минимальный HTTP-сервер воркера: POST /updates с JSON-массивом апдейтов.
+    Держит keep-alive соединения от ingress; ответ 200 — апдейты поставлены в очередь.
+    """
+
+    def __init__(self, listen: str, port: int, secret: str,
+                 on_updates: Callable[[List[Dict[str, Any]]], Awaitable[None]]):
+        self.listen = listen
+        self.port = port
+        self.secret = secret
+        self.on_updates = on_updates
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.stats = {"requests": 0, "updates": 0, "rejected": 0}
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+        logging.info("Shard server listening on %s:%d", self.listen, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                status = await self._dispatch(method, path, headers, body)
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n\r\n".encode())
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> str:
+        if method != "POST" or path != "/updates":
+            return "404 Not Found"
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, ""), self.secret):
+            self.stats["rejected"] += 1
+            return "403 Forbidden"
+        try:
+            updates = json.loads(body)
+        except ValueError:
+            return "400 Bad Request"
+        self.stats["requests"] += 1
+        self.stats["updates"] += len(updates)
+        await self.on_updates(updates)
+        return "200 OK"
+
+# ================== МАРШРУТИЗАЦИЯ В INGRESS ==================
+class ShardRouter:
+    """
+    Ingress: апдейт уходит в очередь воркера-владельца чата.
+    На каждый воркер — одна очередь и одна задача-отправитель, поэтому порядок
+    апдейтов внутри чата сохраняется; отправка пачками, при ошибке — повтор той же пачки.
+    """
+
+    def __init__(self, worker_urls: Sequence[str], secret: str, vnodes: int = 64,
+                 batch_size: int = 100, retry_delay: float = 1.0):
+        self.worker_urls = [u.rstrip("/") for u in worker_urls]
+        self.ring = HashRing(len(self.worker_urls), vnodes)
+        self.secret = secret
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._http: Optional[httpx.AsyncClient] = None
+        self.stats: Dict[str, float] = {"routed": 0, "sent": 0, "batches": 0, "retries": 0}
+
+    def start(self):
+        if self._tasks:
+            return
+        self._http = httpx.AsyncClient(
+            headers={SECRET_HEADER: self.secret},
+            limits=httpx.Limits(max_connections=len(self.worker_urls) * 2),
+            timeout=httpx.Timeout(10, connect=5),
+        )
+        self._queues = [asyncio.Queue() for _ in self.worker_urls]
+        self._tasks = [asyncio.create_task(self._sender(i)) for i in range(len(self.worker_urls))]
+
+    async def stop(self, drain_timeout: float = 5.0):
+        # даём отправителям дослать очередь, затем останавливаем
+        deadline = time.monotonic() + drain_timeout
+        while any(q.qsize() for q in self._queues) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+
+    def route(self, chat_id: Optional[int], update: Dict[str, Any]) -> int:
+        # апдейты без чата (редкие служебные) — в шард 0
+        shard = self.ring.owner(chat_id) if chat_id is not None else 0
+        self._queues[shard].put_nowait(update)
+        self.stats["routed"] += 1
+        return shard
+
+    async def _sender(self, shard: int):
+        queue = self._queues[shard]
+        url = f"{self.worker_urls[shard]}/updates"
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            body = json.dumps(batch, ensure_ascii=False, separators=(",", ":"))
+            while True:
+                try:
+                    resp = await self._http.post(url, content=body, headers={"Content-Type": "application/json"})
+                    resp.raise_for_status()
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.stats["retries"] += 1
+                    logging.warning("Shard %d unavailable (%s), retrying %d updates", shard, e, len(batch))
+                    await asyncio.sleep(self.retry_delay)
+            self.stats["sent"] += len(batch)
+            self.stats["batches"] += 1
+
+    def depths(self) -> List[int]:
+        return [q.qsize() for q in self._queues]
+
+# ================== ПЕРЕБАЛАНСИРОВКА ==================
+# Отметка «чат уже скопирован сюда из from_shard» — пишется в базу получателя той же
+# транзакцией, что и строки чата; удаляется, когда перенос закончен целиком.
+REBALANCE_MARKS = "rebalance_marks"
+REBALANCE_MARKS_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS {REBALANCE_MARKS} (
+    chat_id     INTEGER NOT NULL,
+    from_shard  INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, from_shard)
+) WITHOUT ROWID;
+"""
+
+def _chat_tables(conn: sqlite3.Connection) -> List[Tuple[str, List[str]]]:
+    # все таблицы с колонкой chat_id; суррогатный INTEGER PRIMARY KEY не копируем
+    result = []
+    for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"):
+        if table == REBALANCE_MARKS:
+            continue
+        info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        names = [row[1] for row in info]
+        if "chat_id" not in names:
+            continue
+        pk = [row for row in info if row[5]]
+        if len(pk) == 1 and pk[0][1] != "chat_id" and pk[0][2].upper() == "INTEGER":
+            names.remove(pk[0][1])
+        result.append((table, names))
+    return result
+
+def rebalance(sqlite_path: str, old_count: int, new_count: int, vnodes: int = 64) -> Dict[str, int]:
+    """
+    Переносит строки чатов между базами шардов при смене их числа.
+    Запускать при остановленных воркерах; затем воркеры и ingress стартуют с новым N.
+    Индексы расписаний (schedule_index.shard-N.json) помечены числом шардов — при старте
+    с новым N воркеры пересобирают их из своих баз сами.
+
+    Копия в базу получателя и удаление из источника — две транзакции. Если перенос прервался
+    между ними, повторный запуск с теми же --from/--to не копирует чат второй раз
+    (у surveys и food_log суррогатные id — были бы дубли): по отметке в rebalance_marks
+    он только дочищает источник. Отметки удаляются после полного прохода, поэтому
+    прерванный перенос нужно довести тем же запуском, прежде чем менять число шардов снова.
+    """
+    from storage import SQLITE_SCHEMA
+
+    old_ring, new_ring = HashRing(old_count, vnodes), HashRing(new_count, vnodes)
+    conns = {}
+    for shard in range(max(old_count, new_count)):
+        conn = sqlite3.connect(shard_path(sqlite_path, shard))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SQLITE_SCHEMA)
+        conn.executescript(REBALANCE_MARKS_SCHEMA)
+        conns[shard] = conn
+
+    counts = {"chats_moved": 0, "rows_moved": 0, "chats_resumed": 0}
+    try:
+        for shard in range(old_count):
+            src = conns[shard]
+            tables = _chat_tables(src)
+            chat_ids = set()
+            for table, _ in tables:
+                chat_ids.update(r[0] for r in src.execute(f"SELECT DISTINCT chat_id FROM {table}"))
+            for chat_id in chat_ids:
+                # ожидаем, что чат лежит у старого владельца; чужие строки тоже переносим
+                target = new_ring.owner(chat_id)
+                if target == shard:
+                    continue
+                if old_ring.owner(chat_id) != shard:
+                    logging.warning("chat_id=%s found on shard %d, old owner is %d", chat_id, shard, old_ring.owner(chat_id))
+                dst = conns[target]
+                copied = dst.execute(
+                    f"SELECT 1 FROM {REBALANCE_MARKS} WHERE chat_id = ? AND from_shard = ?", (chat_id, shard)
+                ).fetchone()
+                if copied:
+                    # прошлый запуск успел закоммитить копию, но не удаление из источника
+                    counts["chats_resumed"] += 1
+                else:
+                    with dst:
+                        for table, columns in tables:
+                            cols = ", ".join(columns)
+                            rows = src.execute(f"SELECT {cols} FROM {table} WHERE chat_id = ?", (chat_id,)).fetchall()
+                            if not rows:
+                                continue
+                            marks = ", ".join("?" for _ in columns)
+                            dst.executemany(f"INSERT OR REPLACE INTO {table} ({cols}) VALUES ({marks})", rows)
+                            counts["rows_moved"] += len(rows)
+                        dst.execute(f"INSERT INTO {REBALANCE_MARKS} (chat_id, from_shard) VALUES (?, ?)", (chat_id, shard))
+                    counts["chats_moved"] += 1
+                with src:
+                    for table, _ in tables:
+                        src.execute(f"DELETE FROM {table} WHERE chat_id = ?", (chat_id,))
+        # перенос завершён: отметки не должны сработать в следующей перебалансировке
+        for conn in conns.values():
+            with conn:
+                conn.execute(f"DELETE FROM {REBALANCE_MARKS}")
+    finally:
+        for conn in conns.values():
+            conn.close()
+    return counts
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Перебалансировка баз шардов при смене их числа")
+    parser.add_argument("--sqlite", default="bot.db", help="базовый путь к базе (bot.db -> bot.shard-N.db)")
+    parser.add_argument("--from", dest="old_count", type=int, required=True, help="старое число шардов")
+    parser.add_argument("--to", dest="new_count", type=int, required=True, help="новое число шардов")
+    parser.add_argument("--vnodes", type=int, default=64)
+    args = parser.parse_args()
+    print(rebalance(args.sqlite, args.old_count, args.new_count, args.vnodes))
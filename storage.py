@@ -0,0 +1,789 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from collections import deque
+from datetime import date, timedelta
+from typing import Dict, Any, Optional, List, Tuple, Iterator
+
+from compact import CheckinHistory, apply_checkin_record, dump_history, load_history, slot_code
+from food_diary import NUTRIENTS, add_to_totals, totals_dict
+from journal import Journal, atomic_write_text, read_json_file
+from persistence import PersistenceWorker
+from retention import CheckinArchive, merge_days
+from tracing import span
+
+# {date: {checkin_type: {field: value}}}
+CheckinDays = Dict[str, Dict[str, Dict[str, str]]]
+
+# ================== ИНТЕРФЕЙС ==================
+class Storage(ABC):
+    """
+    Всё состояние бота: подписчики и их настройки, ответы чек-инов,
+    результаты анкет и дневник питания.
+    Методы синхронные и дешёвые: запись на диск делает PersistenceWorker.
+    """
+
+    @abstractmethod
+    def load(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def compact(self) -> None:
+        pass
+
+    def roll(self, budget: int = 1000) -> bool:
+        # шаг фоновой ротации старых данных; True — работа ещё осталась
+        return False
+
+    # ---------- подписчики ----------
+    @abstractmethod
+    def list_subscribers(self) -> List[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_subscriber(self, chat_id: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_subscriber(self, chat_id: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_chat_settings(self, chat_id: int) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_chat_settings(self, chat_id: int, **changes) -> None:
+        raise NotImplementedError
+
+    # ---------- чек-ины ----------
+    @abstractmethod
+    def record_checkin_answer(
+        self, chat_id: int, date_key: str, checkin_type: str, field: str, value: str
+    ) -> Optional[str]:
+        # возвращает прежнее значение поля за этот день (если было)
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_checkins(self, chat_id: int, start: date, end: date) -> CheckinDays:
+        raise NotImplementedError
+
+    # ---------- аналитика ----------
+    # Ответы-кнопки чатов за [start, end] одной матрицей uint16 (коды compact.SLOTS):
+    # строка на чат, столбец на день, 0 — ответа нет. Метод синхронный — chat_ids режет вызывающий.
+    @abstractmethod
+    def checkin_codes(self, chat_ids: List[int], start: date, end: date) -> array:
+        raise NotImplementedError
+
+    def archived_checkin_codes(self, chat_ids: List[int], start: date, end: date) -> List[array]:
+        # то же из холодного архива, матрица на месяц; можно звать из потока. [] — архива нет
+        return []
+
+    # ---------- анкеты ----------
+    @abstractmethod
+    def save_survey(self, chat_id: int, answers: Dict[str, Any], ts: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_surveys(self, chat_id: int) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_surveys(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        # все анкеты всех чатов: (chat_id, запись как в list_surveys), внутри чата — по времени;
+        # можно звать из потока
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_survey_scores(self, updates: List[Tuple[int, float, Dict[str, Any]]]) -> None:
+        # пересчитанные итоги: (chat_id, ts анкеты, ответы с новым "score") — пачкой
+        raise NotImplementedError
+
+    # ---------- дневник питания ----------
+    @abstractmethod
+    def add_food_entry(self, chat_id: int, date_key: str, entry: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_food_entries(self, chat_id: int, start: date, end: date) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_food_totals(self, chat_id: int, start: date, end: date) -> Dict[str, Dict[str, float]]:
+        # {date_key: {calories, protein, fat, carbs, entries}} — итоги, накопленные при записи
+        raise NotImplementedError
+
+    # ---------- состояние диалогов ----------
+    # kind — вид состояния ("checkin", "user", "conv:<имя>"), key — уточнение внутри чата.
+    # Значение сохраняется как есть: вызывающий передаёт копию, а не живой объект.
+    @abstractmethod
+    def get_state(self, kind: str, chat_id: int, key: str = "") -> Optional[Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_state(self, kind: str, chat_id: int, value: Optional[Any], key: str = "") -> None:
+        # None — удалить
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_states(self, kind: str) -> List[Tuple[int, str, Any]]:
+        raise NotImplementedError
+
+# ================== JSON ==================
+def _apply_list_record(data: dict, rec: Dict[str, Any]) -> None:
+    # rec: {"c": chat_id, ...payload}
+    data.setdefault(rec["c"], []).append(rec)
+
+def _apply_survey_record(data: dict, rec: Dict[str, Any]) -> None:
+    # анкета целиком, либо {"c", "ts", "score"} — новый итог уже записанной анкеты
+    if "answers" in rec:
+        data.setdefault(rec["c"], []).append(rec)
+        return
+    for survey in reversed(data.get(rec["c"], [])):
+        if survey["ts"] == rec["ts"]:
+            survey["answers"]["score"] = rec["score"]
+            return
+
+def _apply_state_record(data: dict, rec: Dict[str, Any]) -> None:
+    # rec: {"k": kind, "c": chat_id, "key": key, "v": value|None}
+    chats = data.setdefault(rec["k"], {})
+    if rec["v"] is None:
+        keys = chats.get(rec["c"])
+        if keys is not None:
+            keys.pop(rec["key"], None)
+            if not keys:
+                del chats[rec["c"]]
+    else:
+        chats.setdefault(rec["c"], {})[rec["key"]] = rec["v"]
+
+def _lazy_part(name: str):
+    # часть данных поднимается с диска при первом обращении, а не при старте
+    def get(self):
+        value = self._parts.get(name)
+        if value is None:
+            value = self._parts[name] = self._load_part(name)
+        return value
+
+    def set(self, value):
+        self._parts[name] = value
+
+    return property(get, set)
+
+class JsonStorage(Storage):
+    """
+    Прежний формат: user_settings.json и weekly_data.json (+ журналы дозаписи).
+    Всё держится в памяти целиком; ответы чек-инов — в компактном CheckinHistory,
+    снимок weekly_data.json пишется в компактном формате (старый читается как раньше).
+
+    hot_days > 0 — в памяти и в снимке только последние hot_days дней чек-инов,
+    более старые уходят в archive/checkins-YYYY-MM.json.gz и читаются по запросу.
+
+    Файлы читаются лениво: каждая часть (настройки, чек-ины, анкеты, питание, состояние)
+    при первом обращении к ней, поэтому load() не зависит от числа пользователей.
+    """
+
+    user_settings = _lazy_part("settings")
+    weekly_data = _lazy_part("weekly")
+    surveys = _lazy_part("surveys")
+    food_log = _lazy_part("food")
+    state = _lazy_part("state")
+
+    def __init__(self, persistence: PersistenceWorker, directory: str = ".", compact_every: int = 5000,
+                 hot_days: int = 0):
+        self.persistence = persistence
+        self.compact_every = compact_every
+        self.hot_days = hot_days
+        path = lambda name: os.path.join(directory, name)
+        self.settings_path = path("user_settings.json")
+        # settings: {"subscribers": [...], "chat_settings": {...}}; weekly: CheckinHistory;
+        # surveys/food: {chat_id: [записи]}; state: {kind: {chat_id: {key: value}}}
+        self._parts: Dict[str, Any] = {}
+        self._food_totals: Optional[Dict[str, Dict[str, List[float]]]] = None  # см. food_totals
+
+        self.weekly_journal = Journal(
+            path("weekly_data.json"),
+            path("weekly_data.journal"),
+            apply_checkin_record,
+            load_snapshot=load_history,
+            dump_snapshot=dump_history,
+            empty=CheckinHistory,
+        )
+        self.surveys_journal = Journal(path("surveys.json"), path("surveys.journal"), _apply_survey_record)
+        self.food_journal = Journal(path("food_log.json"), path("food_log.journal"), _apply_list_record)
+        self.state_journal = Journal(path("state.json"), path("state.journal"), _apply_state_record)
+        self._journals = {
+            "weekly": self.weekly_journal,
+            "surveys": self.surveys_journal,
+            "food": self.food_journal,
+            "state": self.state_journal,
+        }
+
+        # prepare — в event loop (дёшево), write — в потоке воркера
+        persistence.register(
+            "settings",
+            self._settings_snapshot,
+            lambda snapshot: atomic_write_text(self.settings_path, json.dumps(snapshot, ensure_ascii=False)),
+        )
+        for name, j in self._journals.items():
+            persistence.register(
+                f"{name}_journal",
+                j.take_buffer,
+                lambda payload, j=j: j.write_lines(*payload),
+                j.restore_buffer,
+            )
+        for name, j in self._journals.items():
+            persistence.register(f"{name}_snapshot", lambda: None, lambda _, j=j: j.compact())
+
+        # ротация: на диске — в потоке воркера (архив, затем снимок без старых дней);
+        # в памяти — порциями в roll(), и только до границы, уже записанной в архив
+        self.archive = CheckinArchive(path("archive")) if hot_days else None
+        self._requested_cutoff = 0
+        self._archived_cutoff = 0
+        self._trim_target = 0
+        self._trim_queue: deque = deque()
+        if self.archive is not None:
+            persistence.register("weekly_rollover", lambda: self._requested_cutoff, self._rollover)
+
+    def load(self) -> None:
+        # части читаются по первому обращению (_lazy_part)
+        pass
+
+    def _settings_snapshot(self) -> Dict[str, Any]:
+        # копируются только ссылки: список подписчиков и настройки чата не правятся на месте,
+        # а заменяются целиком (см. add_subscriber, update_chat_settings), — кодирует поток воркера
+        settings = dict(self.user_settings)
+        settings["chat_settings"] = dict(settings.get("chat_settings", {}))
+        return settings
+
+    def _load_part(self, name: str) -> Any:
+        started = time.perf_counter()
+        if name == "settings":
+            try:
+                data = read_json_file(self.settings_path)
+            except Exception:
+                logging.exception("Failed to load %s", self.settings_path)
+                data = {}
+            data.setdefault("subscribers", [])
+            data.setdefault("chat_settings", {})
+        else:
+            data = self._journals[name].load()
+        logging.info("Storage part %s loaded in %.3fs", name, time.perf_counter() - started)
+        return data
+
+    def close(self) -> None:
+        for j in self._journals.values():
+            j.close()
+
+    def compact(self) -> None:
+        for name, j in self._journals.items():
+            if j.pending:
+                self.persistence.mark_dirty(f"{name}_snapshot")
+
+    def _hot_cutoff(self) -> int:
+        return (date.today() - timedelta(days=self.hot_days)).toordinal()
+
+    def _rollover(self, cutoff: int) -> int:
+        # поток воркера: журнал сворачивается в снимок, дни раньше cutoff переезжают в архив
+        j = self.weekly_journal
+        size = 0
+        with j.lock:  # ленивая загрузка weekly не должна читать снимок посередине
+            j.compact()
+            history = load_history(j.snapshot_path)
+            old = history.split_before(cutoff)
+            if len(old):
+                months = self.archive.absorb(old)
+                # архив записан раньше снимка: при падении между ними дни просто окажутся в обоих местах
+                size = atomic_write_text(j.snapshot_path, dump_history(history))
+                logging.info("Rollover: %d chats, %d months archived", len(old), months)
+        self._archived_cutoff = cutoff
+        return size
+
+    def roll(self, budget: int = 1000) -> bool:
+        if self.archive is None:
+            return False
+        cutoff = self._hot_cutoff()
+        if cutoff > self._requested_cutoff:
+            self._requested_cutoff = cutoff
+            self.persistence.mark_dirty("weekly_rollover")
+        target = self._archived_cutoff
+        if "weekly" not in self._parts:
+            # чек-ины ещё не читались — поднимутся уже из урезанного снимка
+            return False
+        if target > self._trim_target:
+            self._trim_target = target
+            self._trim_queue = deque(self.weekly_data.chats())
+        if not self._trim_queue:
+            return False
+        batch = [self._trim_queue.popleft() for _ in range(min(budget, len(self._trim_queue)))]
+        self.weekly_data.split_before(target, batch)  # отрезанное уже лежит в архиве
+        return bool(self._trim_queue)
+
+    def _append(self, name: str, rec: Dict[str, Any]):
+        j = self._journals[name]
+        with span("storage", journal=name):
+            j.buffer(rec)
+        self.persistence.mark_dirty(f"{name}_journal")
+        if j.pending + j.buffered >= self.compact_every:
+            self.persistence.mark_dirty(f"{name}_snapshot")
+
+    # ---------- подписчики ----------
+    def list_subscribers(self) -> List[int]:
+        return [int(c) for c in self.user_settings.get("subscribers", [])]
+
+    def add_subscriber(self, chat_id: int) -> None:
+        subs = set(self.user_settings.get("subscribers", []))
+        subs.add(chat_id)
+        self.user_settings["subscribers"] = sorted(subs)
+        self.persistence.mark_dirty("settings")
+
+    def remove_subscriber(self, chat_id: int) -> None:
+        subs = set(self.user_settings.get("subscribers", []))
+        subs.discard(chat_id)
+        self.user_settings["subscribers"] = sorted(subs)
+        self.persistence.mark_dirty("settings")
+
+    def get_chat_settings(self, chat_id: int) -> Dict[str, Any]:
+        return self.user_settings.get("chat_settings", {}).get(str(chat_id), {})
+
+    def update_chat_settings(self, chat_id: int, **changes) -> None:
+        chats = self.user_settings.setdefault("chat_settings", {})
+        key = str(chat_id)
+        chats[key] = {**chats.get(key, {}), **changes}
+        self.persistence.mark_dirty("settings")
+
+    # ---------- чек-ины ----------
+    def record_checkin_answer(self, chat_id, date_key, checkin_type, field, value):
+        rec = {"c": str(chat_id), "d": date_key, "t": checkin_type, "f": field, "v": value}
+        previous = self.weekly_data.record(rec["c"], date_key, checkin_type, field, value)
+        # одна компактная строка в журнал вместо перезаписи всего weekly_data.json
+        self._append("weekly", rec)
+        return previous
+
+    def get_checkins(self, chat_id: int, start: date, end: date) -> CheckinDays:
+        days = self.weekly_data.get_range(str(chat_id), start, end)
+        if self.archive is not None and start.toordinal() < self._hot_cutoff():
+            # за пределами горячего окна — дочитываем архив (месяцы грузятся лениво)
+            days = merge_days(self.archive.get_range(str(chat_id), start, end), days)
+        return days
+
+    def checkin_codes(self, chat_ids, start, end):
+        return self.weekly_data.codes_matrix([str(c) for c in chat_ids], start.toordinal(), (end - start).days + 1)
+
+    def archived_checkin_codes(self, chat_ids, start, end):
+        if self.archive is None or start.toordinal() >= self._hot_cutoff():
+            return []
+        keys = [str(c) for c in chat_ids]
+        days = (end - start).days + 1
+        return [h.codes_matrix(keys, start.toordinal(), days) for h in self.archive.read_range(start, end)]
+
+    # ---------- анкеты ----------
+    def save_survey(self, chat_id, answers, ts=None):
+        rec = {"c": str(chat_id), "ts": ts or time.time(), "answers": answers}
+        _apply_survey_record(self.surveys, rec)
+        self._append("surveys", rec)
+
+    def list_surveys(self, chat_id):
+        return list(self.surveys.get(str(chat_id), []))
+
+    def iter_surveys(self):
+        for chat_key, records in list(self.surveys.items()):
+            for rec in records:
+                yield int(chat_key), rec
+
+    def update_survey_scores(self, updates):
+        # в журнал — только новый итог, анкета целиком не переписывается
+        for chat_id, ts, answers in updates:
+            rec = {"c": str(chat_id), "ts": ts, "score": answers["score"]}
+            _apply_survey_record(self.surveys, rec)
+            self._append("surveys", rec)
+
+    # ---------- дневник питания ----------
+    def add_food_entry(self, chat_id, date_key, entry):
+        rec = {"c": str(chat_id), "d": date_key, "ts": entry.get("ts") or time.time(), **entry}
+        # итоги — до записи в food_log: при первом обращении они строятся по журналу без неё
+        days = self.food_totals.setdefault(rec["c"], {})
+        days[date_key] = add_to_totals(days.get(date_key), rec)
+        _apply_list_record(self.food_log, rec)
+        self._append("food", rec)
+
+    def get_food_entries(self, chat_id, start, end):
+        lo, hi = start.isoformat(), end.isoformat()
+        return [e for e in self.food_log.get(str(chat_id), []) if lo <= e["d"] <= hi]
+
+    @property
+    def food_totals(self) -> Dict[str, Dict[str, List[float]]]:
+        # {chat_key: {date_key: итоги}}: один проход по журналу при первом обращении, дальше — только дописывание
+        if self._food_totals is None:
+            totals: Dict[str, Dict[str, List[float]]] = {}
+            for chat_key, records in self.food_log.items():
+                days = totals[chat_key] = {}
+                for rec in records:
+                    days[rec["d"]] = add_to_totals(days.get(rec["d"]), rec)
+            self._food_totals = totals
+        return self._food_totals
+
+    def get_food_totals(self, chat_id, start, end):
+        days = self.food_totals.get(str(chat_id))
+        result: Dict[str, Dict[str, float]] = {}
+        if not days:
+            return result
+        d = start
+        while d <= end:
+            totals = days.get(d.isoformat())
+            if totals is not None:
+                result[d.isoformat()] = totals_dict(totals)
+            d += timedelta(days=1)
+        return result
+
+    # ---------- состояние диалогов ----------
+    def get_state(self, kind, chat_id, key=""):
+        return self.state.get(kind, {}).get(str(chat_id), {}).get(key)
+
+    def set_state(self, kind, chat_id, value, key=""):
+        rec = {"k": kind, "c": str(chat_id), "key": key, "v": value}
+        _apply_state_record(self.state, rec)
+        self._append("state", rec)
+
+    def list_states(self, kind):
+        return [
+            (int(chat_key), key, value)
+            for chat_key, keys in self.state.get(kind, {}).items()
+            for key, value in keys.items()
+        ]
+
+# ================== SQLITE ==================
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscribers (
+    chat_id     INTEGER PRIMARY KEY,
+    created_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_settings (
+    chat_id     INTEGER PRIMARY KEY,
+    data        TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checkins (
+    chat_id       INTEGER NOT NULL,
+    date          TEXT NOT NULL,
+    checkin_type  TEXT NOT NULL,
+    field         TEXT NOT NULL,
+    value         TEXT NOT NULL,
+    PRIMARY KEY (chat_id, date, checkin_type, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS surveys (
+    id          INTEGER PRIMARY KEY,
+    chat_id     INTEGER NOT NULL,
+    created_at  REAL NOT NULL,
+    answers     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_surveys_chat ON surveys (chat_id, created_at);
+CREATE TABLE IF NOT EXISTS food_log (
+    id          INTEGER PRIMARY KEY,
+    chat_id     INTEGER NOT NULL,
+    date        TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_food_chat_date ON food_log (chat_id, date);
+CREATE TABLE IF NOT EXISTS food_daily (
+    chat_id     INTEGER NOT NULL,
+    date        TEXT NOT NULL,
+    calories    REAL NOT NULL,
+    protein     REAL NOT NULL,
+    fat         REAL NOT NULL,
+    carbs       REAL NOT NULL,
+    entries     INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS state (
+    kind        TEXT NOT NULL,
+    chat_id     INTEGER NOT NULL,
+    key         TEXT NOT NULL,
+    data        TEXT NOT NULL,
+    PRIMARY KEY (kind, chat_id, key)
+) WITHOUT ROWID;
+"""
+
+# итоги дня дополняются той же транзакцией, что и запись в food_log
+FOOD_DAILY_UPSERT = (
+    f"INSERT INTO food_daily (chat_id, date, {', '.join(NUTRIENTS)}, entries) VALUES (?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (chat_id, date) DO UPDATE SET "
+    + ", ".join(f"{c} = {c} + excluded.{c}" for c in (*NUTRIENTS, "entries"))
+)
+
+class SqliteStorage(Storage):
+    """
+    SQLite в режиме WAL. Запросы выполняются сразу (они короткие и по индексу),
+    а COMMIT делает поток PersistenceWorker — пачкой за интервал.
+    Соединение одно, доступ к нему — под блокировкой.
+    """
+
+    def __init__(self, persistence: PersistenceWorker, path: str = "bot.db"):
+        self.persistence = persistence
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        persistence.register("sqlite", lambda: None, self._commit)
+
+    def load(self) -> None:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SQLITE_SCHEMA)
+        conn.commit()
+        self._conn = conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._lock:
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+
+    def _commit(self, _=None) -> int:
+        with self._lock:
+            if self._conn is not None and self._conn.in_transaction:
+                self._conn.commit()
+        return 0
+
+    def _write(self, sql: str, params=()):
+        with span("storage", sql=sql[:48]), self._lock:
+            self._conn.execute(sql, params)
+        self.persistence.mark_dirty("sqlite")
+
+    def _read(self, sql: str, params=()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # ---------- подписчики ----------
+    def list_subscribers(self) -> List[int]:
+        return [r[0] for r in self._read("SELECT chat_id FROM subscribers ORDER BY chat_id")]
+
+    def add_subscriber(self, chat_id: int) -> None:
+        self._write("INSERT OR IGNORE INTO subscribers (chat_id, created_at) VALUES (?, ?)", (chat_id, time.time()))
+
+    def remove_subscriber(self, chat_id: int) -> None:
+        self._write("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,))
+
+    def get_chat_settings(self, chat_id: int) -> Dict[str, Any]:
+        rows = self._read("SELECT data FROM chat_settings WHERE chat_id = ?", (chat_id,))
+        return json.loads(rows[0][0]) if rows else {}
+
+    def update_chat_settings(self, chat_id: int, **changes) -> None:
+        cs = self.get_chat_settings(chat_id)
+        cs.update(changes)
+        self._write(
+            "INSERT OR REPLACE INTO chat_settings (chat_id, data) VALUES (?, ?)",
+            (chat_id, json.dumps(cs, ensure_ascii=False)),
+        )
+
+    # ---------- чек-ины ----------
+    def record_checkin_answer(self, chat_id, date_key, checkin_type, field, value):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM checkins WHERE chat_id = ? AND date = ? AND checkin_type = ? AND field = ?",
+                (chat_id, date_key, checkin_type, field),
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkins (chat_id, date, checkin_type, field, value) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, date_key, checkin_type, field, value),
+            )
+        self.persistence.mark_dirty("sqlite")
+        return row[0] if row else None
+
+    def get_checkins(self, chat_id: int, start: date, end: date) -> CheckinDays:
+        result: CheckinDays = {}
+        rows = self._read(
+            "SELECT date, checkin_type, field, value FROM checkins "
+            "WHERE chat_id = ? AND date BETWEEN ? AND ?",
+            (chat_id, start.isoformat(), end.isoformat()),
+        )
+        for d, t, f, v in rows:
+            result.setdefault(d, {}).setdefault(t, {})[f] = v
+        return result
+
+    def checkin_codes(self, chat_ids, start, end):
+        days = (end - start).days + 1
+        out = array("H", bytes(2 * days * len(chat_ids)))
+        if not chat_ids:
+            return out
+        row_of = {c: i for i, c in enumerate(chat_ids)}
+        rows = self._read(
+            "SELECT chat_id, date, checkin_type, field, value FROM checkins "
+            f"WHERE chat_id IN ({','.join('?' * len(chat_ids))}) AND date BETWEEN ? AND ?",
+            (*chat_ids, start.isoformat(), end.isoformat()),
+        )
+        base = start.toordinal()
+        for chat_id, d, t, f, v in rows:
+            code = slot_code(t, f, v)
+            if code:
+                out[row_of[chat_id] * days + date.fromisoformat(d).toordinal() - base] |= code
+        return out
+
+    # ---------- анкеты ----------
+    def save_survey(self, chat_id, answers, ts=None):
+        self._write(
+            "INSERT INTO surveys (chat_id, created_at, answers) VALUES (?, ?, ?)",
+            (chat_id, ts or time.time(), json.dumps(answers, ensure_ascii=False)),
+        )
+
+    def list_surveys(self, chat_id):
+        rows = self._read(
+            "SELECT created_at, answers FROM surveys WHERE chat_id = ? ORDER BY created_at", (chat_id,)
+        )
+        return [{"c": str(chat_id), "ts": ts, "answers": json.loads(a)} for ts, a in rows]
+
+    def iter_surveys(self):
+        rows = self._read("SELECT chat_id, created_at, answers FROM surveys ORDER BY chat_id, created_at")
+        for chat_id, ts, a in rows:
+            yield chat_id, {"c": str(chat_id), "ts": ts, "answers": json.loads(a)}
+
+    def update_survey_scores(self, updates):
+        with span("storage", sql="UPDATE surveys"), self._lock:
+            self._conn.executemany(
+                "UPDATE surveys SET answers = ? WHERE chat_id = ? AND created_at = ?",
+                [(json.dumps(answers, ensure_ascii=False), chat_id, ts) for chat_id, ts, answers in updates],
+            )
+        self.persistence.mark_dirty("sqlite")
+
+    # ---------- дневник питания ----------
+    def add_food_entry(self, chat_id, date_key, entry):
+        # обе записи — под одной блокировкой, чтобы COMMIT не разделил строку и её итоги
+        with span("storage", sql="INSERT INTO food_log"), self._lock:
+            self._conn.execute(
+                "INSERT INTO food_log (chat_id, date, created_at, data) VALUES (?, ?, ?, ?)",
+                (chat_id, date_key, entry.get("ts") or time.time(), json.dumps(entry, ensure_ascii=False)),
+            )
+            self._conn.execute(FOOD_DAILY_UPSERT, (chat_id, date_key, *add_to_totals(None, entry)))
+        self.persistence.mark_dirty("sqlite")
+
+    def get_food_entries(self, chat_id, start, end):
+        rows = self._read(
+            "SELECT date, created_at, data FROM food_log WHERE chat_id = ? AND date BETWEEN ? AND ? ORDER BY id",
+            (chat_id, start.isoformat(), end.isoformat()),
+        )
+        return [{"c": str(chat_id), "d": d, "ts": ts, **json.loads(data)} for d, ts, data in rows]
+
+    def get_food_totals(self, chat_id, start, end):
+        rows = self._read(
+            f"SELECT date, {', '.join(NUTRIENTS)}, entries FROM food_daily "
+            "WHERE chat_id = ? AND date BETWEEN ? AND ?",
+            (chat_id, start.isoformat(), end.isoformat()),
+        )
+        return {d: totals_dict(list(totals)) for d, *totals in rows}
+
+    # ---------- состояние диалогов ----------
+    def get_state(self, kind, chat_id, key=""):
+        rows = self._read("SELECT data FROM state WHERE kind = ? AND chat_id = ? AND key = ?", (kind, chat_id, key))
+        return json.loads(rows[0][0]) if rows else None
+
+    def set_state(self, kind, chat_id, value, key=""):
+        if value is None:
+            self._write("DELETE FROM state WHERE kind = ? AND chat_id = ? AND key = ?", (kind, chat_id, key))
+        else:
+            self._write(
+                "INSERT OR REPLACE INTO state (kind, chat_id, key, data) VALUES (?, ?, ?, ?)",
+                (kind, chat_id, key, json.dumps(value, ensure_ascii=False)),
+            )
+
+    def list_states(self, kind):
+        rows = self._read("SELECT chat_id, key, data FROM state WHERE kind = ?", (kind,))
+        return [(chat_id, key, json.loads(data)) for chat_id, key, data in rows]
+
+# ================== ФАБРИКА ==================
+def create_storage(
+    backend: str,
+    persistence: PersistenceWorker,
+    directory: str = ".",
+    sqlite_path: str = "bot.db",
+    compact_every: int = 5000,
+    hot_days: int = 0,
+) -> Storage:
+    if backend == "json":
+        return JsonStorage(persistence, directory, compact_every, hot_days)
+    if backend == "sqlite":
+        return SqliteStorage(persistence, sqlite_path)
+    raise RuntimeError(f"Unknown STORAGE_BACKEND: {backend!r}")
+
+# ================== МИГРАЦИЯ JSON -> SQLITE ==================
+def migrate_json_to_sqlite(directory: str, sqlite_path: str) -> Dict[str, int]:
+    src = JsonStorage(PersistenceWorker(), directory)
+    src.load()
+
+    conn = sqlite3.connect(sqlite_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SQLITE_SCHEMA)
+    counts = {"subscribers": 0, "chat_settings": 0, "checkins": 0, "surveys": 0, "food_log": 0, "state": 0}
+    now = time.time()
+    with conn:
+        for chat_id in src.list_subscribers():
+            conn.execute("INSERT OR IGNORE INTO subscribers (chat_id, created_at) VALUES (?, ?)", (chat_id, now))
+            counts["subscribers"] += 1
+        for chat_key, cs in src.user_settings.get("chat_settings", {}).items():
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_settings (chat_id, data) VALUES (?, ?)",
+                (int(chat_key), json.dumps(cs, ensure_ascii=False)),
+            )
+            counts["chat_settings"] += 1
+        history = CheckinArchive(os.path.join(directory, "archive")).load_all()
+        history.merge(src.weekly_data)
+        for chat_key, by_date in history.to_json().items():
+            rows = [
+                (int(chat_key), d, t, f, v)
+                for d, by_type in by_date.items()
+                for t, fields in by_type.items()
+                for f, v in fields.items()
+            ]
+            conn.executemany(
+                "INSERT OR REPLACE INTO checkins (chat_id, date, checkin_type, field, value) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            counts["checkins"] += len(rows)
+        for chat_key, items in src.surveys.items():
+            for rec in items:
+                conn.execute(
+                    "INSERT INTO surveys (chat_id, created_at, answers) VALUES (?, ?, ?)",
+                    (int(chat_key), rec["ts"], json.dumps(rec["answers"], ensure_ascii=False)),
+                )
+                counts["surveys"] += 1
+        for chat_key, items in src.food_log.items():
+            for rec in items:
+                entry = {k: v for k, v in rec.items() if k not in ("c", "d")}
+                conn.execute(
+                    "INSERT INTO food_log (chat_id, date, created_at, data) VALUES (?, ?, ?, ?)",
+                    (int(chat_key), rec["d"], rec["ts"], json.dumps(entry, ensure_ascii=False)),
+                )
+                counts["food_log"] += 1
+        for chat_key, days in src.food_totals.items():
+            conn.executemany(
+                f"INSERT OR REPLACE INTO food_daily (chat_id, date, {', '.join(NUTRIENTS)}, entries) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(int(chat_key), d, *totals) for d, totals in days.items()],
+            )
+        for kind, chats in src.state.items():
+            for chat_key, keys in chats.items():
+                for key, value in keys.items():
+                    conn.execute(
+                        "INSERT OR REPLACE INTO state (kind, chat_id, key, data) VALUES (?, ?, ?, ?)",
+                        (kind, int(chat_key), key, json.dumps(value, ensure_ascii=False)),
+                    )
+                    counts["state"] += 1
+    conn.close()
+    src.close()
+    return counts
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Перенос JSON-файлов бота в SQLite")
+    parser.add_argument("--json-dir", default=".", help="папка с user_settings.json и weekly_data.json")
+    parser.add_argument("--sqlite", default="bot.db", help="путь к базе SQLite")
+    args = parser.parse_args()
+    print(migrate_json_to_sqlite(args.json_dir, args.sqlite))
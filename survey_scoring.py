@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import time
+from typing import Dict, Any, Optional, List, Tuple, Iterable, Sequence
+
+from questionnaire import QUESTIONS, YES_NO
+
+SURVEY_FORMAT = "survey-bits/1"
+
+# ================== СХЕМА ЗАПИСИ ==================
+# Порядок полей — часть формата хранения: новые поля только дописывать в конец.
+# да/нет — по биту в масках yes и no (ни там ни там — вопрос пропущен),
+# варианты — код 1..N по кнопкам вопроса (0 — нет ответа), числа — как есть (int/float).
+YES_NO_FIELDS = (
+    "focus_issues", "irritability_day", "sleepiness_day", "sweet_craving", "fat_craving",
+    "palpitations", "cold_hands_feet", "skin_itch", "blue_sclera", "headache",
+    "oily_skin", "dry_skin", "low_libido", "vaginal_itch", "joint_pain",
+    "abdominal_pain", "bloating", "hair_loss", "dry_mouth",
+)
+CHOICE_FIELDS = (
+    "stool_frequency", "stool_type", "cycle_status", "energy_level",
+    "stress_level", "sleep_quality", "appetite_level", "activity_level",
+)
+NUMBER_FIELDS = ("height_cm", "weight_kg", "chest_cm", "waist_cm", "hips_cm", "steps_daily")
+SCALE_FIELDS = ("energy_level", "sleep_quality")  # 0–5, входят в общий балл
+
+_ANSWERS = {q["field"]: q["answer"] for q in QUESTIONS}
+CHOICE_OPTIONS: Dict[str, Tuple[str, ...]] = {
+    f: tuple(t for row in _ANSWERS[f].rows for t in row) for f in CHOICE_FIELDS
+}
+YES_BIT = {f: 1 << i for i, f in enumerate(YES_NO_FIELDS)}
+
+def _check_schema():
+    # вопрос анкеты, не попавший в схему, молча терялся бы при сохранении
+    listed = set(YES_NO_FIELDS) | set(CHOICE_FIELDS) | set(NUMBER_FIELDS)
+    missing = [q["field"] for q in QUESTIONS if q["field"] not in listed]
+    wrong = [f for f in YES_NO_FIELDS if _ANSWERS.get(f) is not YES_NO]
+    if missing or wrong:
+        raise RuntimeError(f"survey schema out of date: missing={missing} not_yes_no={wrong}")
+
+_check_schema()
+
+def _number(text: Any):
+    try:
+        value = float(text)
+    except (TypeError, ValueError):
+        return None
+    return int(value) if value.is_integer() else value
+
+def encode_survey(answers: Dict[str, Any]) -> Dict[str, Any]:
+    # ответы анкеты (как в context.user_data) -> компактная запись для storage.save_survey;
+    # итог подсчёта при сохранении кладётся рядом в "score" (см. Scorer.score)
+    yes = no = 0
+    for f, bit in YES_BIT.items():
+        v = answers.get(f)
+        if v == "да":
+            yes |= bit
+        elif v == "нет":
+            no |= bit
+    choices = []
+    for f in CHOICE_FIELDS:
+        options = CHOICE_OPTIONS[f]
+        v = answers.get(f)
+        choices.append(options.index(v) + 1 if v in options else 0)
+    return {
+        "format": SURVEY_FORMAT,
+        "yes": yes,
+        "no": no,
+        "choices": choices,
+        "numbers": [_number(answers.get(f)) for f in NUMBER_FIELDS],
+    }
+
+def decode_survey(record: Dict[str, Any]) -> Dict[str, str]:
+    # обратно в вид context.user_data (значения — строки, как их отдают валидаторы)
+    if record.get("format") != SURVEY_FORMAT:
+        return dict(record)  # запись в свободной форме
+    answers: Dict[str, str] = {}
+    for f, bit in YES_BIT.items():
+        if record["yes"] & bit:
+            answers[f] = "да"
+        elif record["no"] & bit:
+            answers[f] = "нет"
+    for f, code in zip(CHOICE_FIELDS, record["choices"]):
+        if code:
+            answers[f] = CHOICE_OPTIONS[f][code - 1]
+    for f, v in zip(NUMBER_FIELDS, record["numbers"]):
+        if v is not None:
+            answers[f] = str(v)
+    return answers
+
+# ================== ПРАВИЛА ЗОН ==================
+class Rule:
+    """Зона срабатывает, если выполнено хоть одно условие: «да» на вопрос, вариант ответа, порог числа."""
+
+    def __init__(self, yes: Sequence[str] = (), choices: Optional[Dict[str, Sequence[str]]] = None,
+                 at_least: Optional[Tuple[str, float]] = None):
+        self.yes = tuple(yes)
+        self.choices = {f: tuple(v) for f, v in (choices or {}).items()}
+        self.at_least = at_least
+
+# Меняется набор правил — увеличить RULES_VERSION: сохранённые итоги помечаются устаревшими.
+RULES_VERSION = 1
+ZONE_RULES: Tuple[Tuple[str, Rule], ...] = (
+    ("zone_gut", Rule(yes=("bloating", "abdominal_pain"),
+                      choices={"stool_frequency": ("1 раз в 2–3 дня", "1 раз в 3–5 дней")})),
+    ("zone_bmi", Rule(at_least=("waist_cm", 85))),
+    ("zone_cycle", Rule(choices={"cycle_status": ("нерегулярный", "я женщина, цикла нет")})),
+    ("zone_appetite", Rule(yes=("sweet_craving", "fat_craving"),
+                           choices={"appetite_level": ("повышенный", "пониженный")})),
+    ("zone_symptoms", Rule(yes=("focus_issues", "irritability_day", "sleepiness_day"))),
+    ("zone_skin", Rule(yes=("oily_skin", "dry_skin", "skin_itch"))),
+    ("zone_libido", Rule(yes=("low_libido", "vaginal_itch"))),
+    ("zone_pain", Rule(yes=("headache", "joint_pain", "abdominal_pain"))),
+    ("zone_dry_mouth", Rule(yes=("dry_mouth",))),
+    ("zone_red_flags", Rule(yes=("blue_sclera", "palpitations"))),
+)
+
+# ================== ДВИЖОК ==================
+class Scorer:
+    """
+    Правила компилируются в маски один раз. Признаки анкеты — одно целое:
+    биты «да», затем по биту на каждый вариант ответа, затем биты порогов чисел.
+    Зона = (признаки & маска зоны) != 0; все зоны анкеты — один проход по маскам.
+    """
+
+    def __init__(self, rules: Sequence[Tuple[str, Rule]] = ZONE_RULES, version: int = RULES_VERSION):
+        self.version = version
+        self.zones = tuple(name for name, _ in rules)
+        offset = len(YES_NO_FIELDS)
+        self._choice_base: List[int] = []
+        for f in CHOICE_FIELDS:
+            self._choice_base.append(offset - 1)  # код 1 — первый бит поля
+            offset += len(CHOICE_OPTIONS[f])
+        base = dict(zip(CHOICE_FIELDS, self._choice_base))
+        # пороги: (индекс числа, значение, бит)
+        self._thresholds: List[Tuple[int, float, int]] = []
+        self._masks: List[int] = []
+        for name, rule in rules:
+            mask = 0
+            for f in rule.yes:
+                mask |= YES_BIT[f]
+            for f, values in rule.choices.items():
+                for v in values:
+                    mask |= 1 << (base[f] + CHOICE_OPTIONS[f].index(v) + 1)
+            if rule.at_least is not None:
+                f, limit = rule.at_least
+                bit = 1 << offset
+                offset += 1
+                self._thresholds.append((NUMBER_FIELDS.index(f), limit, bit))
+                mask |= bit
+            self._masks.append(mask)
+        self._scale_index = [CHOICE_FIELDS.index(f) for f in SCALE_FIELDS]
+        self._max_score = 2 * len(YES_NO_FIELDS) + 5 * len(SCALE_FIELDS)
+
+    def features(self, record: Dict[str, Any]) -> int:
+        bits = record["yes"]
+        for base, code in zip(self._choice_base, record["choices"]):
+            if code:
+                bits |= 1 << (base + code)
+        numbers = record["numbers"]
+        for i, limit, bit in self._thresholds:
+            if numbers[i] is not None and numbers[i] >= limit:
+                bits |= bit
+        return bits
+
+    def score(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        feats = self.features(record)
+        zones = 0
+        for i, mask in enumerate(self._masks):
+            if feats & mask:
+                zones |= 1 << i
+        # шкалы 0–5 хранятся кодом кнопки: значение = код − 1
+        scale_sum = sum(max(record["choices"][i] - 1, 0) for i in self._scale_index)
+        score = 2 * record["no"].bit_count() + scale_sum
+        return {
+            "general": round(score / self._max_score * 100),
+            "health": round(scale_sum / (len(SCALE_FIELDS) * 5) * 10),
+            "zones": zones,
+            "rules": self.version,
+        }
+
+    def zone_names(self, zones: int) -> List[str]:
+        return [name for i, name in enumerate(self.zones) if zones >> i & 1]
+
+    def rescore(self, surveys: Iterable[Tuple[int, Dict[str, Any]]]
+                ) -> Tuple[Dict[str, Any], List[Tuple[int, float, Dict[str, Any]]]]:
+        """
+        Пересчёт всей базы за один проход: берётся последняя анкета каждого чата
+        (surveys — пары (chat_id, запись storage) по возрастанию времени).
+        Возвращает сводку (сколько чатов в каждой зоне, у скольких итог изменился)
+        и изменившиеся анкеты для storage.update_survey_scores: (chat_id, ts, ответы с новым итогом).
+        """
+        started = time.perf_counter()
+        latest: Dict[int, Dict[str, Any]] = {}
+        total = 0
+        for chat_id, rec in surveys:
+            total += 1
+            latest[chat_id] = rec
+        counts = [0] * len(self.zones)
+        updates: List[Tuple[int, float, Dict[str, Any]]] = []
+        skipped = 0
+        for chat_id, rec in latest.items():
+            record = rec.get("answers") or {}
+            if record.get("format") != SURVEY_FORMAT:
+                skipped += 1
+                continue
+            result = self.score(record)
+            zones = result["zones"]
+            for i in range(len(counts)):
+                counts[i] += zones >> i & 1
+            if record.get("score") != result:
+                updates.append((chat_id, rec["ts"], {**record, "score": result}))
+        stats = {
+            "surveys": total,
+            "chats": len(latest),
+            "skipped": skipped,
+            "changed": len(updates),
+            "zones": dict(zip(self.zones, counts)),
+            "rules": self.version,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        return stats, updates
+
+def score_delta(scorer: Scorer, current: Dict[str, Any], previous: Dict[str, Any]) -> Dict[str, Any]:
+    # сравнение с прошлой попыткой: разница баллов, появившиеся и ушедшие зоны
+    return {
+        "general": current["general"] - previous["general"],
+        "health": current["health"] - previous["health"],
+        "new_zones": scorer.zone_names(current["zones"] & ~previous["zones"]),
+        "gone_zones": scorer.zone_names(previous["zones"] & ~current["zones"]),
+    }
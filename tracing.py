@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import functools
+import heapq
+import json
+import random
+import threading
+import time
+from typing import Dict, Any, Optional, List, Tuple
+
+# ================== ТРАССИРОВКА АПДЕЙТОВ ==================
+# Трасса — один апдейт (или фоновая задача): список спанов с отметками от начала трассы.
+# Текущая трасса лежит в contextvar, поэтому спаны из хендлера, outbox и хранилища
+# попадают в трассу своего апдейта без передачи её через аргументы.
+# Без активной трассы span() возвращает общий пустой контекст — это одна проверка contextvar.
+
+_current: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+
+class Trace:
+    __slots__ = ("kind", "chat_id", "update_id", "wall", "started", "duration", "spans", "handled")
+
+    def __init__(self, kind: str, chat_id: Optional[int] = None, update_id: Optional[int] = None):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.update_id = update_id
+        self.wall = time.time()
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        # (name, начало от старта трассы, длительность, атрибуты)
+        self.spans: List[Tuple[str, float, float, Optional[Dict[str, Any]]]] = []
+        self.handled = False  # уже был хотя бы один хендлер
+
+    def last_end(self) -> float:
+        # момент конца последнего спана (perf_counter) или начало трассы
+        return self.started + max((start + d for _, start, d, _ in self.spans), default=0.0)
+
+    def add(self, name: str, start: float, end: float, attrs: Optional[Dict[str, Any]] = None):
+        self.spans.append((name, start - self.started, end - start, attrs))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "chat_id": self.chat_id,
+            "update_id": self.update_id,
+            "at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.wall)),
+            "duration_ms": round(self.duration * 1000, 2),
+            "spans": [
+                {"name": name, "start_ms": round(start * 1000, 2), "duration_ms": round(d * 1000, 2), **(attrs or {})}
+                for name, start, d, attrs in self.spans
+            ],
+        }
+
+class _Span:
+    __slots__ = ("trace", "name", "attrs", "start")
+
+    def __init__(self, trace: Trace, name: str, attrs: Optional[Dict[str, Any]]):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        attrs = self.attrs
+        if exc_type is not None:
+            attrs = {**(attrs or {}), "error": exc_type.__name__}
+        self.trace.add(self.name, self.start, time.perf_counter(), attrs)
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_SPAN = _NoSpan()
+
+def span(name: str, **attrs):
+    trace = _current.get()
+    if trace is None:
+        return NO_SPAN
+    return _Span(trace, name, attrs or None)
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+class Tracer:
+    """
+    Трассирует долю sample_rate апдейтов и держит keep самых медленных трасс.
+    begin()/finish() — вокруг обработки апдейта (см. ChatOrderedProcessor),
+    record() — для готовых спанов из других потоков (запись PersistenceWorker).
+    """
+
+    def __init__(self, sample_rate: float = 0.0, keep: int = 50):
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self._slowest: List[Tuple[float, int, Trace]] = []  # min-heap по длительности
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.stats = {"sampled": 0, "finished": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def begin(self, kind: str, chat_id: Optional[int] = None, update_id: Optional[int] = None):
+        # возвращает токен для finish() или None, если апдейт не попал в выборку
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        self.stats["sampled"] += 1
+        trace = Trace(kind, chat_id, update_id)
+        return trace, _current.set(trace)
+
+    def finish(self, token) -> None:
+        if token is None:
+            return
+        trace, ctx_token = token
+        _current.reset(ctx_token)
+        trace.duration = time.perf_counter() - trace.started
+        self._keep(trace)
+
+    def record(self, kind: str, spans: List[Tuple[str, float, float]], **fields) -> None:
+        # spans: (name, start perf_counter, end perf_counter); трасса уже завершена
+        if self.sample_rate <= 0 or not spans:
+            return
+        trace = Trace(kind, fields.get("chat_id"), fields.get("update_id"))
+        trace.started = min(s for _, s, _ in spans)
+        for name, start, end in spans:
+            trace.add(name, start, end)
+        trace.duration = max(e for _, _, e in spans) - trace.started
+        self._keep(trace)
+
+    def _keep(self, trace: Trace):
+        with self._lock:
+            self.stats["finished"] += 1
+            self._seq += 1
+            item = (trace.duration, self._seq, trace)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, item)
+            elif trace.duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+
+    def slowest(self, n: Optional[int] = None) -> List[Trace]:
+        with self._lock:
+            items = sorted(self._slowest, reverse=True)
+        return [t for _, _, t in items[:n]]
+
+    def dump(self, path: str) -> int:
+        traces = [t.to_dict() for t in self.slowest()]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"sample_rate": self.sample_rate, "stats": self.stats, "traces": traces}, f,
+                      ensure_ascii=False, indent=1)
+        return len(traces)
+
+    def summary(self, n: int = 5) -> str:
+        # короткий текст для ответа в чат: трасса и её самые долгие спаны
+        lines = []
+        for t in self.slowest(n):
+            top = sorted(t.spans, key=lambda s: s[2], reverse=True)[:4]
+            parts = ", ".join(f"{name} {d * 1000:.0f}ms" for name, _, d, _ in top)
+            lines.append(f"{t.duration * 1000:.0f}ms {t.kind} chat={t.chat_id}: {parts}")
+        return "\n".join(lines)
+
+def traced(name: str):
+    # спан на всё время async-функции; перед первым хендлером трассы ещё и «dispatch» —
+    # время от конца ожидания очереди до него (фильтры, check_update ConversationHandler и т.п.)
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return await fn(*args, **kwargs)
+            if not trace.handled:
+                trace.handled = True
+                trace.add("dispatch", trace.last_end(), time.perf_counter())
+            with _Span(trace, f"handler:{name}", None):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator